@@ -0,0 +1,31 @@
+'''Helpers to bound the concurrent requests'''
+
+import threading
+import time
+
+class TokenBucket:
+    '''
+    Token bucket rate limiter shared by threads. The bucket holds at most capacity tokens and is
+    refilled with rate tokens per second, acquire blocks until a token is available.
+    A rate of 0 or less disables the limit.
+    '''
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait_time = (tokens - self.tokens) / self.rate
+            time.sleep(wait_time)
@@ -12,4 +12,63 @@ MOCK_PATH = 'mocks/llm_resp.json'
 ADD_INSTRUCTION = True
 ENTITY_LIST = ['DISO', 'FINDING', 'ANATOMY', 'PHYS', 'CHEM', 'LABPROC', 'INJURY_POISONING', 'DEVICE']
 RUN_MODE = 'validate' # train, validate, test
-ENABLE_SECOND_LLM_RUN = False
\ No newline at end of file
+
+# LLM backend, FAKE_LLM takes precedence
+LLM_BACKEND_LIST = [
+    'TEXTSYNTH',    # send the requests to TextSynth
+    'REPLAY'        # answer the requests from the recordings in LLM_REPLAY_PATH, without network access
+]
+LLM_BACKEND = LLM_BACKEND_LIST[0]
+LLM_HISTORY_PATH = 'logs/llm_nne_history.jsonl' # every request and response is appended here
+LLM_REPLAY_PATH = 'logs/llm_nne_history.jsonl'
+LLM_HISTORY_MAX_BYTES = 100 * 1024 * 1024 # rotate the history log at this size, 0 never rotates
+LLM_HISTORY_BACKUP_COUNT = 5
+LLM_HISTORY_COMPRESS = True # gzip the rotated history logs
+
+# LLM response cache, see llm_cache.py for the modes
+LLM_CACHE_MODE_LIST = [
+    'OFF',              # 0
+    'DETERMINISTIC',    # 1 cache the requests with temperature 0 or a seed, the NER prompts use LLM_SEED
+    'ALL',              # 2
+    'READ_ONLY'         # 3 replay the cached responses only, the requests not cached get an empty completion
+]
+LLM_CACHE_MODE = LLM_CACHE_MODE_LIST[1]
+LLM_CACHE_PATH = 'simple_db/data/llm_cache.sqlite'
+LLM_CACHE_TTL = 0               # seconds, 0 keeps the entries forever
+LLM_CACHE_MAX_ENTRIES = 100000  # least recently used entries are evicted, 0 for no limit
+ENABLE_SECOND_LLM_RUN = False
+
+# Spacy pipelines
+GEN_SPACY_MODEL = 'en_core_web_trf' # general purpose NLP
+BIO_SPACY_MODEL = 'en_ner_bc5cdr_md' # biomedical NLP, entity types: DISEASE, CHEMICAL
+
+# Run all abstracts through the spacy pipelines with nlp.pipe before the per record steps
+ENABLE_SPACY_PREPASS = True
+SPACY_BATCH_SIZE = 16
+SPACY_N_PROCESS = 1
+
+# Cache the parsed spacy docs on disk, so rule-only iterations skip the spacy pipelines
+ENABLE_DOC_CACHE = True
+DOC_CACHE_DIR = 'processed_data/doc_cache'
+
+# UMLS http client
+UMLS_MAX_RETRIES = 5
+UMLS_BACKOFF_BASE = 0.5 # seconds, doubled on every retry
+UMLS_BACKOFF_MAX = 8.0
+UMLS_POOL_SIZE = 10 # connections, also the limit of the requests in flight
+UMLS_MAX_WORKERS = 5 # entities searched at once by umls_rules_many
+UMLS_CUI_WORKERS = 5 # CUIs looked up at once, UMLS_MAX_WORKERS + UMLS_CUI_WORKERS stay within UMLS_POOL_SIZE
+UMLS_RATE_LIMIT = 20 # requests per second, the limit of the UMLS API terms of service, 0 for no limit
+UMLS_RATE_BURST = 5
+UMLS_TIMEOUT = 10
+
+# UMLS backend
+UMLS_BACKEND_LIST = [
+    'REMOTE',   # UMLS REST API
+    'LOCAL'     # offline index built by umls_local.py from MRCONSO.RRF and MRSTY.RRF
+]
+UMLS_BACKEND = UMLS_BACKEND_LIST[0]
+UMLS_LOCAL_INDEX = 'simple_db/data/umls_local.sqlite'
+
+# Semantic type name to tag table, rebuild or verify it with semantic_table.py
+SEMANTIC_TAG_TABLE = 'simple_db/data/semantic_tag_table.json'
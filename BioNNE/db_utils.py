@@ -4,8 +4,12 @@ def open_db():
     cui_db = SimpleDB('simple_db/data/cui.json')
     semantic_db = SimpleDB('simple_db/data/semantic.json')
     nonentity_db = SimpleDB('simple_db/data/nonentity.json') # entity that UMLS lookup returns no results
-    return cui_db, semantic_db, nonentity_db
+    rules_db = SimpleDB('simple_db/data/umls_rules.sqlite') # umls_rules results keyed by the rules version, topk and normalized entity
+    return cui_db, semantic_db, nonentity_db, rules_db
 
 def close_db(database_list):
     for db in database_list:
-        db.save_data()
+        # Write the new entries back to the tracked JSON files
+        if db.json_file is not None:
+            db.export_data()
+        db.close()
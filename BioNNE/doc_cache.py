@@ -0,0 +1,40 @@
+'''
+On disk cache of the spacy docs parsed from the BioNNE abstracts.
+Each pipeline has its own folder named after the model name and version, so the cache is
+invalidated when the model changes. Every doc is saved as a DocBin file named by the hash of the text:
+    processed_data/doc_cache/en_core_web_trf-3.7.3/<sha256 of text>.spacy
+'''
+import hashlib
+import os
+import spacy
+from spacy.tokens import DocBin
+
+class DocCache:
+    def __init__(self, cache_dir, model_name, lang='en'):
+        self.model_name = model_name
+        self.model_version = spacy.util.get_package_version(model_name)
+        self.cache_dir = os.path.join(cache_dir, f'{model_name}-{self.model_version}')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Docs are restored with a blank vocab of the same language, so the pipeline doesn't need to be loaded
+        self.vocab = spacy.blank(lang).vocab
+
+    def get_path(self, text):
+        text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f'{text_hash}.spacy')
+
+    def get(self, text):
+        '''Return the cached doc of the text, return None if the text is not cached'''
+        path = self.get_path(text)
+        if not os.path.exists(path):
+            return None
+        doc_bin = DocBin(store_user_data=True).from_disk(path)
+        return next(doc_bin.get_docs(self.vocab))
+
+    def set(self, text, doc):
+        '''Save the doc, user_data (e.g. abbreviation offsets) is saved along with the doc'''
+        doc_bin = DocBin(store_user_data=True)
+        doc_bin.add(doc)
+        path = self.get_path(text)
+        tmp_path = path + '.tmp'
+        doc_bin.to_disk(tmp_path)
+        os.replace(tmp_path, path)
@@ -72,24 +72,31 @@ class DocNER:
         '''
         Populate the UMLS tag for each word in the name_tables
         '''
+        lookup_words = []
         for word in self.name_table:
             doc_ent = self.name_table[word]
             if doc_ent.hardcode_tag is not None:
                 continue
             if (not doc_ent.is_abbr) and len(doc_ent.umls_tags) == 0:
-                umls_res = umls.umls_rules(doc_ent.text, topk=5)
-                if umls_res is None:
-                    print(f'No UMLS results found for {doc_ent.text}')
-                    self.name_table[word].umls_tags = ['Unknown']
-                else:
-                    # May add check to see how concept match the original word
-                    concept, semantic, tag = umls_res
-                    self.name_table[word].umls_tags = tag
-                    self.name_table[word].umls_concepts = concept
-                    self.name_table[word].umls_semantics = semantic
-                    self.name_table[word].umls_first_match_exact = (concept[0].lower() == doc_ent.text.lower())
-                    if self.name_table[word].umls_first_match_exact:
-                        print(f'Exact match found, {doc_ent.text}, type: {tag[0]}')
+                lookup_words.append(word)
+
+        # Resolve all words concurrently, then write the results back in the name_table order
+        umls_res_dict = umls.umls_rules_many([self.name_table[word].text for word in lookup_words], topk=5)
+        for word in lookup_words:
+            doc_ent = self.name_table[word]
+            umls_res = umls_res_dict[doc_ent.text]
+            if umls_res is None:
+                print(f'No UMLS results found for {doc_ent.text}')
+                self.name_table[word].umls_tags = ['Unknown']
+            else:
+                # May add check to see how concept match the original word
+                concept, semantic, tag = umls_res
+                self.name_table[word].umls_tags = tag
+                self.name_table[word].umls_concepts = concept
+                self.name_table[word].umls_semantics = semantic
+                self.name_table[word].umls_first_match_exact = (concept[0].lower() == doc_ent.text.lower())
+                if self.name_table[word].umls_first_match_exact:
+                    print(f'Exact match found, {doc_ent.text}, type: {tag[0]}')
 
     def set_hardcode_tag(self, word, tag):
         '''
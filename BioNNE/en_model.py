@@ -16,7 +16,8 @@ import mocker
 import config
 import db_utils
 from umls_module import UMLSModule
-from spacy_lm_module import SpacyLMModule
+from umls_local import LocalUMLSModule
+from spacy_lm_module import SpacyLMModule, parse_documents, print_timer
 from doc_ner_module import DocNER, COUNTER
 ENTITY_LIST_TO_TRY = config.ENTITY_LIST
 # ENTITY_LIST_TO_TRY = ['FINDING']
@@ -29,14 +30,17 @@ def run_model(save_prediction):
     2. test 5 dev examples
     3. calculate the accuracy, after removing duplicate and non-existent entities
     '''
-    llm_log_file = open('logs/llm_nne_history.txt', "a")
     train_path = f'processed_data/bionne/en/train.json'
     dev_path = f'processed_data/bionne/en/dev.json'
     test_path = f'processed_data/bionne/en/test.json'
     start_time = datetime.datetime.now()
-    print('Config:', config.LLM_MODEL, 'fake_llm:', config.FAKE_LLM, 'seed:', config.LLM_SEED, 'add_instruction:', config.ADD_INSTRUCTION)
-    cui_db, semantic_db, nonentity_db = db_utils.open_db()
-    umls_cls = UMLSModule(cui_db, semantic_db, nonentity_db)
+    print('Config:', config.LLM_MODEL, 'fake_llm:', config.FAKE_LLM, 'seed:', config.LLM_SEED, 'add_instruction:', config.ADD_INSTRUCTION, 'umls_backend:', config.UMLS_BACKEND)
+    cui_db, semantic_db, nonentity_db, rules_db = db_utils.open_db()
+    if config.UMLS_BACKEND == 'LOCAL':
+        # rules_db holds the UMLS REST API results, the local lookups aren't cached
+        umls_cls = LocalUMLSModule(config.UMLS_LOCAL_INDEX, cui_db, semantic_db, nonentity_db)
+    else:
+        umls_cls = UMLSModule(cui_db, semantic_db, nonentity_db, rules_db)
 
     with open(train_path, "r", encoding='utf-8') as read_file:
         train_dict = json.load(read_file)
@@ -101,13 +105,18 @@ def run_model(save_prediction):
         for category in ['tp', 'fp', 'fn']:
             accuracy_dict[tag][category] = 0.0
 
+    parsed_docs = {}
+    if config.ENABLE_SPACY_PREPASS:
+        print('Parsing all records with spacy pipelines')
+        parsed_docs = parse_documents([run_set_dict[rec]['text'] for rec in run_split])
+
     for index, rec in enumerate(run_split):
         # time.sleep(1)
         llm_ans_dict = {}
         llm_ans_dict['id'] = rec
         text = run_set_dict[rec]['text']
         text_lower = text.lower()
-        spacy_lm = SpacyLMModule(text, umls_cls)
+        spacy_lm = SpacyLMModule(text, umls_cls, parsed_docs.get(text))
         doc_ner = DocNER(text)
         print(f'\n({index}/{total}) Processing:', rec, '\n')
         # Step 1. Find acronyms and their category
@@ -146,7 +155,7 @@ def run_model(save_prediction):
                 if (rec in llm_response) and (selected_tag in llm_response[rec]):
                     response = llm_response[rec][selected_tag]
             else:
-                resp = llm.make_textsynth_request(f'/v1/engines/{config.LLM_MODEL}/completions', llm_query, llm_log_file)
+                resp = llm.make_textsynth_request(f'/v1/engines/{config.LLM_MODEL}/completions', llm_query)
                 response = resp['text']
                 llm_ans_dict[selected_tag] = response
 
@@ -263,8 +272,9 @@ def run_model(save_prediction):
         avg_f1 = np.mean(f1_np)
         print(f'Precision: {avg_pr:.4f}\nRecall: {avg_rec:.4f}\nF1: {avg_f1:.4f}')
 
+    umls_cls.close()
     # Save the db content on disk
-    db_utils.close_db([cui_db, semantic_db, nonentity_db])
+    db_utils.close_db([cui_db, semantic_db, nonentity_db, rules_db])
 
     print('\n## Output\n')
     print(f'Start time: {start_time}')
@@ -274,6 +284,10 @@ def run_model(save_prediction):
     
     print('Total record processed', total)
     print('Counter:', COUNTER)
+    print_timer()
+    umls_cls.http_client.print_stats()
+    umls_cls.print_cache_stats()
+    llm.print_llm_report()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='BioNNE model runner')
@@ -0,0 +1,105 @@
+'''
+HTTP client shared by the UMLS lookups. It keeps the connections alive in a requests.Session pool,
+retries failed requests with exponential backoff and jitter, waits for the Retry-After header when
+the server is rate limiting, and counts the latency and errors of every endpoint.
+The requests are sent at most rate_limit per second, and at most pool_size at once whatever the
+number of calling threads, so the callers never wait for a connection of the pool.
+'''
+import random
+import re
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from concurrency_utils import TokenBucket
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+def get_endpoint(url):
+    '''
+    Group urls by endpoint, the path segments that contain digits (e.g. CUI, TUI) are replaced by '*'
+    '''
+    parsed = urlparse(url)
+    segments = ['*' if re.search(r'\d', seg) else seg for seg in parsed.path.split('/')]
+    return parsed.netloc + '/'.join(segments)
+
+class HttpClient:
+    def __init__(self, max_retries=5, backoff_base=0.5, backoff_max=8.0, pool_size=10, timeout=10, rate_limit=0, rate_burst=1):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.in_flight = threading.BoundedSemaphore(pool_size)
+        self.rate_limiter = TokenBucket(rate_limit, rate_burst) # rate_limit 0 for no limit
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def get_backoff(self, attempt, rsp=None):
+        '''
+        Return the seconds to wait before the next attempt. Use the Retry-After header if the
+        server sent one, else use exponential backoff with full jitter
+        '''
+        if rsp is not None and rsp.headers.get('Retry-After'):
+            try:
+                return min(float(rsp.headers['Retry-After']), self.backoff_max)
+            except ValueError:
+                pass # Retry-After can also be a http date
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def update_stats(self, endpoint, latency, error=False, retry=False, rate_limited=False):
+        with self.lock:
+            if endpoint not in self.stats:
+                self.stats[endpoint] = {'requests': 0, 'errors': 0, 'retries': 0, 'rate_limited': 0, 'latency': 0.0}
+            stat = self.stats[endpoint]
+            stat['requests'] += 1
+            stat['latency'] += latency
+            stat['errors'] += int(error)
+            stat['retries'] += int(retry)
+            stat['rate_limited'] += int(rate_limited)
+
+    def get_json(self, url, params=None):
+        '''
+        Send a GET request and return the response once its body is valid JSON.
+        Return None if all attempts fail
+        '''
+        endpoint = get_endpoint(url)
+        for attempt in range(self.max_retries):
+            rsp = None
+            error = None
+            self.rate_limiter.acquire()
+            with self.in_flight:
+                start = time.perf_counter()
+                try:
+                    rsp = self.session.get(url, params=params, timeout=self.timeout)
+                    rsp.json()
+                except (requests.RequestException, ValueError) as e:
+                    error = e
+                latency = time.perf_counter() - start
+
+            status = rsp.status_code if rsp is not None else None
+            # Some servers send a JSON error body along with a 429/5xx status
+            failed = (error is not None) or (status in RETRY_STATUS)
+            can_retry = failed and (attempt + 1) < self.max_retries
+            self.update_stats(endpoint, latency, error=failed, retry=can_retry, rate_limited=(status == 429))
+            if not failed:
+                return rsp
+            print(f'Error HTTP request failed: {url}, {status}, {error if error is not None else rsp.text[:200]}')
+            if can_retry:
+                time.sleep(self.get_backoff(attempt, rsp))
+        print(f'Error HTTP request failed return: {url}')
+        return None
+
+    def print_stats(self):
+        '''
+        Print the request count, error count and average latency of every endpoint
+        '''
+        with self.lock:
+            for endpoint, stat in sorted(self.stats.items()):
+                avg_latency = stat['latency'] / stat['requests'] if stat['requests'] else 0.0
+                print(f"{endpoint}: requests={stat['requests']}, errors={stat['errors']}, retries={stat['retries']}, "
+                      f"rate_limited={stat['rate_limited']}, avg_latency={avg_latency:.3f}s")
@@ -0,0 +1,182 @@
+'''
+Record and replay the LLM requests.
+LLMRecorder appends every request and its response to a JSONL file, one record per line:
+    {"time": "...", "url": "https://api.textsynth.com/v1/engines/mistral_7B/completions",
+     "request": {...}, "status": 200, "response": {...}}
+LLMReplay serves the recorded responses of the matching url and request without any network access,
+so a run can be repeated offline with realistic payloads. A request without recording is answered
+with an empty completion and listed in the report.
+
+The records are written by a background thread, the request threads only put them in a queue.
+The log is rotated when it reaches max_bytes: llm_history.jsonl -> llm_history.jsonl.1 (.1.gz with
+compress) -> llm_history.jsonl.2 ... and the oldest backup is removed.
+'''
+import atexit
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import queue
+import shutil
+import threading
+
+def get_request_key(url, request):
+    key_text = json.dumps({'url': url, 'request': request}, sort_keys=True)
+    return hashlib.sha256(key_text.encode('utf-8')).hexdigest()
+
+def get_empty_response(url, request):
+    '''Response returned for the requests without recording'''
+    if url.startswith('openai:'):
+        return {'content': ''}
+    n = request.get('n', 1)
+    return {
+        'text': '' if n == 1 else [''] * n,
+        'reached_end': True,
+        'input_tokens': 0,
+        'output_tokens': 0,
+        'finish_reason': 'stop'}
+
+class LLMRecorder:
+    def __init__(self, log_path, max_bytes=0, backup_count=5, compress=False):
+        self.log_path = log_path
+        self.max_bytes = max_bytes # 0 never rotates
+        self.backup_count = backup_count
+        self.compress = compress
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        atexit.register(self.close)
+
+    def record(self, url, request, status, response):
+        log_data = {
+            'time': str(datetime.datetime.now()),
+            'url': url,
+            'request': request,
+            'status': status,
+            'response': response}
+        with self.lock:
+            if self.thread is None:
+                # Start the writer on the first record, so importing the module doesn't start threads
+                self.thread = threading.Thread(target=self.write_loop, daemon=True)
+                self.thread.start()
+        # Serialize now, the caller may reuse the request dict for the next request
+        self.queue.put(json.dumps(log_data) + '\n')
+
+    def write_loop(self):
+        log_file = open(self.log_path, 'a')
+        while True:
+            line = self.queue.get()
+            done = line is None
+            # Write all queued records before the flush
+            lines = [] if done else [line]
+            task_cnt = 1
+            while not done:
+                try:
+                    line = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                task_cnt += 1
+                if line is None:
+                    done = True
+                else:
+                    lines.append(line)
+            log_file.write(''.join(lines))
+            log_file.flush()
+            if self.max_bytes > 0 and log_file.tell() >= self.max_bytes:
+                log_file.close()
+                self.rotate()
+                log_file = open(self.log_path, 'a')
+            for _ in range(task_cnt):
+                self.queue.task_done()
+            if done:
+                log_file.close()
+                return
+
+    def get_backup_path(self, ind):
+        return f'{self.log_path}.{ind}' + ('.gz' if self.compress else '')
+
+    def rotate(self):
+        oldest = self.get_backup_path(self.backup_count)
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for ind in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(self.get_backup_path(ind)):
+                os.replace(self.get_backup_path(ind), self.get_backup_path(ind + 1))
+        if self.compress:
+            with open(self.log_path, 'rb') as src, gzip.open(self.get_backup_path(1), 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.log_path)
+        else:
+            os.replace(self.log_path, self.get_backup_path(1))
+
+    def flush(self):
+        '''Block until all queued records are written'''
+        self.queue.join()
+
+    def close(self):
+        with self.lock:
+            if self.thread is None:
+                return
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+def get_log_files(log_path):
+    '''Return the log file and its rotated backups, oldest first'''
+    backups = []
+    ind = 1
+    while True:
+        if os.path.exists(f'{log_path}.{ind}.gz'):
+            backups.append(f'{log_path}.{ind}.gz')
+        elif os.path.exists(f'{log_path}.{ind}'):
+            backups.append(f'{log_path}.{ind}')
+        else:
+            break
+        ind += 1
+    log_files = list(reversed(backups))
+    if os.path.exists(log_path):
+        log_files.append(log_path)
+    return log_files
+
+class LLMReplay:
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.recordings = {}
+        self.lock = threading.Lock()
+        self.served = {}
+        self.stats = {'hit': 0, 'miss': 0}
+        self.missing = []
+        for log_file_path in get_log_files(log_path):
+            open_fn = gzip.open if log_file_path.endswith('.gz') else open
+            with open_fn(log_file_path, 'rt') as log_file:
+                for line in log_file:
+                    rec = json.loads(line)
+                    if rec['status'] != 200:
+                        continue
+                    key = get_request_key(rec['url'], rec['request'])
+                    self.recordings.setdefault(key, []).append(rec['response'])
+        print(f'Loaded {sum(len(res) for res in self.recordings.values())} LLM recordings from {log_path}')
+
+    def get(self, url, request):
+        '''
+        Return the recorded response of the request. A request recorded several times
+        (e.g. sampled completions) gets the recordings in order
+        '''
+        key = get_request_key(url, request)
+        with self.lock:
+            if key not in self.recordings:
+                self.stats['miss'] += 1
+                self.missing.append((url, request.get('prompt', request.get('messages'))))
+                return get_empty_response(url, request)
+            self.stats['hit'] += 1
+            ind = self.served.get(key, 0)
+            self.served[key] = ind + 1
+            responses = self.recordings[key]
+            return responses[ind % len(responses)]
+
+    def print_report(self, max_prompt_len=200):
+        '''Print the hit/miss count and the prompts without recording'''
+        print(f"LLM replay ({self.log_path}): hit={self.stats['hit']}, miss={self.stats['miss']}")
+        for url, prompt in self.missing:
+            print(f'No recording: {url} {str(prompt)[:max_prompt_len]!r}')
@@ -0,0 +1,85 @@
+'''
+Build and verify the semantic type name to BioNNE tag table used by UMLSModule.lookup_cui.
+The table is rebuilt from the UMLS semantic network: every semantic type (TUI) is fetched once and its
+tree number is mapped with get_tag_from_treeid, the same rules as the live lookup.
+
+Verify the shipped table against the live semantic network and the current rules:
+    python semantic_table.py --verify
+Rebuild the table after a UMLS release or a change of semantic_type_dict:
+    python semantic_table.py --umls-release 2024AB --output simple_db/data/semantic_tag_table.json
+'''
+import argparse
+import json
+import sys
+from tokens import *
+from http_client import HttpClient
+from umls_module import UMLS_URI, get_rules_version, get_tag_from_treeid
+import config
+
+MAX_TUI = 204 # semantic type ids are T001 to T204, the numbers in between are partly unused
+
+def fetch_semantic_types(tui_list, http_client):
+    '''
+    Return a dictionary with the semantic type name as key and the {tui, tree, tag} as value
+    '''
+    semantic_types = {}
+    for tui in tui_list:
+        rsp = http_client.get_json(UMLS_URI + f'/semantic-network/current/TUI/{tui}', {'apiKey': UMLS_TOKEN})
+        if rsp is None or rsp.status_code != 200:
+            continue
+        res = rsp.json()['result']
+        semantic_types[res['name']] = {
+            'tui': tui,
+            'tree': res['treeNumber'],
+            'tag': get_tag_from_treeid(res['treeNumber'])}
+    return semantic_types
+
+def diff_tables(old_types, new_types):
+    '''
+    Return the list of differences between two semantic_types dictionaries
+    '''
+    diff_list = []
+    for name in sorted(set(old_types) | set(new_types)):
+        if name not in new_types:
+            diff_list.append(f'- {name}: {old_types[name]}')
+        elif name not in old_types:
+            diff_list.append(f'+ {name}: {new_types[name]}')
+        elif old_types[name] != new_types[name]:
+            diff_list.append(f'~ {name}: {old_types[name]} -> {new_types[name]}')
+    return diff_list
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or verify the semantic type to tag table')
+    parser.add_argument('--verify', action='store_true', help="Diff the table against the live semantic network")
+    parser.add_argument('--table', type=str, default=config.SEMANTIC_TAG_TABLE, help="Path of the table")
+    parser.add_argument('--output', type=str, default=None, help="Write the rebuilt table to this path")
+    parser.add_argument('--umls-release', type=str, default='current', help="UMLS release recorded in the rebuilt table")
+    args = parser.parse_args()
+
+    # Unused TUIs are answered with an error, don't retry them for long
+    http_client = HttpClient(max_retries=2, backoff_base=config.UMLS_BACKOFF_BASE, timeout=config.UMLS_TIMEOUT,
+        rate_limit=config.UMLS_RATE_LIMIT, rate_burst=config.UMLS_RATE_BURST)
+    tui_list = [f'T{ind:03d}' for ind in range(1, MAX_TUI + 1)]
+    new_types = fetch_semantic_types(tui_list, http_client)
+    print(f'Fetched {len(new_types)} semantic types')
+
+    if args.verify:
+        with open(args.table, 'r', encoding='utf-8') as f:
+            table = json.load(f)
+        diff_list = diff_tables(table['semantic_types'], new_types)
+        if table['rules_version'] != get_rules_version():
+            diff_list.append(f"rules_version {table['rules_version']} -> {get_rules_version()}")
+        for diff in diff_list:
+            print(diff)
+        print(f'{len(diff_list)} differences in {args.table}')
+        sys.exit(1 if diff_list else 0)
+
+    if args.output is not None:
+        table = {
+            'umls_release': args.umls_release,
+            'rules_version': get_rules_version(),
+            'semantic_types': new_types}
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(table, f, indent=4)
+            f.write('\n')
+        print(f'Saved the table to {args.output}')
@@ -1,6 +1,9 @@
 '''
-The simple_db database is a simple database that stores data in a dictionary file. It supports basic CRUD operations.
-The database is stored in a dictionary file. The dictionary file is a JSON file that stores the data in the following format:
+The simple_db database is a simple key-value database backed by a SQLite file. It supports basic CRUD operations.
+Every set and delete is committed to the database file right away, so a crash doesn't lose the data
+collected so far, and a write doesn't rewrite the whole database. Values are stored as JSON strings.
+
+The database used to be a JSON file that stores the data in the following format:
 {
     {
         "key1": "value1",
@@ -8,43 +11,109 @@ The database is stored in a dictionary file. The dictionary file is a JSON file
         ...
     }
 }
+When SimpleDB is given a JSON file, the data is kept in a .sqlite file next to it. The JSON file is
+imported when it is opened the first time and whenever its content changed since (e.g. updated by a
+git pull), its entries replace the ones of the .sqlite file. export_data writes the content back to
+the JSON file, db_utils.close_db exports the databases so the JSON files keep up with the .sqlite ones.
 '''
+import hashlib
 import json
 import os
+import sqlite3
+import threading
 
 class SimpleDB:
     def __init__(self, db_file):
+        self.json_file = None
+        if db_file.endswith('.json'):
+            self.json_file = db_file
+            db_file = db_file[:-len('.json')] + '.sqlite'
         self.db_file = db_file
-        self.data = {}
+        # The connection is shared by all threads, the lock serializes the access to it
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS data (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
         self.load_data()
 
     def load_data(self):
-        '''Load data from the database file, return False if database doesn't exist'''
-        if os.path.exists(self.db_file):
-            with open(self.db_file, 'r') as f:
-                self.data = json.load(f)
-                return True
-        else:
-            # Create a database file if it doesn't exist
-            self.save_data()
-        return False
+        '''Import the JSON database file, return False if there is no JSON file or it is unchanged since the last import'''
+        if self.json_file is None or not os.path.exists(self.json_file):
+            return False
+        with self.lock:
+            with open(self.json_file, 'rb') as f:
+                json_bytes = f.read()
+            json_hash = hashlib.sha256(json_bytes).hexdigest()
+            imported = self.conn.execute("SELECT value FROM meta WHERE key = 'json_hash'").fetchone()
+            if imported is not None and imported[0] == json_hash:
+                return False
+            json_text = json_bytes.decode('utf-8')
+            data = json.loads(json_text) if json_text.strip() else {}
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO data (key, value) VALUES (?, ?)',
+                    [(key, json.dumps(value)) for key, value in data.items()])
+                self.set_json_hash(json_hash)
+        print(f'Imported {len(data)} records from {self.json_file} to {self.db_file}')
+        return True
+
+    def set_json_hash(self, json_hash):
+        '''Record the hash of the JSON file content in sync with the database, the caller holds the lock'''
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_hash', ?)", (json_hash,))
 
     def save_data(self):
-        with open(self.db_file, 'w') as f:
-            json.dump(self.data, f)
-    
+        '''Every write is committed already, kept for the callers of the JSON database'''
+        with self.lock:
+            self.conn.commit()
+
+    def export_data(self, json_file=None):
+        '''Write the whole database to a JSON file, the imported JSON file by default'''
+        json_file = json_file or self.json_file
+        with self.lock:
+            rows = self.conn.execute('SELECT key, value FROM data').fetchall()
+            json_bytes = json.dumps({key: json.loads(value) for key, value in rows}).encode('utf-8')
+            with open(json_file, 'wb') as f:
+                f.write(json_bytes)
+            if json_file == self.json_file:
+                # The exported file has the content of the database, the next open doesn't import it
+                with self.conn:
+                    self.set_json_hash(hashlib.sha256(json_bytes).hexdigest())
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
     def get(self, key):
-        return self.data.get(key, None)
-    
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM data WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def get_many(self, keys):
+        '''Return a dictionary of the keys found in the database'''
+        keys = list(keys)
+        res = {}
+        chunk_size = 500 # stay below the SQLite limit of host parameters
+        with self.lock:
+            for start in range(0, len(keys), chunk_size):
+                chunk = keys[start:start + chunk_size]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.conn.execute(f'SELECT key, value FROM data WHERE key IN ({placeholders})', chunk).fetchall()
+                for key, value in rows:
+                    res[key] = json.loads(value)
+        return res
+
     def set(self, key, value, save=False):
-        self.data[key] = value
-        if save:
-            self.save_data()
-    
-    def delete(self, key, save=False):
-        if key in self.data:
-            del self.data[key]
-            if save:
-                self.save_data()
+        '''The value is committed right away, save is kept for the callers of the JSON database'''
+        with self.lock:
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO data (key, value) VALUES (?, ?)', (key, json.dumps(value)))
 
-    
\ No newline at end of file
+    def delete(self, key, save=False):
+        with self.lock:
+            with self.conn:
+                self.conn.execute('DELETE FROM data WHERE key = ?', (key,))
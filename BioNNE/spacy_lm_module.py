@@ -3,24 +3,132 @@ Language processing using spacy modules and pipelines
 '''
 import spacy
 import re
+import time
+import config
 from scispacy.abbreviation import AbbreviationDetector
+from spacy.language import Language
 from doc_ner_module import DocNER, DocEntity
+from doc_cache import DocCache
 import helper_utils as helper
 from spacy.matcher import Matcher
 from pprint import pprint
 
+global TIMER
+TIMER = {
+    'model_load': 0.0,
+    'inference': 0.0,
+}
+
+@Language.component('abbreviation_offsets')
+def abbreviation_offsets(doc):
+    '''
+    Replace the abbreviation spans set by abbreviation_detector with plain character offsets,
+    so the doc can be sent between processes by nlp.pipe(n_process > 1) or serialized
+    '''
+    offsets = []
+    for abrv in doc._.abbreviations:
+        long_form = abrv._.long_form
+        offsets.append([abrv.start_char, abrv.end_char, long_form.start_char, long_form.end_char])
+    span_keys = [key for key in doc.user_data if isinstance(key, tuple) and len(key) > 1 and key[1] in ('abbreviations', 'long_form')]
+    for key in span_keys:
+        del doc.user_data[key]
+    doc.user_data['abbreviation_offsets'] = offsets
+    return doc
+
+# Pipelines loaded in this process, keyed by (model name, with abbreviation detector)
+SHARED_PIPELINES = {}
+
+def load_pipeline(model_name, add_abbreviation=False):
+    '''
+    Load a spacy pipeline once per process and return the shared instance afterwards
+    '''
+    key = (model_name, add_abbreviation)
+    if key not in SHARED_PIPELINES:
+        start = time.perf_counter()
+        nlp = spacy.load(model_name)
+        if add_abbreviation:
+            nlp.add_pipe("abbreviation_detector") # TODO: does the abbreviation underlying NLP model matter?
+            nlp.add_pipe("abbreviation_offsets", after="abbreviation_detector")
+        SHARED_PIPELINES[key] = nlp
+        TIMER['model_load'] += time.perf_counter() - start
+    return SHARED_PIPELINES[key]
+
+def pipe_documents(load_nlp, texts, batch_size, n_process, doc_cache=None):
+    '''
+    Run the texts through the pipeline returned by load_nlp, skipping the texts that are already in doc_cache.
+    Return the list of docs in the same order as texts
+    '''
+    docs = [None] * len(texts)
+    if doc_cache is not None:
+        for ind, text in enumerate(texts):
+            docs[ind] = doc_cache.get(text)
+    miss_ind = [ind for ind, doc in enumerate(docs) if doc is None]
+    if len(miss_ind) > 0:
+        start = time.perf_counter()
+        miss_docs = load_nlp().pipe([texts[ind] for ind in miss_ind], batch_size=batch_size, n_process=n_process)
+        for ind, doc in zip(miss_ind, miss_docs):
+            docs[ind] = doc
+            if doc_cache is not None:
+                doc_cache.set(texts[ind], doc)
+        TIMER['inference'] += time.perf_counter() - start
+    print(f'Parsed {len(miss_ind)} of {len(texts)} texts, the others are loaded from cache')
+    return docs
+
+def parse_documents(texts, batch_size=config.SPACY_BATCH_SIZE, n_process=config.SPACY_N_PROCESS, use_cache=config.ENABLE_DOC_CACHE):
+    '''
+    Run all texts through both pipelines with nlp.pipe.
+    Return a dictionary with the text as key and (gen_doc, nlp_bc5_doc) as value
+    '''
+    unique_texts = list(dict.fromkeys(texts))
+    gen_cache, bc5_cache = None, None
+    if use_cache:
+        gen_cache = DocCache(config.DOC_CACHE_DIR, config.GEN_SPACY_MODEL)
+        bc5_cache = DocCache(config.DOC_CACHE_DIR, config.BIO_SPACY_MODEL)
+
+    # The pipelines are only loaded when some text is not in the cache
+    gen_docs = pipe_documents(lambda: load_pipeline(config.GEN_SPACY_MODEL, add_abbreviation=True),
+        unique_texts, batch_size, n_process, gen_cache)
+    bc5_docs = pipe_documents(lambda: load_pipeline(config.BIO_SPACY_MODEL),
+        unique_texts, batch_size, n_process, bc5_cache)
+
+    parsed_docs = {}
+    for text, gen_doc, bc5_doc in zip(unique_texts, gen_docs, bc5_docs):
+        parsed_docs[text] = (gen_doc, bc5_doc)
+    return parsed_docs
+
+def print_timer():
+    '''
+    Print the time spent on loading spacy models compared with running them
+    '''
+    print(f"Spacy model load time: {TIMER['model_load']:.2f}s, inference time: {TIMER['inference']:.2f}s")
+
 class SpacyLMModule:
-    def __init__(self, abstract, umls):
+    def __init__(self, abstract, umls, parsed_docs=None):
+        '''
+        parsed_docs is an optional (gen_doc, nlp_bc5_doc) pair from parse_documents
+        '''
         self.abstract = abstract
-        self.gen_nlp = spacy.load('en_core_web_trf') # general purpose NLP
-        self.gen_nlp.add_pipe("abbreviation_detector") # TODO: does the abbreviation underlying NLP model matter?
-        self.gen_doc = self.gen_nlp(abstract)
-
-        self.nlp_bc5 = spacy.load("en_ner_bc5cdr_md") # biomedical NLP
-        self.nlp_bc5_doc = self.nlp_bc5(abstract) # Entity types: DISEASE, CHEMICAL
+        if parsed_docs is not None:
+            self.gen_doc, self.nlp_bc5_doc = parsed_docs
+        else:
+            self.gen_nlp = load_pipeline(config.GEN_SPACY_MODEL, add_abbreviation=True)
+            self.nlp_bc5 = load_pipeline(config.BIO_SPACY_MODEL)
+            start = time.perf_counter()
+            self.gen_doc = self.gen_nlp(abstract)
+            self.nlp_bc5_doc = self.nlp_bc5(abstract) # Entity types: DISEASE, CHEMICAL
+            TIMER['inference'] += time.perf_counter() - start
 
         self.umls_module = umls
 
+    def get_abbreviation_pairs(self):
+        '''
+        Get the (short form, long form) text pairs found by the abbreviation detector
+        '''
+        pairs = []
+        for short_start, short_end, long_start, long_end in self.gen_doc.user_data.get('abbreviation_offsets', []):
+            pairs.append((self.gen_doc.text[short_start:short_end], self.gen_doc.text[long_start:long_end]))
+        return pairs
+
     def get_sentence(self, word, span):
         '''
         Get the sentence that contains the span
@@ -37,23 +145,23 @@ class SpacyLMModule:
         '''
         abrv_set = set()
         abrv_list = []
-        for abrv in self.gen_doc._.abbreviations:
-            if abrv.text in abrv_set:
+        for short, long in self.get_abbreviation_pairs():
+            if short in abrv_set:
                 continue
             
-            abrv_span = self.get_span(abrv.text)
+            abrv_span = self.get_span(short)
             # Get span of long form
-            longform_span = self.get_span(abrv._.long_form.text)
-            longform_sent = self.get_sentence(abrv._.long_form.text, longform_span)
+            longform_span = self.get_span(long)
+            longform_sent = self.get_sentence(long, longform_span)
 
-            abrv_entity = DocEntity(abrv.text, abrv_span, self.get_sentence(abrv.text, abrv_span))
+            abrv_entity = DocEntity(short, abrv_span, self.get_sentence(short, abrv_span))
             abrv_entity.is_abbr = True
-            abrv_entity.abrv_longform = abrv._.long_form.text
+            abrv_entity.abrv_longform = long
             abrv_list.append(abrv_entity)
-            long_entity = DocEntity(abrv._.long_form.text, longform_span, longform_sent)
-            long_entity.abrv_shortform = abrv.text
+            long_entity = DocEntity(long, longform_span, longform_sent)
+            long_entity.abrv_shortform = short
             abrv_list.append(long_entity)
-            abrv_set.add(abrv.text)
+            abrv_set.add(short)
     
         umls_abbrvs = self.umls_module.detect_acronym_entity(self.abstract, get_tag=False)
         for abrv in umls_abbrvs:
@@ -199,7 +307,7 @@ class SpacyLMModule:
             pattern = [[{'LOWER': word}], [{'LOWER': f'{word}s'}]]
         else:
             pattern = [[{'TEXT': word}]]
-        matcher = Matcher(self.gen_nlp.vocab)
+        matcher = Matcher(self.gen_doc.vocab)
         matcher.add(word, pattern)
         matches = matcher(self.gen_doc)
         res = {}
@@ -4,18 +4,55 @@ import json
 import time
 import datetime
 from tokens import * 
+from llm_cache import LLMCache, LLMCacheMiss
+from llm_replay import LLMRecorder, LLMReplay, get_empty_response
+import config
 
 URL = 'https://api.textsynth.com'
-def make_textsynth_request(path, query_param, llm_log_file=None):
+
+# Every request is recorded, the REPLAY backend serves the recorded responses instead of TextSynth
+LLM_RECORDER = LLMRecorder(config.LLM_HISTORY_PATH, config.LLM_HISTORY_MAX_BYTES,
+    config.LLM_HISTORY_BACKUP_COUNT, config.LLM_HISTORY_COMPRESS)
+LLM_REPLAY = LLMReplay(config.LLM_REPLAY_PATH) if config.LLM_BACKEND == 'REPLAY' else None
+
+LLM_CACHE = LLMCache(config.LLM_CACHE_PATH, config.LLM_CACHE_MODE, config.LLM_CACHE_TTL, config.LLM_CACHE_MAX_ENTRIES)
+
+class LLMRequestError(Exception):
+    '''A failed request, its error response is returned to the caller but not cached'''
+    def __init__(self, response_json):
+        super().__init__('TextSynth request failed')
+        self.response_json = response_json
+
+def make_textsynth_request(path, query_param):
+    '''
+    Return the response of the request through LLM_CACHE. A request missing from a READ_ONLY cache
+    isn't sent, it gets an empty completion and is listed in the cache report
+    '''
+    if LLM_REPLAY is not None:
+        # The replay answers every request itself, its empty completions must not be cached
+        return LLM_REPLAY.get(URL + path, query_param)
+    try:
+        return LLM_CACHE.cached_call(f'textsynth:{path}', query_param, lambda: post_textsynth_request(path, query_param))
+    except LLMCacheMiss:
+        return get_empty_response(URL + path, query_param)
+    except LLMRequestError as e:
+        return e.response_json
+
+def post_textsynth_request(path, query_param):
     response = requests.post(URL + path,
         headers = { "Authorization": f"Bearer {TEXTSYNTH_TOKEN}"},
         json = query_param)
-    if llm_log_file:
-        llm_log_file.write(f"\n# {datetime.datetime.now()}\n")
-        llm_log_file.write(f'{URL + path}\n')
-        json.dump(query_param, llm_log_file, indent=2)
-        llm_log_file.write('\nResponse\n')
-        json.dump(response.json(), llm_log_file, indent=2)
+    try:
+        response_json = response.json()
+    except ValueError:
+        response_json = None
+    LLM_RECORDER.record(URL + path, query_param, response.status_code, response_json)
     if response.status_code != 200:
         print("Request error:", response.text)
-    return response.json()
+        raise LLMRequestError(response_json)
+    return response_json
+
+def print_llm_report():
+    LLM_CACHE.print_stats()
+    if LLM_REPLAY is not None:
+        LLM_REPLAY.print_report()
@@ -0,0 +1,163 @@
+'''
+Offline UMLS backend. build_index compiles the UMLS Metathesaurus files MRCONSO.RRF and MRSTY.RRF
+into a compact SQLite index:
+    string -> CUIs -> semantic type -> tree number -> BioNNE tag
+LocalUMLSModule answers umls_rules from the index with the same return shape as UMLSModule, without
+any call to the UMLS REST API. Select it with UMLS_BACKEND = 'LOCAL' in config.py.
+The index stores the rules version it was built with, the tags are recomputed from the tree numbers
+when semantic_type_dict changed since. The lookups take microseconds, they are not cached in rules_db.
+
+Build the index:
+    python umls_local.py --mrconso META/MRCONSO.RRF --mrsty META/MRSTY.RRF --output simple_db/data/umls_local.sqlite
+'''
+import argparse
+import os
+import sqlite3
+import threading
+from umls_module import UMLSModule, get_rules_version, get_tag_from_treeid, normalize_entity
+
+# Column positions in the pipe delimited RRF files
+MRCONSO_CUI, MRCONSO_LAT, MRCONSO_TS, MRCONSO_STT, MRCONSO_ISPREF, MRCONSO_STR, MRCONSO_SUPPRESS = 0, 1, 2, 4, 6, 14, 16
+MRSTY_CUI, MRSTY_TUI, MRSTY_STN, MRSTY_STY = 0, 1, 2, 3
+
+def read_rrf(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            yield line.rstrip('\n').split('|')
+
+def build_index(mrconso_path, mrsty_path, index_path, languages=('ENG',)):
+    '''
+    Build the SQLite index from MRCONSO.RRF and MRSTY.RRF. Only the strings in the given languages
+    that are not suppressed are kept
+    '''
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    conn = sqlite3.connect(index_path)
+    with conn:
+        conn.execute('CREATE TABLE concepts (cui TEXT PRIMARY KEY, name TEXT, name_rank INTEGER)')
+        conn.execute('CREATE TABLE strings (norm TEXT, cui TEXT, rank INTEGER, PRIMARY KEY (norm, cui))')
+        conn.execute('CREATE VIRTUAL TABLE strings_fts USING fts5(norm, cui UNINDEXED)')
+        conn.execute('CREATE TABLE semtypes (cui TEXT, sty TEXT, tui TEXT, tree TEXT, tag TEXT, ord INTEGER)')
+        conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute("INSERT INTO meta (key, value) VALUES ('rules_version', ?)", (get_rules_version(),))
+
+        str_cnt = 0
+        for row in read_rrf(mrconso_path):
+            if row[MRCONSO_LAT] not in languages or row[MRCONSO_SUPPRESS] != 'N':
+                continue
+            cui, text = row[MRCONSO_CUI], row[MRCONSO_STR]
+            # 0 for the preferred name of the concept, 1 for the preferred string of a term, 2 otherwise
+            if row[MRCONSO_TS] == 'P' and row[MRCONSO_STT] == 'PF' and row[MRCONSO_ISPREF] == 'Y':
+                rank = 0
+            elif row[MRCONSO_ISPREF] == 'Y':
+                rank = 1
+            else:
+                rank = 2
+            conn.execute('INSERT INTO concepts (cui, name, name_rank) VALUES (?, ?, ?) '
+                'ON CONFLICT(cui) DO UPDATE SET name = excluded.name, name_rank = excluded.name_rank '
+                'WHERE excluded.name_rank < concepts.name_rank', (cui, text, rank))
+            norm = normalize_entity(text)
+            cur = conn.execute('INSERT OR IGNORE INTO strings (norm, cui, rank) VALUES (?, ?, ?)', (norm, cui, rank))
+            if cur.rowcount > 0:
+                conn.execute('INSERT INTO strings_fts (norm, cui) VALUES (?, ?)', (norm, cui))
+                str_cnt += 1
+
+        sty_cnt = 0
+        for row_ind, row in enumerate(read_rrf(mrsty_path)):
+            tree = row[MRSTY_STN]
+            conn.execute('INSERT INTO semtypes (cui, sty, tui, tree, tag, ord) VALUES (?, ?, ?, ?, ?, ?)',
+                (row[MRSTY_CUI], row[MRSTY_STY], row[MRSTY_TUI], tree, get_tag_from_treeid(tree), row_ind))
+            sty_cnt += 1
+
+        conn.execute('CREATE INDEX strings_norm ON strings (norm, rank)')
+        conn.execute('CREATE INDEX semtypes_cui ON semtypes (cui, ord)')
+    conn.execute('VACUUM')
+    conn.close()
+    print(f'Indexed {str_cnt} strings and {sty_cnt} semantic types to {index_path}')
+
+class LocalUMLSModule(UMLSModule):
+    def __init__(self, index_path, cui_db=None, semantic_db=None, nonentity_db=None):
+        super().__init__(cui_db, semantic_db, nonentity_db)
+        if not os.path.exists(index_path):
+            raise FileNotFoundError(f'UMLS index {index_path} not found, build it with umls_local.py')
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True, check_same_thread=False)
+        self.recompute_tags = self.get_index_rules_version() != get_rules_version()
+        if self.recompute_tags:
+            print(f'UMLS index {index_path} was built with older rules, recompute the tags')
+
+    def close(self):
+        super().close()
+        with self.lock:
+            self.conn.close()
+
+    def get_index_rules_version(self):
+        '''Return the rules version of the index, None for an index built before it was recorded'''
+        with self.lock:
+            try:
+                row = self.conn.execute("SELECT value FROM meta WHERE key = 'rules_version'").fetchone()
+            except sqlite3.OperationalError:
+                return None
+        return row[0] if row is not None else None
+
+    def search_cuis(self, entity, topk):
+        '''
+        Return up to topk (cui, concept name) pairs. Exact matches of the normalized entity come
+        first, then the strings that contain all words of the entity ranked by bm25
+        '''
+        norm = normalize_entity(entity)
+        with self.lock:
+            rows = self.conn.execute('SELECT s.cui, c.name FROM strings s JOIN concepts c ON s.cui = c.cui '
+                'WHERE s.norm = ? ORDER BY s.rank, s.cui LIMIT ?', (norm, topk)).fetchall()
+            if len(rows) < topk and norm:
+                words = ' '.join('"' + word.replace('"', '""') + '"' for word in norm.split())
+                rows += self.conn.execute('SELECT f.cui, c.name FROM strings_fts f JOIN concepts c ON f.cui = c.cui '
+                    'WHERE strings_fts MATCH ? ORDER BY bm25(strings_fts) LIMIT ?', (words, topk * 5)).fetchall()
+        res = []
+        seen = set()
+        for cui, name in rows:
+            if cui not in seen:
+                seen.add(cui)
+                res.append((cui, name))
+        return res[:topk]
+
+    def lookup_cui(self, cui, concept_name):
+        with self.lock:
+            row = self.conn.execute('SELECT sty, tree, tag FROM semtypes WHERE cui = ? ORDER BY ord LIMIT 1', (cui,)).fetchone()
+        if row is None:
+            return 'Unknown', 'OTHERS'
+        sty, tree, tag = row
+        return sty, get_tag_from_treeid(tree) if self.recompute_tags else tag
+
+    def umls_rules(self, entity, topk=1):
+        '''
+        Same as UMLSModule.umls_rules, answered from the local index
+        '''
+        search_res = self.search_cuis(entity, topk)
+        if len(search_res) == 0:
+            print(f'\n### entity:  {entity}\nNo results found for {entity}')
+            return None
+        concept_list = [name for _, name in search_res]
+        lookup_res = [self.lookup_cui(cui, name) for cui, name in search_res]
+        semantic_list = [semantic_name for semantic_name, _ in lookup_res]
+        tag_list = [tag_name for _, tag_name in lookup_res]
+        print(f'\n### entity:  {entity}\n'
+              f'cui_list {[cui for cui, _ in search_res]}\n'
+              f'concept_list {concept_list}\n'
+              f'semantic_list {semantic_list}\n'
+              f'tag_list {tag_list}')
+        if topk == 1:
+            return tag_list[0]
+        return [concept_list, semantic_list, tag_list]
+
+    def umls_rules_many(self, entities, topk=1):
+        # The local lookups take microseconds, a thread pool doesn't help
+        return {entity: self.umls_rules(entity, topk=topk) for entity in dict.fromkeys(entities)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the offline UMLS index')
+    parser.add_argument('--mrconso', type=str, required=True, help="Path of MRCONSO.RRF")
+    parser.add_argument('--mrsty', type=str, required=True, help="Path of MRSTY.RRF")
+    parser.add_argument('--output', type=str, default='simple_db/data/umls_local.sqlite', help="Path of the index file")
+    args = parser.parse_args()
+    build_index(args.mrconso, args.mrsty, args.output)
@@ -6,9 +6,14 @@ from pprint import pprint
 import requests
 import time
 import datetime
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from tokens import * 
 from simple_db.database import SimpleDB
+from http_client import HttpClient
 import helper_utils as utils
+import config
 
 semantic_type_dict = {
     'ANATOMY': 'A1.2',
@@ -23,107 +28,244 @@ semantic_type_dict = {
 
 UMLS_URI = 'https://uts-ws.nlm.nih.gov'
 
-def make_http_resp(url, query):
-    for i in range(5):
-        rsp = requests.get(url, params=query)
-        try:
-            rsp.json()
-        except:
-            print(f'Error HTTP request failed: {rsp.text}, {rsp.status_code}, {rsp}')
-            time.sleep(1)
-        else:
-            return rsp
-    print(f'Error HTTP request failed return: {rsp.text}')
-    return {}
+# Connection pool shared by all UMLS lookups of the process
+UMLS_CLIENT = HttpClient(
+    max_retries=config.UMLS_MAX_RETRIES,
+    backoff_base=config.UMLS_BACKOFF_BASE,
+    backoff_max=config.UMLS_BACKOFF_MAX,
+    pool_size=config.UMLS_POOL_SIZE,
+    timeout=config.UMLS_TIMEOUT,
+    rate_limit=config.UMLS_RATE_LIMIT,
+    rate_burst=config.UMLS_RATE_BURST)
+# A search worker waits for its CUI lookups, the two pools together send at most this many requests at once
+assert config.UMLS_MAX_WORKERS + config.UMLS_CUI_WORKERS <= config.UMLS_POOL_SIZE, \
+    'UMLS_MAX_WORKERS + UMLS_CUI_WORKERS must not exceed UMLS_POOL_SIZE'
+
+def get_tag_from_treeid(semantic_treeid):
+    '''
+    Map the tree number of a UMLS semantic type to the BioNNE tag
+    '''
+    tag_name = 'OTHERS'
+    for stype in semantic_type_dict.keys():
+        if semantic_treeid.startswith(semantic_type_dict[stype]):
+            tag_name = stype
+            break
+        if stype == 'ANATOMY':
+            if semantic_treeid == 'A2.1.5.2': # Body location or region
+                tag_name = stype
+                break
+        if stype == 'LABPROC':
+            if semantic_treeid == 'B1.3.1.2': # Diagnostic Procedure
+                tag_name = stype
+                break
+    return tag_name
+
+def get_rules_version():
+    '''
+    Fingerprint of the tree number rules, it changes when semantic_type_dict changes
+    '''
+    rules_text = json.dumps(semantic_type_dict, sort_keys=True)
+    return hashlib.sha256(rules_text.encode('utf-8')).hexdigest()[:12]
+
+def load_semantic_tag_table(table_file):
+    '''
+    Return a dictionary with the semantic type name as key and the tag as value, built by semantic_table.py.
+    The tags are recomputed from the tree numbers if the table was built with different rules
+    '''
+    if table_file is None or not os.path.exists(table_file):
+        print(f'Semantic tag table {table_file} not found, the tags are looked up from UMLS')
+        return {}
+    with open(table_file, 'r', encoding='utf-8') as f:
+        table = json.load(f)
+    if table['rules_version'] != get_rules_version():
+        print(f'Semantic tag table {table_file} was built with older rules, recompute the tags')
+        return {name: get_tag_from_treeid(item['tree']) for name, item in table['semantic_types'].items()}
+    return {name: item['tag'] for name, item in table['semantic_types'].items()}
+
+def normalize_entity(entity):
+    '''
+    Lower case the entity and collapse the whitespaces
+    '''
+    return ' '.join(entity.lower().split())
+
+def get_rules_key(entity, topk):
+    '''
+    Key of the umls_rules cache. The entity is normalized, so the different mentions of a
+    surface form share one entry. The rules version is part of the key, the results computed
+    with older rules are not used once semantic_type_dict changes
+    '''
+    return f'{get_rules_version()}:{topk}:{normalize_entity(entity)}'
+
+def make_http_resp(url, query, http_client=UMLS_CLIENT):
+    '''
+    Return the response with a valid JSON body, return None if the request keeps failing
+    '''
+    return http_client.get_json(url, query)
 
 class UMLSModule:
-    def __init__(self, cui_db, semantic_db, nonentity_db):
+    def __init__(self, cui_db, semantic_db, nonentity_db, rules_db=None, http_client=UMLS_CLIENT,
+                 semantic_tag_table=config.SEMANTIC_TAG_TABLE):
         self.cui_db = cui_db
         self.semantic_db = semantic_db
+        self.semantic_tag_table = load_semantic_tag_table(semantic_tag_table)
         self.nonentity_db = nonentity_db
+        self.rules_db = rules_db # umls_rules results of the entities seen in previous documents and runs
+        self.http_client = http_client
+        self.stats_lock = threading.Lock()
+        self.cache_stats = {'hit': 0, 'miss': 0}
+        # Looks up the CUIs of one search result. It is separate from the pool in umls_rules_many,
+        # so a search running in that pool never waits for a worker of its own pool
+        self.cui_executor = ThreadPoolExecutor(max_workers=config.UMLS_CUI_WORKERS)
+
+    def close(self):
+        '''Shut down the CUI lookup pool, call it once the module is no longer used'''
+        self.cui_executor.shutdown(wait=True)
+
+    def lookup_cui(self, cui, concept_name):
+        '''
+        Return the (semantic type name, tag) of the cui, the results are cached in cui_db and semantic_db.
+        Return None if the UMLS request failed
+        '''
+        # look up the type from cui_db
+        cui_lookup_res = self.cui_db.get(cui)
+        if cui_lookup_res is not None:
+            _, semantic_name, tag_name = cui_lookup_res
+            # The table follows the current rules, the stored tag may come from older rules
+            return semantic_name, self.semantic_tag_table.get(semantic_name, tag_name)
+
+        concept_endpoint = f'/content/current/CUI/{cui}'
+        query = {'apiKey': UMLS_TOKEN}
+        concpet_rsp = make_http_resp(UMLS_URI + concept_endpoint, query, self.http_client)
+        if concpet_rsp is None:
+            # Don't cache the failed lookup, so the next run retries it
+            return None
+        concept_res = concpet_rsp.json()
+        semantic_type = concept_res['result']['semanticTypes'][0]
+        semantic_name = semantic_type['name']
+        # The precomputed table covers all semantic types, semantic_db is the fallback for new ones
+        tag_name = self.semantic_tag_table.get(semantic_name)
+        if tag_name is None:
+            tag_name = self.semantic_db.get(semantic_name)
+        if tag_name is not None:
+            self.cui_db.set(cui, (concept_name, semantic_name, tag_name))
+            return semantic_name, tag_name
+
+        semantic_uri = semantic_type['uri']
+        r3 = make_http_resp(semantic_uri, query, self.http_client)
+        if r3 is None:
+            return None
+        res3 = r3.json()
+        semantic_treeid = res3['result']['treeNumber']
+        tag_name = get_tag_from_treeid(semantic_treeid)
+        self.cui_db.set(cui, (concept_name, semantic_name, tag_name))
+        self.semantic_db.set(semantic_name, tag_name)
+        return semantic_name, tag_name
 
     def umls_rules(self, entity, topk=1):
         '''
-        Given an entity and a tag, return the suggested tag based on the UMLS category
+        Given an entity and a tag, return the suggested tag based on the UMLS category.
+        The results are cached in rules_db by the normalized entity and topk
+        '''
+        rules_key = get_rules_key(entity, topk)
+        if self.rules_db is not None:
+            cached = self.rules_db.get(rules_key)
+            self.count_cache_lookup(cached is not None)
+            if cached is not None:
+                return cached['result']
+        result, complete = self.search_entity(entity, topk)
+        if self.rules_db is not None and complete:
+            self.rules_db.set(rules_key, {'result': result})
+        return result
+
+    def search_entity(self, entity, topk=1):
+        '''
+        Search the entity in UMLS and look up the tags of the results.
+        Return the umls_rules result and whether all UMLS requests succeeded
         '''
         query = {'string':entity, 'apiKey':UMLS_TOKEN, 'pageSize': topk}
         nonentity_lookup = self.nonentity_db.get(entity)
         if nonentity_lookup is None:
-            r1 = make_http_resp(UMLS_URI + '/search/current', query)
+            r1 = make_http_resp(UMLS_URI + '/search/current', query, self.http_client)
+            if r1 is None:
+                print(f'UMLS search failed for {entity}')
+                return None, False
             r1.encoding = 'utf-8'
             res1 = r1.json()['result']['results']
-            print()
-            print('### entity: ', entity)
             if len(res1) == 0:
                 self.nonentity_db.set(entity, '1')
-                print(f'No results found for {entity}')
-                return None
+                print(f'\n### entity:  {entity}\nNo results found for {entity}')
+                return None, True
         else:
-            print()
-            print('### entity: ', entity)
-            print(f'No results found for {entity}')
-            return None
+            print(f'\n### entity:  {entity}\nNo results found for {entity}')
+            return None, True
 
         cui_list = []
         concept_list = []
         for result in res1:
             concept_list.append(result['name'])
             cui_list.append(result['ui'])
-        tag_list = []
-        semantic_list = []
-        for ind, cui in enumerate(cui_list):
-            # look up the type from cui_db
-            cui_lookup_res = self.cui_db.get(cui)
-            if cui_lookup_res is not None:
-                concept_name, semantic_name, tag_name = cui_lookup_res
-                semantic_list.append(semantic_name)
-                tag_list.append(tag_name)
-            else:
-                concept_endpoint = f'/content/current/CUI/{cui}'
-                query = {'apiKey': UMLS_TOKEN}
-                concpet_rsp = make_http_resp(UMLS_URI + concept_endpoint, query)
-                concept_res = concpet_rsp.json()
-                semantic_type = concept_res['result']['semanticTypes'][0]
-                semantic_name = semantic_type['name']
-                semantic_list.append(semantic_name)
-                tag_name = self.semantic_db.get(semantic_name)
-                if tag_name is not None:
-                    tag_list.append(tag_name)
-                    self.cui_db.set(cui, (concept_list[ind], semantic_name, tag_name))
-                else:
-                    semantic_uri = semantic_type['uri']
-                    r3 = make_http_resp(semantic_uri, query)
-                    res3 = r3.json()
-                    semantic_treeid = res3['result']['treeNumber']
-                    tag_name = 'OTHERS'
-                    for stype in semantic_type_dict.keys():
-                        if semantic_treeid.startswith(semantic_type_dict[stype]):
-                            tag_name = stype
-                            break
-                        if stype == 'ANATOMY':
-                            if semantic_treeid == 'A2.1.5.2': # Body location or region
-                                tag_name = stype
-                                break
-                        if stype == 'LABPROC':
-                            if semantic_treeid == 'B1.3.1.2': # Diagnostic Procedure
-                                tag_name = stype
-                                break
-                    tag_list.append(tag_name)
-                    self.cui_db.set(cui, (concept_list[ind], semantic_name, tag_name))
-                    self.semantic_db.set(semantic_name, tag_name)
-
-            if topk == 1:
-                # Just check the most likely tag if we don't have a preference for the tag
-                break
+        if topk == 1:
+            # Just check the most likely tag if we don't have a preference for the tag
+            lookup_list = list(zip(cui_list[:1], concept_list[:1]))
+        else:
+            lookup_list = list(zip(cui_list, concept_list))
+        # The CUIs are looked up concurrently, map keeps the order of the search results
+        lookup_res = list(self.cui_executor.map(lambda item: self.lookup_cui(*item), lookup_list))
+        complete = None not in lookup_res
+        lookup_res = [item if item is not None else ('Unknown', 'OTHERS') for item in lookup_res]
+        semantic_list = [semantic_name for semantic_name, _ in lookup_res]
+        tag_list = [tag_name for _, tag_name in lookup_res]
 
-        print('cui_list', cui_list)
-        print('concept_list', concept_list)
-        print('semantic_list', semantic_list)
-        print('tag_list', tag_list)
+        # Print the result in one call, so the output of concurrent lookups doesn't interleave
+        print(f'\n### entity:  {entity}\n'
+              f'cui_list {cui_list}\n'
+              f'concept_list {concept_list}\n'
+              f'semantic_list {semantic_list}\n'
+              f'tag_list {tag_list}')
         if topk == 1:
-            return tag_list[0]
+            return tag_list[0], complete
         
-        return [concept_list, semantic_list, tag_list]
+        return [concept_list, semantic_list, tag_list], complete
+
+    def umls_rules_many(self, entities, topk=1):
+        '''
+        Run umls_rules for a list of entities with a bounded thread pool.
+        Return a dictionary with the entity as key and the umls_rules result as value
+        '''
+        unique_entities = list(dict.fromkeys(entities))
+        res = {}
+        if self.rules_db is not None:
+            rules_keys = {entity: get_rules_key(entity, topk) for entity in unique_entities}
+            cached = self.rules_db.get_many(rules_keys.values())
+            for entity in unique_entities:
+                if rules_keys[entity] in cached:
+                    res[entity] = cached[rules_keys[entity]]['result']
+                    self.count_cache_lookup(True)
+        # Entities known to have no UMLS results don't need a worker
+        remaining_entities = [entity for entity in unique_entities if entity not in res]
+        nonentity_res = self.nonentity_db.get_many(remaining_entities)
+        for entity in nonentity_res:
+            res[entity] = None
+        lookup_entities = [entity for entity in remaining_entities if entity not in nonentity_res]
+        if len(lookup_entities) == 0:
+            return res
+        with ThreadPoolExecutor(max_workers=config.UMLS_MAX_WORKERS) as executor:
+            lookup_res = executor.map(lambda entity: self.umls_rules(entity, topk=topk), lookup_entities)
+            for entity, entity_res in zip(lookup_entities, lookup_res):
+                res[entity] = entity_res
+        return res
+
+    def count_cache_lookup(self, hit):
+        with self.stats_lock:
+            self.cache_stats['hit' if hit else 'miss'] += 1
+
+    def print_cache_stats(self):
+        '''
+        Print the hit rate of the umls_rules cache
+        '''
+        total = self.cache_stats['hit'] + self.cache_stats['miss']
+        hit_rate = self.cache_stats['hit'] / total if total else 0.0
+        print(f"UMLS rules cache: hit={self.cache_stats['hit']}, miss={self.cache_stats['miss']}, hit_rate={hit_rate:.2%}")
 
     def get_bracket_entity(self, text):
         '''
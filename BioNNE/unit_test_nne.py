@@ -0,0 +1,428 @@
+''' Unit tests for BioNNE helper modules, they run offline '''
+
+import json
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http_client import HttpClient, get_endpoint
+
+class StubServer:
+    '''
+    Local HTTP server that replies the scripted (status, body, headers) responses in order,
+    the last response is repeated once the script runs out. responses can also be a function
+    of the request path that returns the response, the requests are served concurrently
+    '''
+    def __init__(self, responses):
+        self.responses = responses if callable(responses) else list(responses)
+        self.paths = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.paths.append(self.path)
+                if callable(stub.responses):
+                    status, body, headers = stub.responses(self.path)
+                elif len(stub.responses) > 1:
+                    status, body, headers = stub.responses.pop(0)
+                else:
+                    status, body, headers = stub.responses[0]
+                payload = body.encode('utf-8')
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self.do_GET()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+# Search results of the UMLS stub, (cui, concept name, semantic type name, delay of the CUI lookup)
+UMLS_STUB_ENTITIES = {
+    'fever': [('C0015967', 'Fever', 'Sign or Symptom', 0.1), ('C0424755', 'Fever symptoms', 'Finding', 0)],
+    'heart': [('C0018787', 'Heart', 'Body Part, Organ, or Organ Component', 0)],
+    'aspirin': [('C0004057', 'Aspirin', 'Pharmacologic Substance', 0.1), ('C0004058', 'Aspirin 81 MG', 'Clinical Drug', 0)],
+    'patients': [],
+}
+UMLS_STUB_CUIS = {cui: (semantic_name, delay) for results in UMLS_STUB_ENTITIES.values() for cui, _, semantic_name, delay in results}
+
+class UMLSStub:
+    '''
+    Replies the UMLS search and CUI requests of UMLS_STUB_ENTITIES. The search of an entity waits
+    search_delays[entity] seconds, so the responses of concurrent requests complete out of order
+    '''
+    def __init__(self, search_delays=None, failing_cuis=()):
+        # The lookups of failing_cuis keep failing with 503
+        self.search_delays = search_delays or {}
+        self.failing_cuis = set(failing_cuis)
+        self.completed = []
+        self.lock = threading.Lock()
+
+    def __call__(self, path):
+        url = urlparse(path)
+        if url.path == '/search/current':
+            entity = ' '.join(parse_qs(url.query)['string'][0].lower().split())
+            time.sleep(self.search_delays.get(entity, 0))
+            results = [{'ui': cui, 'name': name} for cui, name, _, _ in UMLS_STUB_ENTITIES.get(entity, [])]
+            body = json.dumps({'result': {'results': results}})
+        else:
+            cui = url.path.split('/')[-1]
+            semantic_name, delay = UMLS_STUB_CUIS[cui]
+            time.sleep(delay)
+            if cui in self.failing_cuis:
+                return 503, 'unavailable', {}
+            body = json.dumps({'result': {'semanticTypes': [{'name': semantic_name, 'uri': 'http://127.0.0.1:1/unused'}]}})
+        with self.lock:
+            self.completed.append(url.path + ('?' + url.query.split('&')[0] if url.query else ''))
+        return 200, body, {}
+
+def make_stub_umls(with_rules_db=False):
+    '''UMLSModule with empty databases that sends the requests to the stub server'''
+    import umls_module
+    from simple_db.database import SimpleDB
+    tmp_dir = tempfile.mkdtemp()
+    names = ('cui', 'semantic', 'nonentity', 'rules') if with_rules_db else ('cui', 'semantic', 'nonentity')
+    dbs = [SimpleDB(os.path.join(tmp_dir, f'{name}.sqlite')) for name in names]
+    return umls_module.UMLSModule(*dbs, http_client=HttpClient(max_retries=1))
+
+def test_http_client_retry():
+    ok_body = json.dumps({'result': {'results': []}})
+    responses = [
+        (500, 'internal error', {}),
+        (429, '{"error": "rate limit"}', {'Retry-After': '0'}),
+        (200, ok_body, {}),
+    ]
+    with StubServer(responses) as stub:
+        client = HttpClient(max_retries=5, backoff_base=0.01, backoff_max=0.05)
+        rsp = client.get_json(stub.url + '/search/current', {'string': 'fever'})
+        assert rsp is not None
+        assert rsp.json() == json.loads(ok_body)
+        assert len(stub.paths) == 3
+        stat = client.stats[get_endpoint(stub.url + '/search/current')]
+        assert stat['requests'] == 3
+        assert stat['errors'] == 2
+        assert stat['retries'] == 2
+        assert stat['rate_limited'] == 1
+
+def test_http_client_give_up():
+    with StubServer([(503, 'unavailable', {})]) as stub:
+        client = HttpClient(max_retries=3, backoff_base=0.01, backoff_max=0.05)
+        rsp = client.get_json(stub.url + '/content/current/CUI/C0015967')
+        assert rsp is None
+        assert len(stub.paths) == 3
+        stat = client.stats[get_endpoint(stub.url + '/content/current/CUI/C0015967')]
+        assert stat['errors'] == 3
+        assert stat['retries'] == 2
+
+def test_http_client_limits():
+    active = [0, 0] # requests in the handlers, maximum
+    lock = threading.Lock()
+    def _slow_response(path):
+        with lock:
+            active[0] += 1
+            active[1] = max(active[1], active[0])
+        time.sleep(0.05)
+        with lock:
+            active[0] -= 1
+        return 200, '{}', {}
+    with StubServer(_slow_response) as stub:
+        # More threads than connections, the requests in flight stay within the pool size
+        client = HttpClient(max_retries=1, pool_size=2)
+        threads = [threading.Thread(target=client.get_json, args=(stub.url + '/search/current',)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(stub.paths) == 8
+        assert active[1] == 2
+        # After the burst, the requests are sent at the rate limit
+        client = HttpClient(max_retries=1, rate_limit=20, rate_burst=1)
+        start = time.monotonic()
+        for _ in range(5):
+            assert client.get_json(stub.url + '/search/current') is not None
+        assert time.monotonic() - start >= 4 / 20
+
+def test_endpoint_grouping():
+    assert get_endpoint('https://uts-ws.nlm.nih.gov/content/current/CUI/C0015967') == 'uts-ws.nlm.nih.gov/content/current/CUI/*'
+    assert get_endpoint('https://uts-ws.nlm.nih.gov/search/current') == 'uts-ws.nlm.nih.gov/search/current'
+
+def test_local_umls_backend():
+    import umls_module
+    from umls_local import LocalUMLSModule, build_index
+    index_path = os.path.join(tempfile.mkdtemp(), 'umls_local.sqlite')
+    build_index('mocks/umls_subset/MRCONSO.RRF', 'mocks/umls_subset/MRSTY.RRF', index_path)
+    umls = LocalUMLSModule(index_path)
+    assert umls.umls_rules('Pyrexia', topk=5) == [['Fever'], ['Sign or Symptom'], ['FINDING']]
+    assert umls.umls_rules('fever') == 'FINDING'
+    # Exact match first, then the strings that contain all the words
+    assert umls.umls_rules('blood  pressure', topk=5) == [
+        ['Blood Pressure', 'Hypertensive disease'],
+        ['Organism Function', 'Disease or Syndrome'],
+        ['PHYS', 'DISO']]
+    assert umls.umls_rules('Aspirin') == 'CHEM'
+    assert umls.umls_rules('heart') == 'ANATOMY'
+    assert umls.umls_rules('patients') == 'OTHERS'
+    # Non English and suppressed strings are not indexed
+    assert umls.umls_rules('Fièvre') is None
+    assert umls.umls_rules('Obsolete concept') is None
+    res = umls.umls_rules_many(['diabetes', 'heart', 'diabetes'], topk=1)
+    assert res == {'diabetes': 'DISO', 'heart': 'ANATOMY'}
+    assert umls.get_index_rules_version() == umls_module.get_rules_version() and not umls.recompute_tags
+    # An index built with older rules gets the tags of the current rules
+    rules = umls_module.semantic_type_dict
+    umls_module.semantic_type_dict = {stype: treeid for stype, treeid in rules.items() if stype != 'FINDING'}
+    try:
+        new_rules_umls = LocalUMLSModule(index_path)
+        assert new_rules_umls.recompute_tags
+        assert new_rules_umls.umls_rules('fever') == 'OTHERS'
+        assert new_rules_umls.umls_rules('diabetes') == 'DISO'
+    finally:
+        umls_module.semantic_type_dict = rules
+
+def test_semantic_tag_table():
+    import umls_module
+    from simple_db.database import SimpleDB
+    with open('simple_db/data/semantic_tag_table.json', 'r', encoding='utf-8') as f:
+        table = json.load(f)
+    assert table['rules_version'] == umls_module.get_rules_version()
+    for item in table['semantic_types'].values():
+        assert item['tag'] == umls_module.get_tag_from_treeid(item['tree'])
+
+    # The tag comes from the table, the semantic type uri is never requested
+    concept_body = json.dumps({'result': {'semanticTypes': [
+        {'name': 'Disease or Syndrome', 'uri': 'http://127.0.0.1:1/semantic-network/current/TUI/T047'}]}})
+    tmp_dir = tempfile.mkdtemp()
+    dbs = [SimpleDB(os.path.join(tmp_dir, f'{name}.sqlite')) for name in ('cui', 'semantic', 'nonentity')]
+    with StubServer([(200, concept_body, {})]) as stub:
+        uri = umls_module.UMLS_URI
+        umls_module.UMLS_URI = stub.url
+        try:
+            umls = umls_module.UMLSModule(*dbs, http_client=HttpClient(max_retries=1))
+            assert umls.lookup_cui('C0020538', 'Hypertensive disease') == ('Disease or Syndrome', 'DISO')
+        finally:
+            umls_module.UMLS_URI = uri
+        assert len(stub.paths) == 1
+    assert dbs[0].get('C0020538') == ['Hypertensive disease', 'Disease or Syndrome', 'DISO']
+
+def test_simple_db_json_import():
+    from simple_db.database import SimpleDB
+    tmp_dir = tempfile.mkdtemp()
+    json_file = os.path.join(tmp_dir, 'cui_db.json')
+    with open(json_file, 'w') as f:
+        json.dump({'C0015967': ['Fever', 'Sign or Symptom', 'FINDING'], 'C0018787': ['Heart', 'Body Part', 'ANATOMY']}, f)
+    db = SimpleDB(json_file)
+    assert db.db_file == os.path.join(tmp_dir, 'cui_db.sqlite')
+    assert db.get('C0015967') == ['Fever', 'Sign or Symptom', 'FINDING']
+    db.delete('C0018787')
+    db.close()
+    # The hash of the imported content is recorded in the meta table, reopening doesn't import the unchanged JSON file again
+    db = SimpleDB(json_file)
+    assert db.load_data() is False
+    assert db.get('C0018787') is None
+    assert db.conn.execute("SELECT COUNT(*) FROM meta WHERE key = 'json_hash'").fetchone()[0] == 1
+    db.set('C0004057', ['Aspirin', 'Pharmacologic Substance', 'CHEM'])
+    db.close()
+    # An updated JSON file is imported again, its entries replace the stored ones
+    with open(json_file, 'w') as f:
+        json.dump({'C0015967': ['Fever', 'Sign or Symptom', 'OTHERS'], 'C0020538': ['Hypertensive disease', 'Disease or Syndrome', 'DISO']}, f)
+    db = SimpleDB(json_file)
+    assert db.get('C0015967') == ['Fever', 'Sign or Symptom', 'OTHERS']
+    assert db.get('C0020538') == ['Hypertensive disease', 'Disease or Syndrome', 'DISO']
+    assert db.get('C0004057') == ['Aspirin', 'Pharmacologic Substance', 'CHEM']
+    # close_db writes the new entries back to the JSON file, which isn't imported again
+    import db_utils
+    db_utils.close_db([db])
+    with open(json_file, 'r') as f:
+        assert set(json.load(f)) == {'C0015967', 'C0020538', 'C0004057'}
+    db = SimpleDB(json_file)
+    assert db.load_data() is False
+    db.close()
+
+    # An empty JSON file is imported as no records, a missing one isn't imported
+    empty_file = os.path.join(tmp_dir, 'empty_db.json')
+    open(empty_file, 'w').close()
+    db = SimpleDB(empty_file)
+    assert db.get_many(['C0015967']) == {}
+    assert db.conn.execute("SELECT COUNT(*) FROM meta WHERE key = 'json_hash'").fetchone()[0] == 1
+    db.close()
+    db = SimpleDB(os.path.join(tmp_dir, 'missing_db.json'))
+    assert db.get('C0015967') is None
+    assert db.conn.execute('SELECT COUNT(*) FROM meta').fetchone()[0] == 0
+    db.set('C0015967', ['Fever', 'Sign or Symptom', 'FINDING'])
+    db.close()
+    assert os.path.exists(os.path.join(tmp_dir, 'missing_db.sqlite'))
+
+def test_simple_db_persistence():
+    from simple_db.database import SimpleDB
+    db_file = os.path.join(tempfile.mkdtemp(), 'rules_db.sqlite')
+    db = SimpleDB(db_file)
+    # More keys than one get_many chunk
+    for ind in range(1200):
+        db.set(f'key{ind}', {'result': ind})
+    db.set('key0', {'result': 'updated'})
+    db.close()
+    db = SimpleDB(db_file)
+    keys = [f'key{ind}' for ind in range(1300)]
+    res = db.get_many(keys)
+    assert len(res) == 1200
+    assert res['key0'] == {'result': 'updated'}
+    assert res['key1199'] == {'result': 1199}
+    assert 'key1200' not in res
+    db.close()
+
+def test_umls_rules_many_order():
+    import umls_module
+    from doc_ner_module import DocNER, DocEntity
+    text = 'Patients (PT) with fever and heart failure took aspirin.'
+    entities = ['fever', 'heart', 'aspirin', 'patients']
+    # The first entities are answered last
+    stub_responder = UMLSStub(search_delays={'fever': 0.3, 'heart': 0.2})
+    with StubServer(stub_responder) as stub:
+        uri = umls_module.UMLS_URI
+        umls_module.UMLS_URI = stub.url
+        try:
+            doc = DocNER(text)
+            for entity in entities + ['PT']:
+                doc.add_word(DocEntity(entity, None, text))
+            doc.name_table['PT'].is_abbr = True
+            doc.populate_umls_tags(make_stub_umls())
+            completed = list(stub_responder.completed)
+            # The results of the old sequential loop
+            sequential_umls = make_stub_umls()
+            sequential_res = {entity: sequential_umls.umls_rules(entity, topk=5) for entity in entities}
+        finally:
+            umls_module.UMLS_URI = uri
+    # The concurrent searches completed out of order
+    assert completed.index('/search/current?string=aspirin') < completed.index('/search/current?string=heart') \
+        < completed.index('/search/current?string=fever')
+    assert sequential_res['fever'] == [['Fever', 'Fever symptoms'], ['Sign or Symptom', 'Finding'], ['FINDING', 'FINDING']]
+    assert sequential_res['aspirin'] == [['Aspirin', 'Aspirin 81 MG'], ['Pharmacologic Substance', 'Clinical Drug'], ['CHEM', 'OTHERS']]
+    assert sequential_res['patients'] is None
+    for entity in entities:
+        doc_ent = doc.name_table[entity]
+        if sequential_res[entity] is None:
+            assert doc_ent.umls_tags == ['Unknown']
+        else:
+            assert [doc_ent.umls_concepts, doc_ent.umls_semantics, doc_ent.umls_tags] == sequential_res[entity]
+    # The abbreviation isn't looked up
+    assert doc.name_table['PT'].umls_tags == []
+
+def test_umls_rules_cache():
+    import umls_module
+    stub_responder = UMLSStub(failing_cuis=['C0004057'])
+    with StubServer(stub_responder) as stub:
+        uri = umls_module.UMLS_URI
+        umls_module.UMLS_URI = stub.url
+        try:
+            umls = make_stub_umls(with_rules_db=True)
+            get_search_cnt = lambda: len([path for path in stub.paths if path.startswith('/search')])
+            fever_res = [['Fever', 'Fever symptoms'], ['Sign or Symptom', 'Finding'], ['FINDING', 'FINDING']]
+            assert umls.umls_rules('Fever', topk=5) == fever_res
+            # The spellings with the same normalized form share one entry
+            assert umls.umls_rules(' FEVER  ', topk=5) == fever_res
+            assert get_search_cnt() == 1
+            assert umls.rules_db.get(umls_module.get_rules_key('fever', 5)) == {'result': fever_res}
+            # topk is part of the key
+            assert umls.umls_rules('fever') == 'FINDING'
+            assert get_search_cnt() == 2
+            # A result with a failed CUI lookup isn't cached, the next call searches again
+            aspirin_res = [['Aspirin', 'Aspirin 81 MG'], ['Unknown', 'Clinical Drug'], ['OTHERS', 'OTHERS']]
+            assert umls.umls_rules('aspirin', topk=5) == aspirin_res
+            assert umls.rules_db.get(umls_module.get_rules_key('aspirin', 5)) is None
+            assert umls.umls_rules('aspirin', topk=5) == aspirin_res
+            assert get_search_cnt() == 4
+            # umls_rules_many reads the cached entries in one query
+            res = umls.umls_rules_many(['fever', 'Fever', 'heart', 'fever'], topk=5)
+            assert res['fever'] == fever_res and res['Fever'] == fever_res
+            assert res['heart'] == [['Heart'], ['Body Part, Organ, or Organ Component'], ['ANATOMY']]
+            assert get_search_cnt() == 5
+            assert umls.cache_stats == {'hit': 3, 'miss': 5}
+            # The entries are kept for the next runs
+            next_run = umls_module.UMLSModule(umls.cui_db, umls.semantic_db, umls.nonentity_db, umls.rules_db,
+                http_client=HttpClient(max_retries=1))
+            assert next_run.umls_rules('Heart', topk=5) == res['heart']
+            assert next_run.cache_stats == {'hit': 1, 'miss': 0}
+            assert get_search_cnt() == 5
+            # A run with changed rules doesn't use the results of the older rules
+            rules = umls_module.semantic_type_dict
+            umls_module.semantic_type_dict = {stype: treeid for stype, treeid in rules.items() if stype != 'FINDING'}
+            try:
+                new_rules_run = umls_module.UMLSModule(umls.cui_db, umls.semantic_db, umls.nonentity_db, umls.rules_db,
+                    http_client=HttpClient(max_retries=1))
+                assert new_rules_run.umls_rules('fever', topk=5) == [fever_res[0], fever_res[1], ['OTHERS', 'OTHERS']]
+                assert new_rules_run.cache_stats == {'hit': 0, 'miss': 1}
+                assert get_search_cnt() == 6
+            finally:
+                umls_module.semantic_type_dict = rules
+            assert next_run.umls_rules('fever', topk=5) == fever_res
+        finally:
+            umls_module.UMLS_URI = uri
+
+def test_textsynth_cache():
+    import textsynth_api
+    from llm_cache import LLMCache
+    from llm_replay import LLMRecorder
+    tmp_dir = tempfile.mkdtemp()
+    error = (429, json.dumps({'error': 'too many requests'}), {})
+    completion = (200, json.dumps({'text': 'fever', 'reached_end': True}), {})
+    with StubServer([error, completion]) as stub:
+        orig = textsynth_api.URL, textsynth_api.LLM_CACHE, textsynth_api.LLM_RECORDER
+        textsynth_api.URL = stub.url
+        textsynth_api.LLM_CACHE = LLMCache(os.path.join(tmp_dir, 'llm_cache.sqlite'), 'DETERMINISTIC')
+        textsynth_api.LLM_RECORDER = LLMRecorder(os.path.join(tmp_dir, 'llm_history.jsonl'))
+        try:
+            path = '/v1/engines/mistral_7B/completions'
+            seeded = {'prompt': 'Entities: fever', 'max_tokens': 10, 'seed': 1}
+            # The error response is returned but not cached
+            assert textsynth_api.make_textsynth_request(path, seeded) == {'error': 'too many requests'}
+            assert textsynth_api.make_textsynth_request(path, seeded) == {'text': 'fever', 'reached_end': True}
+            assert textsynth_api.make_textsynth_request(path, dict(seeded)) == {'text': 'fever', 'reached_end': True}
+            assert len(stub.paths) == 2
+            # The sampled requests are always sent
+            sampled = {'prompt': 'Entities: fever', 'max_tokens': 10}
+            textsynth_api.make_textsynth_request(path, sampled)
+            textsynth_api.make_textsynth_request(path, sampled)
+            assert len(stub.paths) == 4
+            # A request missing from a READ_ONLY cache gets an empty completion without being sent
+            textsynth_api.LLM_CACHE = LLMCache(os.path.join(tmp_dir, 'llm_cache.sqlite'), 'READ_ONLY')
+            assert textsynth_api.make_textsynth_request(path, seeded)['text'] == 'fever'
+            assert textsynth_api.make_textsynth_request(path, {**seeded, 'seed': 2})['text'] == ''
+            assert len(stub.paths) == 4
+        finally:
+            textsynth_api.LLM_RECORDER.close()
+            textsynth_api.URL, textsynth_api.LLM_CACHE, textsynth_api.LLM_RECORDER = orig
+
+def execute_all_tests():
+    test_http_client_retry()
+    test_http_client_give_up()
+    test_http_client_limits()
+    test_endpoint_grouping()
+    test_local_umls_backend()
+    test_semantic_tag_table()
+    test_simple_db_json_import()
+    test_simple_db_persistence()
+    test_umls_rules_many_order()
+    test_umls_rules_cache()
+    test_textsynth_cache()
+
+if __name__ == '__main__':
+    execute_all_tests()
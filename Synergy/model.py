@@ -3,15 +3,15 @@ import datetime
 import json
 import re
 import time
-import torch
 import search_utils
+import model_manager
 import textsynth_api as llm
 import helper_utils as helper
 from pathlib import Path
 from pprint import pprint
 from types import SimpleNamespace
-from sentence_transformers import SentenceTransformer, util
 from prompt_utils import Question, prompt_config, keyword_extact_prompt
+from embedding_store import CachedEncoder, load_cached_encoder
 
 RUN_IR = True
 RUN_QA = True
@@ -41,6 +41,15 @@ SNIP_EXTRACT_MODE = SNIP_EXTRACT_LIST[1]
 VERBOSE = False
 INFO_TRACE = True
 MAX_CONTEXT_LEN = 1000
+EMBEDDING_BACKEND_LIST = [
+    'TORCH',        # sentence_transformers, fp32
+    'ONNX_INT8'     # ONNX Runtime with int8 weights, export it first, see onnx_embedder.py
+]
+EMBEDDING_BACKEND = EMBEDDING_BACKEND_LIST[0]
+ONNX_MODEL_DIR = 'cache/onnx/all-MiniLM-L6-v2'
+ONNX_NUM_THREADS = 0 # intra-op threads of ONNX Runtime, 0 lets it choose
+ENABLE_EMBEDDING_STORE = True # keep the sentence embeddings in EMBEDDING_STORE_PATH, a text is encoded only once
+EMBEDDING_STORE_PATH = 'cache/embeddings'
 
 # -----------------------------------------------------------------------------
 # LLM Question keyword extractor methods
@@ -252,6 +261,23 @@ def ask_llm(cur_model, qbody, qtype, context, log_file=None):
 # -----------------------------------------------------------------------------
 # Snippet extraction helpers
 # -----------------------------------------------------------------------------
+def load_st_model(model_name="all-MiniLM-L6-v2"):
+    '''
+        Return the shared sentence embedder of EMBEDDING_BACKEND, behind the embedding store if
+        ENABLE_EMBEDDING_STORE. It is loaded on the first call
+    '''
+    if EMBEDDING_BACKEND == 'ONNX_INT8':
+        load_fn = lambda: model_manager.get_onnx_embedder(ONNX_MODEL_DIR, num_threads=ONNX_NUM_THREADS)
+        # The int8 vectors are not the torch ones, they are stored apart
+        store_name = f'{model_name}-onnx-int8'
+    else:
+        load_fn = lambda: model_manager.get_sentence_transformer(model_name)
+        store_name = model_name
+    if not ENABLE_EMBEDDING_STORE:
+        return load_fn()
+    return model_manager.get_model(('cached_encoder', store_name, EMBEDDING_STORE_PATH),
+        lambda: load_cached_encoder(load_fn(), store_name, EMBEDDING_STORE_PATH))
+
 def extract_snippets(article_list, qbody, st_model):
     ''' 
         Given a list of article, a question and an embeding model, return the
@@ -367,10 +393,13 @@ def run(input_filename):
     start_time = datetime.datetime.now()
     spacy_model = None
     st_model = None
+    # Load the models in parallel
+    if SNIP_EXTRACT_MODE == 'transformer':
+        model_manager.warm_up(load_st_model)
     if SEARCH_WORD_MODE == 'SPACY':
         spacy_model = search_utils.load_spacy_model()
     if SNIP_EXTRACT_MODE == 'transformer':
-        st_model = SentenceTransformer("all-MiniLM-L6-v2")
+        st_model = load_st_model()
     output_dict = {'questions': []}
     proc_rec = 0
     proc_qa = 0
@@ -429,6 +458,9 @@ def run(input_filename):
     print(f'See result in output file \"{output_path}\"')
     print(f'Start time: {start_time}')
     print(f'End time: {datetime.datetime.now()}')
+    if isinstance(st_model, CachedEncoder):
+        st_model.print_stats()
+    llm.print_llm_report()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Synergy model runner')
@@ -5,8 +5,6 @@ import json
 import search_utils
 import helper_utils as helper
 from pprint import pprint
-import torch
-from sentence_transformers import SentenceTransformer, util
 from pathlib import Path
 
 def overview_test_feedback():
@@ -150,7 +148,7 @@ def load_sentence_transformer():
         embed_snippets(st_model)
         embed_golden_doc(st_model)
     '''
-    return SentenceTransformer("all-MiniLM-L6-v2")
+    return model.load_st_model()
 
 def embed_golden_doc(st_model):
     print(f'max sequence: {st_model.max_seq_length}')
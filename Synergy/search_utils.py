@@ -1,7 +1,7 @@
 # Copy from search/search-utils.py
-import spacy
 import requests
 import xml.etree.ElementTree as ET
+import model_manager
 
 MINDATE = '2000/01/01' # TODO: find a better starting date
 MAXDATE = '2024/02/15' # TODO: update to the date that corresponds to the PubMed version required by the competition
@@ -110,7 +110,7 @@ def query_by_pmids(pmids, verbose=True):
     return res
 
 def load_spacy_model():
-    return spacy.load("en_ner_bc5cdr_md")
+    return model_manager.get_spacy_model("en_ner_bc5cdr_md")
 
 if __name__ == '__main__':
     model = load_spacy_model()
@@ -6,24 +6,44 @@ import json
 import time
 import datetime
 from tokens import * 
+from llm_cache import LLMCache, LLMCacheMiss
+from llm_replay import LLMRecorder, get_empty_response
 
 URL = 'https://api.textsynth.com'
-llm_log_file = open('logs/llm_history.txt', "a")
+# Every request and response is appended to the history log by a background thread
+LLM_RECORDER = LLMRecorder('logs/llm_history.jsonl', max_bytes=100 * 1024 * 1024, backup_count=5, compress=True)
+
+# LLM response cache, see llm_cache.py for the modes. The completions are sampled (no seed nor
+# temperature 0) so DETERMINISTIC caches nothing until the requests set one, ALL caches them anyway
+LLM_CACHE_MODE = 'DETERMINISTIC'
+LLM_CACHE_PATH = 'cache/llm_cache.sqlite'
+LLM_CACHE_TTL = 0               # seconds, 0 keeps the entries forever
+LLM_CACHE_MAX_ENTRIES = 100000  # least recently used entries are evicted, 0 for no limit
+LLM_CACHE = LLMCache(LLM_CACHE_PATH, LLM_CACHE_MODE, LLM_CACHE_TTL, LLM_CACHE_MAX_ENTRIES)
 
 def make_textsynth_request(path, query_param):
+    '''
+    Return the response of the request through LLM_CACHE. A request missing from a READ_ONLY cache
+    isn't sent, it gets an empty completion and is listed in the cache report
+    '''
+    try:
+        return LLM_CACHE.cached_call(f'textsynth:{path}', query_param, lambda: post_textsynth_request(path, query_param))
+    except LLMCacheMiss:
+        return get_empty_response(URL + path, query_param)
+
+def post_textsynth_request(path, query_param):
     response = requests.post(URL + path,
         headers = { "Authorization": f"Bearer {TEXTSYNTH_TOKEN}"},
         json = query_param)
-    if llm_log_file:
-        llm_log_file.write(f"\n# {datetime.datetime.now()}\n")
-        llm_log_file.write(f'{URL + path}\n')
-        json.dump(query_param, llm_log_file, indent=2)
-        llm_log_file.write('\nResponse\n')
-        json.dump(response.json(), llm_log_file, indent=2)
+    try:
+        response_json = response.json()
+    except ValueError:
+        response_json = None
+    LLM_RECORDER.record(URL + path, query_param, response.status_code, response_json)
     if response.status_code != 200:
         print("Request error:", response.text)
         sys.exit(1)
-    return response.json()
+    return response_json
 
 def textsynth_completion(model, query_param, task, fake_llm=True):
     if fake_llm:
@@ -53,3 +73,6 @@ def textsynth_completion(model, query_param, task, fake_llm=True):
     if 'qtype' in query_param:
         del query_param['qtype']
     return make_textsynth_request(f"/v1/engines/{model}/completions", query_param)
+
+def print_llm_report():
+    LLM_CACHE.print_stats()
@@ -0,0 +1,74 @@
+'''
+Persistent store of the PubMed articles keyed by PMID, so an article is fetched and parsed from
+PubMed only once across questions and runs. Each row keeps the article dictionary returned by
+search_utils.parse_pubmed_articles (pmid, title, abstract_raw, abstract_list) and the fetch date.
+'''
+import datetime
+import json
+import sqlite3
+import threading
+
+class ArticleStore:
+    def __init__(self, db_file):
+        self.db_file = db_file
+        # The connection is shared by the fetch threads, the lock serializes the access to it
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS articles (pmid TEXT PRIMARY KEY, title TEXT, '
+                'abstract_raw TEXT, abstract_list TEXT, fetch_date TEXT)')
+
+    def get_many(self, pmids):
+        '''Return a dictionary with the pmid as key and the article as value, for the pmids in the store'''
+        pmids = list(pmids)
+        res = {}
+        chunk_size = 500 # stay below the SQLite limit of host parameters
+        with self.lock:
+            for start in range(0, len(pmids), chunk_size):
+                chunk = pmids[start:start + chunk_size]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.conn.execute('SELECT pmid, title, abstract_raw, abstract_list FROM articles '
+                    f'WHERE pmid IN ({placeholders})', chunk).fetchall()
+                for pmid, title, abstract_raw, abstract_list in rows:
+                    res[pmid] = {
+                        'pmid': pmid,
+                        'title': title,
+                        'abstract_raw': abstract_raw,
+                        'abstract_list': json.loads(abstract_list)}
+        return res
+
+    def put_many(self, articles):
+        '''Insert or update a list of articles'''
+        fetch_date = datetime.date.today().isoformat()
+        rows = [(item['pmid'], item['title'], item['abstract_raw'], json.dumps(item['abstract_list']), fetch_date)
+                for item in articles]
+        with self.lock:
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO articles (pmid, title, abstract_raw, abstract_list, fetch_date) '
+                    'VALUES (?, ?, ?, ?, ?)', rows)
+
+    def iter_articles(self, batch_size=1000):
+        '''Yield all stored articles in pmid order, batch_size rows are read at a time'''
+        last_pmid = ''
+        while True:
+            with self.lock:
+                rows = self.conn.execute('SELECT pmid, title, abstract_raw, abstract_list FROM articles '
+                    'WHERE pmid > ? ORDER BY pmid LIMIT ?', (last_pmid, batch_size)).fetchall()
+            if len(rows) == 0:
+                return
+            for pmid, title, abstract_raw, abstract_list in rows:
+                yield {
+                    'pmid': pmid,
+                    'title': title,
+                    'abstract_raw': abstract_raw,
+                    'abstract_list': json.loads(abstract_list)}
+            last_pmid = rows[-1][0]
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM articles').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,245 @@
+'''
+Offline index of the PubMed annual baseline for Phase A retrieval.
+ingest_files streams the baseline files (pubmed24nNNNN.xml.gz) into a SQLite database: the articles
+table keeps the article fields and the publication date, and an FTS5 table indexes the title and
+abstract for BM25 ranking. BaselineIndex.get_pmids answers the same queries as search_utils.get_pmids
+without any network access or rate limit, and the results are reproducible.
+
+Build the index from the downloaded baseline files (https://ftp.ncbi.nlm.nih.gov/pubmed/baseline/):
+    python baseline_index.py --ingest baseline/pubmed24n*.xml.gz --index cache/pubmed_baseline.sqlite
+Query the index:
+    python baseline_index.py --index cache/pubmed_baseline.sqlite --query "Hirschsprung disease AND genetics"
+'''
+import argparse
+import gzip
+import json
+import re
+import sqlite3
+import threading
+import xml.etree.ElementTree as ET
+# search_utils imports this module for the BASELINE search backend, its names are read at call time
+import search_utils
+import config
+
+MONTHS = {'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+          'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12}
+QUERY_TOKEN_RE = re.compile(r'"[^"]*"|\(|\)|[^\s()"]+')
+
+def get_pub_date(article):
+    '''
+    Return the publication date of a PubmedArticle element as YYYY/MM/DD, the missing month and day
+    are set to 01. Return '' if the article has no date
+    '''
+    pub_date = article.find('MedlineCitation/Article/Journal/JournalIssue/PubDate')
+    if pub_date is None:
+        return ''
+    year = pub_date.findtext('Year')
+    month = pub_date.findtext('Month') or ''
+    day = pub_date.findtext('Day') or ''
+    if year is None:
+        # e.g. <MedlineDate>1998 Dec-1999 Jan</MedlineDate>
+        medline_date = pub_date.findtext('MedlineDate') or ''
+        match = re.match(r'(\d{4})\s*([A-Za-z]{3})?', medline_date)
+        if match is None:
+            return ''
+        year, month = match.group(1), match.group(2) or ''
+    month_num = int(month) if month.isdigit() else MONTHS.get(month[:3].lower(), 1)
+    day_num = int(day) if day.isdigit() else 1
+    return f'{year}/{month_num:02d}/{day_num:02d}'
+
+def to_fts_query(query_term, operator=None):
+    '''
+    Translate a PubMed query to a FTS5 query. Field tags (e.g. [MeSH Terms]) are dropped, the
+    words and quoted phrases are quoted, AND/OR/NOT and parentheses are kept. If operator is given,
+    the terms are joined with it and the other operators are dropped
+    '''
+    query_term = re.sub(r'\[[^\]]*\]', ' ', query_term.replace('+', ' '))
+    parts = []
+    for token in QUERY_TOKEN_RE.findall(query_term):
+        if token in ('(', ')') or token.upper() in ('AND', 'OR', 'NOT'):
+            if operator is None:
+                parts.append(token.upper())
+            continue
+        prefix = token.endswith('*')
+        word = token.strip('"').rstrip('*').strip()
+        if not any(ch.isalnum() for ch in word):
+            continue
+        parts.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+    if operator is not None:
+        return f' {operator} '.join(parts)
+    return ' '.join(parts)
+
+def iter_baseline_records(path):
+    '''
+    Yield ('article', item) for every PubmedArticle and ('delete', pmid) for every PMID of the
+    DeleteCitation element of a baseline or update file, .xml or .xml.gz
+    '''
+    open_fn = gzip.open if path.endswith('.gz') else open
+    with open_fn(path, 'rb') as source:
+        root = None
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                continue
+            if elem.tag == 'PubmedArticle':
+                item = search_utils.get_article_item(elem, verbose=False)
+                item['pub_date'] = get_pub_date(elem)
+                yield 'article', item
+                root.clear()
+            elif elem.tag == 'DeleteCitation':
+                for pmid_elem in elem.findall('PMID'):
+                    yield 'delete', pmid_elem.text
+                root.clear()
+
+def create_index(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS articles (pmid INTEGER PRIMARY KEY, title TEXT, '
+        'abstract_raw TEXT, abstract_list TEXT, pub_date TEXT)')
+    conn.execute('CREATE INDEX IF NOT EXISTS articles_pub_date ON articles (pub_date)')
+    conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS articles_fts USING fts5(title, abstract)')
+    conn.execute('CREATE TABLE IF NOT EXISTS ingested_files (path TEXT PRIMARY KEY)')
+
+def clear_index(conn):
+    '''Remove all articles and ingested files, before a full rebuild'''
+    conn.execute('DELETE FROM articles')
+    conn.execute('DELETE FROM articles_fts')
+    conn.execute('DELETE FROM ingested_files')
+
+def add_article(conn, item):
+    '''Insert or replace an article, the publication date and abstract list are optional'''
+    pmid = int(item['pmid'])
+    abstract_raw = item.get('abstract_raw', item.get('abstract', '')) or ''
+    conn.execute('INSERT OR REPLACE INTO articles (pmid, title, abstract_raw, abstract_list, pub_date) '
+        'VALUES (?, ?, ?, ?, ?)', (pmid, item['title'], abstract_raw,
+        json.dumps(item.get('abstract_list', [])), item.get('pub_date', '')))
+    conn.execute('DELETE FROM articles_fts WHERE rowid = ?', (pmid,))
+    conn.execute('INSERT INTO articles_fts (rowid, title, abstract) VALUES (?, ?, ?)',
+        (pmid, item['title'] or '', abstract_raw))
+
+def delete_article(conn, pmid):
+    conn.execute('DELETE FROM articles WHERE pmid = ?', (int(pmid),))
+    conn.execute('DELETE FROM articles_fts WHERE rowid = ?', (int(pmid),))
+
+def ingest_articles(articles, index_path, rebuild=False):
+    '''
+    Add the article dictionaries (e.g. a JSONL collection) to the index, return the number of articles.
+    An article is keyed by its pmid, ingesting it again replaces it. rebuild removes the other articles first
+    '''
+    conn = sqlite3.connect(index_path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    article_cnt = 0
+    with conn:
+        create_index(conn)
+        if rebuild:
+            clear_index(conn)
+        for item in articles:
+            add_article(conn, item)
+            article_cnt += 1
+    conn.close()
+    return article_cnt
+
+def ingest_files(paths, index_path, batch_size=10000, rebuild=False):
+    '''
+    Add the baseline files to the index in the given order, so the update files override the older
+    versions of an article. A file ingested before is skipped, rebuild removes the indexed articles first
+    '''
+    conn = sqlite3.connect(index_path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    with conn:
+        create_index(conn)
+        if rebuild:
+            clear_index(conn)
+    for path in paths:
+        if conn.execute('SELECT 1 FROM ingested_files WHERE path = ?', (path,)).fetchone() is not None:
+            print(f'Skip {path}, it was ingested before')
+            continue
+        article_cnt = 0
+        delete_cnt = 0
+        with conn:
+            for record_type, record in iter_baseline_records(path):
+                if record_type == 'delete':
+                    delete_article(conn, record)
+                    delete_cnt += 1
+                    continue
+                if not record['pmid']:
+                    continue
+                add_article(conn, record)
+                article_cnt += 1
+                if article_cnt % batch_size == 0:
+                    conn.commit()
+            conn.execute('INSERT INTO ingested_files (path) VALUES (?)', (path,))
+        print(f'Ingested {article_cnt} articles and {delete_cnt} deletions from {path}')
+    conn.close()
+
+class BaselineIndex:
+    def __init__(self, index_path):
+        self.index_path = index_path
+        # The connection is shared by the search threads, the lock serializes the access to it
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True, check_same_thread=False)
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM articles').fetchone()[0]
+
+    def search(self, fts_query, max_length, mindate, maxdate):
+        with self.lock:
+            rows = self.conn.execute('SELECT a.pmid FROM articles_fts f JOIN articles a ON a.pmid = f.rowid '
+                'WHERE articles_fts MATCH ? AND a.pub_date >= ? AND a.pub_date <= ? '
+                'ORDER BY bm25(articles_fts, 2.0, 1.0) LIMIT ?', (fts_query, mindate, maxdate, max_length)).fetchall()
+        return [str(row[0]) for row in rows]
+
+    def get_pmids(self, query_term, max_length=config.PUBMED_MAX_LENGTH, verbose=True, mindate=None, maxdate=None):
+        '''
+        Same as search_utils.get_pmids, return the pmids of the best BM25 matches published between
+        mindate and maxdate. If the query can't be parsed as a boolean query, any of its terms match
+        '''
+        mindate = mindate or search_utils.MINDATE
+        maxdate = maxdate or search_utils.MAXDATE
+        fts_query = to_fts_query(query_term)
+        if config.INFO_TRACE:
+            print('Query term: ', query_term)
+        if verbose:
+            print('Querying the baseline index', fts_query)
+        try:
+            pmids = self.search(fts_query, max_length, mindate, maxdate) if fts_query else []
+        except sqlite3.OperationalError as e:
+            print(f'Baseline query error: {e}, search any of the terms')
+            fts_query = to_fts_query(query_term, operator='OR')
+            pmids = self.search(fts_query, max_length, mindate, maxdate) if fts_query else []
+        if verbose:
+            for pmid in pmids:
+                print("PMID:", pmid)
+        return pmids
+
+    def get_articles(self, pmids):
+        '''Return a dictionary with the pmid as key and the article as value, for the pmids in the index'''
+        pmids = [int(pmid) for pmid in pmids if str(pmid).isdigit()]
+        res = {}
+        chunk_size = 500 # stay below the SQLite limit of host parameters
+        with self.lock:
+            for start in range(0, len(pmids), chunk_size):
+                chunk = pmids[start:start + chunk_size]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.conn.execute('SELECT pmid, title, abstract_raw, abstract_list FROM articles '
+                    f'WHERE pmid IN ({placeholders})', chunk).fetchall()
+                for pmid, title, abstract_raw, abstract_list in rows:
+                    res[str(pmid)] = {
+                        'pmid': str(pmid),
+                        'title': title,
+                        'abstract_raw': abstract_raw,
+                        'abstract_list': json.loads(abstract_list)}
+        return res
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PubMed baseline index')
+    parser.add_argument('--ingest', type=str, nargs='*', default=[], help="Baseline files to add to the index, in order")
+    parser.add_argument('--index', type=str, default=config.BASELINE_INDEX_PATH, help="Path of the index file")
+    parser.add_argument('--rebuild', action='store_true', help="Remove the indexed articles before the ingestion")
+    parser.add_argument('--query', type=str, default=None, help="Query the index")
+    args = parser.parse_args()
+    if args.ingest:
+        ingest_files(args.ingest, args.index, rebuild=args.rebuild)
+    if args.query:
+        index = BaselineIndex(args.index)
+        print(index.get_pmids(args.query, verbose=False))
@@ -6,7 +6,8 @@ SEARCH_WORD_LIST =[
     'SPACY',            # 0
     'LLM',              # 1
     'MIXTRAL_47B',      # 2
-    'OPENAI'            # 3
+    'OPENAI',           # 3
+    'HYBRID'            # 4 BM25 and dense search of the question in a local collection, no LLM query, see hybrid_search.py
 ]
 SEARCH_WORD_MODE = 'MIXTRAL_47B'
 
@@ -26,6 +27,27 @@ SNIP_EXTRACT_LIST = [
     'TRANSFORMER'
 ]
 SNIP_EXTRACT_MODE = SNIP_EXTRACT_LIST[1]
+ST_BATCH_SIZE = 64 # sentences encoded per sentence transformer call in the snippet extraction
+SNIP_RERANK_MODE_LIST = [
+    'OFF',              # 0 best bi-encoder sentence of each article
+    'CROSS_ENCODER'     # 1 rerank the best sentences of all articles with CROSS_ENCODER_MODEL, see snippet_rerank.py
+]
+SNIP_RERANK_MODE = SNIP_RERANK_MODE_LIST[0]
+CROSS_ENCODER_MODEL = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+RERANK_CANDIDATES = 50      # best bi-encoder sentences of the question scored by the cross encoder
+RERANK_BATCH_SIZE = 16
+RERANK_LATENCY_BUDGET = 2.0 # seconds per question, the candidates left keep the bi-encoder order. 0 for no limit
+RERANK_MAX_SNIPPETS = 30    # snippets returned for a question
+RERANK_MAX_PER_ARTICLE = 2
+EMBEDDING_BACKEND_LIST = [
+    'TORCH',        # 0 sentence_transformers, fp32
+    'ONNX_INT8'     # 1 ONNX Runtime with int8 weights, export it first, see onnx_embedder.py
+]
+EMBEDDING_BACKEND = EMBEDDING_BACKEND_LIST[0]
+ONNX_MODEL_DIR = 'cache/onnx/all-MiniLM-L6-v2'
+ONNX_NUM_THREADS = 0 # 0 lets ONNX Runtime choose
+ENABLE_EMBEDDING_STORE = True # keep the sentence embeddings in EMBEDDING_STORE_PATH, a text is encoded only once
+EMBEDDING_STORE_PATH = 'cache/embeddings'
 
 # Logging
 VERBOSE = False
@@ -33,8 +55,63 @@ INFO_TRACE = True
 
 # Pubmed
 PUBMED_MAX_LENGTH = 30
+EFETCH_CHUNK_SIZE = 200 # pmids per EFetch request
+ENABLE_ARTICLE_STORE = True # keep the fetched articles in ARTICLE_STORE_PATH, they are not fetched again
+ARTICLE_STORE_PATH = 'cache/articles.sqlite'
+NCBI_MAX_WORKERS = 3    # concurrent E-utilities requests, the rate is 3/s or 10/s with NCBI_API_KEY in the environment
+PUBMED_SEARCH_BACKEND_LIST = [
+    'EUTILS',   # 0 search PubMed with ESearch and fetch the articles with EFetch
+    'BASELINE'  # 1 search the local index of the PubMed baseline, see baseline_index.py
+]
+PUBMED_SEARCH_BACKEND = PUBMED_SEARCH_BACKEND_LIST[0]
+BASELINE_INDEX_PATH = 'cache/pubmed_baseline.sqlite'
+RETRIEVAL_MODE_LIST = [
+    'KEYWORD',  # 0 pmids of the keyword query
+    'DENSE',    # 1 pmids of the dense index by question embedding, see dense_index.py
+    'FALLBACK'  # 2 keyword query, the dense index when the keyword query finds nothing
+]
+RETRIEVAL_MODE = RETRIEVAL_MODE_LIST[0]
+DENSE_INDEX_PATH = 'cache/dense_index'
+DENSE_MODEL_NAME = 'all-MiniLM-L6-v2' # must be the model that built the index
+DENSE_TOP_K = 30
+# HYBRID search word mode
+HYBRID_COLLECTION_PATH = 'cache/articles.jsonl'
+HYBRID_LEXICAL_INDEX_PATH = 'cache/hybrid_bm25.sqlite'
+HYBRID_DENSE_INDEX_PATH = 'cache/dense_index'
+HYBRID_CANDIDATES = 100 # pmids of each ranking fused
+HYBRID_RRF_K = 60
 
 # QA
 QA_PROXY_CACHE_PATH = 'qa_proxy.json'
 ENABLE_SYNONYM_GROUPING = False
-LIST_SINGLE_PROMPT = True
\ No newline at end of file
+LIST_SINGLE_PROMPT = True
+# LLM request concurrency
+LLM_MAX_IN_FLIGHT = 4   # TextSynth requests sent at once
+LLM_RATE_LIMIT = 2.0    # TextSynth requests per second, 0 disables the limit
+LLM_RATE_BURST = 4      # requests allowed in a burst above the rate
+QA_MAX_WORKERS = 4      # context groups answered at once in stage B, forced to 1 with FAKE_LLM
+QA_QUESTION_WINDOW = 8  # questions fanned out at once in stage B
+
+# LLM response cache, see llm_cache.py for the modes
+LLM_CACHE_MODE_LIST = [
+    'OFF',              # 0
+    'DETERMINISTIC',    # 1 cache the requests with temperature 0 or a seed
+    'ALL',              # 2
+    'READ_ONLY'         # 3 replay the cached responses only, the requests not cached get an empty completion
+]
+LLM_CACHE_MODE = LLM_CACHE_MODE_LIST[1]
+LLM_CACHE_PATH = 'cache/llm_cache.sqlite'
+LLM_CACHE_TTL = 0               # seconds, 0 keeps the entries forever
+LLM_CACHE_MAX_ENTRIES = 100000  # least recently used entries are evicted, 0 for no limit
+
+# LLM backend
+LLM_BACKEND_LIST = [
+    'TEXTSYNTH',    # 0 send the requests to TextSynth and OpenAI
+    'REPLAY'        # 1 answer the requests from the recordings in LLM_REPLAY_PATH, without network access
+]
+LLM_BACKEND = LLM_BACKEND_LIST[0]
+LLM_HISTORY_PATH = 'logs/llm_history.jsonl' # every request and response is appended here
+LLM_REPLAY_PATH = 'logs/llm_history.jsonl'
+LLM_HISTORY_MAX_BYTES = 100 * 1024 * 1024 # rotate the history log at this size, 0 never rotates
+LLM_HISTORY_BACKUP_COUNT = 5
+LLM_HISTORY_COMPRESS = True # gzip the rotated history logs
@@ -0,0 +1,130 @@
+'''
+Dense vector index of a local abstract collection for the first stage retrieval of Phase A.
+build_index embeds the articles of a JSONL collection (one {"pmid", "title", "abstract_raw"} object per
+line, "abstract" is accepted too) with the sentence transformer model and writes the normalized
+embeddings to a float16 matrix on disk. DenseIndex memory maps the matrix and returns the exact top-k
+articles by cosine similarity, the matrix is scanned in blocks so it doesn't have to fit in memory.
+
+Index layout (index_dir):
+    embeddings.npy  float16 matrix of count x dim
+    pmids.txt       pmid of each row
+    meta.json       {"model": ..., "dim": ..., "count": ...}
+
+Export the articles fetched so far and build the index:
+    python dense_index.py --export-store cache/articles.sqlite --collection cache/articles.jsonl
+    python dense_index.py --collection cache/articles.jsonl --build --index cache/dense_index
+'''
+import argparse
+import json
+import os
+import numpy as np
+from article_store import ArticleStore
+import model_manager
+import config
+
+def iter_collection(collection_path):
+    '''Yield the articles of a JSONL collection'''
+    with open(collection_path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def get_article_text(article):
+    '''Text embedded for an article, the title followed by the abstract'''
+    abstract = article.get('abstract_raw', article.get('abstract', '')) or ''
+    return ((article.get('title') or '') + ' ' + abstract).strip()
+
+def export_article_store(store_path, collection_path):
+    '''Write the articles of an ArticleStore to a JSONL collection, return the number of articles'''
+    store = ArticleStore(store_path)
+    cnt = 0
+    with open(collection_path, 'w') as f:
+        for article in store.iter_articles():
+            f.write(json.dumps({'pmid': article['pmid'], 'title': article['title'],
+                'abstract_raw': article['abstract_raw']}) + '\n')
+            cnt += 1
+    store.close()
+    return cnt
+
+def build_index(collection_path, index_dir, st_model, model_name=config.DENSE_MODEL_NAME, batch_size=256):
+    '''Embed the collection in batches and write the index to index_dir, return the number of articles'''
+    os.makedirs(index_dir, exist_ok=True)
+    count = sum(1 for _ in iter_collection(collection_path))
+    dim = st_model.get_sentence_embedding_dimension()
+    embeddings = np.lib.format.open_memmap(os.path.join(index_dir, 'embeddings.npy'), mode='w+',
+        dtype=np.float16, shape=(count, dim))
+    row = 0
+    batch = []
+    with open(os.path.join(index_dir, 'pmids.txt'), 'w') as pmid_file:
+        def _write_batch():
+            batch_embeddings = st_model.encode([get_article_text(article) for article in batch],
+                batch_size=batch_size, normalize_embeddings=True)
+            embeddings[row:row + len(batch)] = np.asarray(batch_embeddings, dtype=np.float16)
+            pmid_file.write(''.join(f"{article['pmid']}\n" for article in batch))
+        for article in iter_collection(collection_path):
+            batch.append(article)
+            if len(batch) == batch_size:
+                _write_batch()
+                row += len(batch)
+                batch = []
+                if config.INFO_TRACE:
+                    print(f'Embedded {row}/{count} articles')
+        if len(batch) > 0:
+            _write_batch()
+            row += len(batch)
+    embeddings.flush()
+    del embeddings
+    with open(os.path.join(index_dir, 'meta.json'), 'w') as f:
+        json.dump({'model': model_name, 'dim': dim, 'count': row}, f)
+    return row
+
+class DenseIndex:
+    def __init__(self, index_dir, block_size=65536):
+        self.index_dir = index_dir
+        self.block_size = block_size # rows scored at a time
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(index_dir, 'pmids.txt'), 'r') as f:
+            self.pmids = [line.strip() for line in f]
+        self.embeddings = np.load(os.path.join(index_dir, 'embeddings.npy'), mmap_mode='r')
+        assert len(self.pmids) == self.embeddings.shape[0], f'Corrupted dense index {index_dir}'
+
+    def search(self, query_embedding, top_k=config.DENSE_TOP_K):
+        '''Return the [(pmid, score)] of the top_k articles by cosine similarity, best first'''
+        query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        query = query / max(np.linalg.norm(query), 1e-12)
+        best_scores = np.empty(0, dtype=np.float32)
+        best_rows = np.empty(0, dtype=np.int64)
+        for start in range(0, len(self.pmids), self.block_size):
+            block = np.asarray(self.embeddings[start:start + self.block_size], dtype=np.float32)
+            scores = np.concatenate([best_scores, block @ query])
+            rows = np.concatenate([best_rows, np.arange(start, start + len(block))])
+            if len(scores) > top_k:
+                keep = np.argpartition(-scores, top_k - 1)[:top_k]
+                scores, rows = scores[keep], rows[keep]
+            best_scores, best_rows = scores, rows
+        # Ties are ordered by row, so the ranking is reproducible
+        order = np.lexsort((best_rows, -best_scores))
+        return [(self.pmids[best_rows[i]], float(best_scores[i])) for i in order]
+
+    def get_pmids(self, st_model, text, top_k=config.DENSE_TOP_K):
+        '''Return the pmids of the top_k articles for the text'''
+        query_embedding = st_model.encode(text, normalize_embeddings=True)
+        return [pmid for pmid, _ in self.search(query_embedding, top_k)]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Dense index of a local abstract collection')
+    parser.add_argument('--export-store', type=str, default=None, help="Export this article store to the collection")
+    parser.add_argument('--collection', type=str, default=None, help="JSONL collection of the articles")
+    parser.add_argument('--build', action='store_true', help="Build the index from the collection")
+    parser.add_argument('--index', type=str, default=config.DENSE_INDEX_PATH, help="Index directory")
+    parser.add_argument('--query', type=str, default=None, help="Query the index")
+    args = parser.parse_args()
+    if args.export_store:
+        print(f'Exported {export_article_store(args.export_store, args.collection)} articles to {args.collection}')
+    if args.build or args.query:
+        st_model = model_manager.get_sentence_transformer(config.DENSE_MODEL_NAME)
+        if args.build:
+            print(f'Indexed {build_index(args.collection, args.index, st_model)} articles in {args.index}')
+        if args.query:
+            print(DenseIndex(args.index).search(st_model.encode(args.query, normalize_embeddings=True)))
@@ -0,0 +1,128 @@
+'''
+Persistent store of the sentence embeddings, so a text is encoded by the transformer only once
+across questions and runs. The vectors of a model are appended to a float16 file that is read
+through a memory map, the index file lists the sha256 of the text of each row:
+    cache/embeddings/all-MiniLM-L6-v2.f16   rows of dim float16 values, as returned by the model
+    cache/embeddings/all-MiniLM-L6-v2.idx   one text hash per line, in row order
+CachedEncoder wraps a SentenceTransformer and answers encode() from the store, only the texts
+without vector are sent to the model. The vectors are normalized after the lookup if requested.
+'''
+import hashlib
+import os
+import re
+import threading
+import numpy as np
+
+def get_text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class EmbeddingStore:
+    def __init__(self, store_dir, model_name, dim):
+        os.makedirs(store_dir, exist_ok=True)
+        file_name = re.sub(r'[^A-Za-z0-9_.-]', '_', model_name)
+        self.vector_path = os.path.join(store_dir, f'{file_name}.f16')
+        self.index_path = os.path.join(store_dir, f'{file_name}.idx')
+        self.dim = dim
+        self.lock = threading.Lock()
+        hashes = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                hashes = [line.strip() for line in f]
+        vector_rows = os.path.getsize(self.vector_path) // (2 * dim) if os.path.exists(self.vector_path) else 0
+        # A run stopped between the two appends leaves rows without hash or hashes without row
+        row_cnt = min(len(hashes), vector_rows)
+        if row_cnt < vector_rows:
+            with open(self.vector_path, 'r+b') as f:
+                f.truncate(row_cnt * 2 * dim)
+        if row_cnt < len(hashes):
+            with open(self.index_path, 'w') as f:
+                f.write(''.join(f'{text_hash}\n' for text_hash in hashes[:row_cnt]))
+        self.rows = {text_hash: row for row, text_hash in enumerate(hashes[:row_cnt])}
+        self.row_cnt = row_cnt
+        self.vectors = None # memory map of the first mapped_cnt rows
+        self.mapped_cnt = 0
+
+    def __len__(self):
+        return self.row_cnt
+
+    def get_vectors(self, rows):
+        if self.mapped_cnt < self.row_cnt:
+            self.vectors = np.memmap(self.vector_path, dtype=np.float16, mode='r', shape=(self.row_cnt, self.dim))
+            self.mapped_cnt = self.row_cnt
+        return np.asarray(self.vectors[rows], dtype=np.float32)
+
+    def get_many(self, texts):
+        '''Return the float32 matrix of the stored vectors and the list of the texts not in the store'''
+        with self.lock:
+            rows = [self.rows.get(get_text_hash(text)) for text in texts]
+            found = [row for row in rows if row is not None]
+            vectors = self.get_vectors(found) if found else np.zeros((0, self.dim), dtype=np.float32)
+        res = np.zeros((len(texts), self.dim), dtype=np.float32)
+        res[[ind for ind, row in enumerate(rows) if row is not None]] = vectors
+        missing = [text for text, row in zip(texts, rows) if row is None]
+        return res, missing
+
+    def put_many(self, texts, vectors):
+        '''Append the vectors of the texts, the texts already stored are skipped'''
+        vectors = np.asarray(vectors, dtype=np.float16).reshape(-1, self.dim)
+        with self.lock:
+            new_rows = []
+            new_hashes = []
+            for text, vector in zip(texts, vectors):
+                text_hash = get_text_hash(text)
+                if text_hash in self.rows:
+                    continue
+                self.rows[text_hash] = self.row_cnt + len(new_rows)
+                new_rows.append(vector)
+                new_hashes.append(text_hash)
+            if len(new_rows) == 0:
+                return
+            with open(self.vector_path, 'ab') as f:
+                f.write(np.stack(new_rows).tobytes())
+            with open(self.index_path, 'a') as f:
+                f.write(''.join(f'{text_hash}\n' for text_hash in new_hashes))
+            self.row_cnt += len(new_rows)
+
+class CachedEncoder:
+    def __init__(self, st_model, store):
+        self.st_model = st_model
+        self.store = store
+        self.stats = {'hit': 0, 'miss': 0}
+
+    def __getattr__(self, name):
+        # max_seq_length, get_sentence_embedding_dimension, ... of the wrapped model
+        return getattr(self.st_model, name)
+
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, convert_to_tensor=False, **kwargs):
+        '''Same as SentenceTransformer.encode, the stored vectors are not encoded again'''
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        vectors, missing = self.store.get_many(texts)
+        self.stats['hit'] += len(texts) - len(missing)
+        self.stats['miss'] += len(missing)
+        if len(missing) > 0:
+            unique_missing = list(dict.fromkeys(missing))
+            new_vectors = self.st_model.encode(unique_missing, batch_size=batch_size, **kwargs)
+            self.store.put_many(unique_missing, new_vectors)
+            # Return the stored float16 values, so a text gets the same vector from the model and the store
+            new_vectors = dict(zip(unique_missing, np.asarray(new_vectors, dtype=np.float16).astype(np.float32)))
+            for ind, text in enumerate(texts):
+                if text in new_vectors:
+                    vectors[ind] = new_vectors[text]
+        if normalize_embeddings:
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        res = vectors[0] if single else vectors
+        if convert_to_tensor:
+            import torch
+            res = torch.from_numpy(res)
+        return res
+
+    def print_stats(self):
+        total = self.stats['hit'] + self.stats['miss']
+        hit_rate = self.stats['hit'] / total if total else 0.0
+        print(f"Embedding store: hit={self.stats['hit']}, miss={self.stats['miss']}, hit_rate={hit_rate:.2%}, size={len(self.store)}")
+
+def load_cached_encoder(st_model, model_name, store_dir):
+    '''Wrap the sentence transformer with the embedding store of store_dir'''
+    store = EmbeddingStore(store_dir, model_name, st_model.get_sentence_embedding_dimension())
+    return CachedEncoder(st_model, store)
@@ -4,12 +4,9 @@ import datetime
 import json
 import re
 import time
-import torch
-import search_utils
 from pathlib import Path
 from pprint import pprint
 from types import SimpleNamespace
-from sentence_transformers import util
 from prompt_utils import Question, prompt_config, keyword_extact_prompt
 
 def parse_input(file_path, verbose=False):
@@ -103,6 +100,9 @@ def get_top_results(st_model, query, sentences, topk=None, verbose=False):
         the embedding space.
         Return the rank of sentences according to the embedding similarity. 
     '''
+    # torch and sentence_transformers are imported on use, the metric scripts don't need them
+    import torch
+    from sentence_transformers import util
     assert(len(sentences) > 0)
     if (not topk) or (topk > len(sentences)):
         topk = len(sentences)
@@ -0,0 +1,77 @@
+'''
+Hybrid first stage retrieval over a local abstract collection, the HYBRID search word mode.
+The question is searched as is, without LLM query expansion, in a BM25 index (SQLite FTS5, see
+baseline_index.py) and in a dense index (see dense_index.py) of the same JSONL collection. The two
+rankings are fused with reciprocal rank fusion: score(pmid) = sum over rankings of 1 / (k + rank).
+
+Build both indexes from a collection (e.g. exported with dense_index.py --export-store):
+    python hybrid_search.py --collection cache/articles.jsonl --build
+'''
+import argparse
+import baseline_index
+import dense_index
+from baseline_index import BaselineIndex
+from dense_index import DenseIndex
+import model_manager
+import config
+
+def reciprocal_rank_fusion(ranked_lists, k=config.HYBRID_RRF_K, top_k=None):
+    '''Fuse lists of pmids ranked best first, ties keep the order of first appearance'''
+    scores = {}
+    for ranked_list in ranked_lists:
+        for rank, pmid in enumerate(ranked_list, start=1):
+            scores[pmid] = scores.get(pmid, 0.0) + 1.0 / (k + rank)
+    # sorted is stable, the dict keeps the order of first appearance
+    fused = sorted(scores, key=lambda pmid: -scores[pmid])
+    return fused if top_k is None else fused[:top_k]
+
+def build_indexes(collection_path, lexical_index_path, dense_index_dir, st_model, model_name=config.DENSE_MODEL_NAME):
+    '''Build the BM25 and dense indexes of the collection from scratch, so both hold the same articles'''
+    article_cnt = baseline_index.ingest_articles(dense_index.iter_collection(collection_path), lexical_index_path, rebuild=True)
+    print(f'Indexed {article_cnt} articles in {lexical_index_path}')
+    article_cnt = dense_index.build_index(collection_path, dense_index_dir, st_model, model_name)
+    print(f'Indexed {article_cnt} articles in {dense_index_dir}')
+    lexical_cnt = BaselineIndex(lexical_index_path).count()
+    if lexical_cnt != article_cnt:
+        # A pmid repeated in the collection is one article of the BM25 index and several rows of the dense one
+        print(f'Warning: the BM25 index has {lexical_cnt} articles and the dense index {article_cnt}, check the collection for duplicate pmids')
+
+class HybridRetriever:
+    def __init__(self, lexical_index_path, dense_index_dir):
+        self.lexical_index = BaselineIndex(lexical_index_path)
+        self.dense_index = DenseIndex(dense_index_dir)
+
+    def get_lexical_pmids(self, question, max_length):
+        # Any term of the question may match, BM25 ranks the articles matching the rare terms first
+        fts_query = baseline_index.to_fts_query(question, operator='OR')
+        if not fts_query:
+            return []
+        # The collection has no publication dates, it is not filtered by date
+        return self.lexical_index.search(fts_query, max_length, '', '9999/99/99')
+
+    def get_pmids(self, st_model, question, top_k=config.PUBMED_MAX_LENGTH, candidates=config.HYBRID_CANDIDATES):
+        '''Return the top_k pmids of the fused BM25 and dense rankings of the question'''
+        lexical_pmids = self.get_lexical_pmids(question, candidates)
+        dense_pmids = self.dense_index.get_pmids(st_model, question, candidates)
+        pmids = reciprocal_rank_fusion([lexical_pmids, dense_pmids], config.HYBRID_RRF_K, top_k)
+        if config.INFO_TRACE:
+            print(f'Hybrid search: {len(lexical_pmids)} BM25 and {len(dense_pmids)} dense candidates, {len(pmids)} fused')
+        return pmids
+
+def load_hybrid_retriever():
+    retriever = HybridRetriever(config.HYBRID_LEXICAL_INDEX_PATH, config.HYBRID_DENSE_INDEX_PATH)
+    assert retriever.dense_index.meta['model'] == config.DENSE_MODEL_NAME, \
+        f"The dense index was built with {retriever.dense_index.meta['model']}, not {config.DENSE_MODEL_NAME}"
+    return retriever
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hybrid BM25 and dense retrieval over a local abstract collection')
+    parser.add_argument('--collection', type=str, default=config.HYBRID_COLLECTION_PATH, help="JSONL collection of the articles")
+    parser.add_argument('--build', action='store_true', help="Build the indexes from the collection")
+    parser.add_argument('--query', type=str, default=None, help="Query the indexes")
+    args = parser.parse_args()
+    st_model = model_manager.get_sentence_transformer(config.DENSE_MODEL_NAME)
+    if args.build:
+        build_indexes(args.collection, config.HYBRID_LEXICAL_INDEX_PATH, config.HYBRID_DENSE_INDEX_PATH, st_model)
+    if args.query:
+        print(load_hybrid_retriever().get_pmids(st_model, args.query))
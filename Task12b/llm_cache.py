@@ -0,0 +1,117 @@
+'''
+On disk cache of the LLM responses, shared by the TextSynth and OpenAI calls.
+A response is keyed by the hash of the engine and all request parameters (prompt, max_tokens, stop,
+temperature, seed, ...), so a changed prompt or parameter is a new entry.
+
+Cache modes:
+    OFF:            every request goes to the LLM
+    DETERMINISTIC:  cache the requests with temperature 0 or a seed, sampled requests go to the LLM
+    ALL:            cache every request, a sampled request is answered with the first sample
+    READ_ONLY:      answer every request from the cache only, nothing is sent to the LLM or stored;
+                    a request not cached raises LLMCacheMiss and is listed in the stats report
+'''
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_MODES = ['OFF', 'DETERMINISTIC', 'ALL', 'READ_ONLY']
+
+class LLMCacheMiss(Exception):
+    '''Raised in READ_ONLY mode for a request that is not cached'''
+
+def get_cache_key(engine, params):
+    key_text = json.dumps({'engine': engine, 'params': params}, sort_keys=True)
+    return hashlib.sha256(key_text.encode('utf-8')).hexdigest()
+
+def is_deterministic(params):
+    '''The request returns the same response every time, TextSynth and OpenAI default to sampling'''
+    return params.get('temperature') == 0 or params.get('seed') is not None
+
+class LLMCache:
+    def __init__(self, db_file, mode='DETERMINISTIC', ttl=0, max_entries=0):
+        assert mode in CACHE_MODES, f'Unrecognized LLM cache mode {mode}'
+        self.mode = mode
+        self.ttl = ttl # seconds, 0 keeps the entries forever
+        self.max_entries = max_entries # 0 for no limit
+        self.stats = {'hit': 0, 'miss': 0}
+        self.missing = [] # (engine, prompt) of the READ_ONLY misses
+        self.lock = threading.Lock()
+        self.conn = None
+        if mode != 'OFF':
+            os.makedirs(os.path.dirname(db_file) or '.', exist_ok=True)
+            self.conn = sqlite3.connect(db_file, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            with self.conn:
+                self.conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, engine TEXT, '
+                    'params TEXT, response TEXT, created_at REAL, accessed_at REAL)')
+
+    def can_read(self, params):
+        if self.mode in ('ALL', 'READ_ONLY'):
+            return True
+        return self.mode == 'DETERMINISTIC' and is_deterministic(params)
+
+    def can_write(self, params):
+        if self.mode == 'ALL':
+            return True
+        return self.mode == 'DETERMINISTIC' and is_deterministic(params)
+
+    def get(self, key):
+        '''Return the cached response, return None if it is not cached or expired'''
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT response, created_at FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            response, created_at = row
+            if self.ttl > 0 and now - created_at > self.ttl:
+                if self.mode != 'READ_ONLY':
+                    with self.conn:
+                        self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                return None
+            if self.mode != 'READ_ONLY':
+                with self.conn:
+                    self.conn.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+        return json.loads(response)
+
+    def set(self, key, engine, params, response):
+        now = time.time()
+        with self.lock:
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO responses (key, engine, params, response, created_at, accessed_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)', (key, engine, json.dumps(params), json.dumps(response), now, now))
+                if self.max_entries > 0:
+                    # Evict the least recently used entries
+                    self.conn.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses '
+                        'ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def cached_call(self, engine, params, request_fn):
+        '''
+        Return the cached response of the request, or call request_fn() and cache its response.
+        In READ_ONLY mode request_fn() is never called, a request not cached raises LLMCacheMiss
+        '''
+        if self.mode == 'OFF' or not self.can_read(params):
+            return request_fn()
+        key = get_cache_key(engine, params)
+        response = self.get(key)
+        with self.lock:
+            self.stats['hit' if response is not None else 'miss'] += 1
+        if response is not None:
+            return response
+        if self.mode == 'READ_ONLY':
+            with self.lock:
+                self.missing.append((engine, params.get('prompt', params.get('messages'))))
+            raise LLMCacheMiss(f'{engine} request not cached')
+        response = request_fn()
+        if self.can_write(params):
+            self.set(key, engine, params, response)
+        return response
+
+    def print_stats(self, max_prompt_len=200):
+        total = self.stats['hit'] + self.stats['miss']
+        hit_rate = self.stats['hit'] / total if total else 0.0
+        print(f"LLM cache ({self.mode}): hit={self.stats['hit']}, miss={self.stats['miss']}, hit_rate={hit_rate:.2%}")
+        for engine, prompt in self.missing:
+            print(f'Not cached: {engine} {str(prompt)[:max_prompt_len]!r}')
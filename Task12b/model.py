@@ -2,19 +2,27 @@ import argparse
 import datetime
 import json
 import re
+import threading
 import time
-import torch
+import numpy as np
 import search_utils
+import hybrid_search
+import snippet_rerank
+import model_manager
 import textsynth_api as llm
 import helper_utils as helper
 import metrics
 import config
 import qa_module
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from pprint import pprint
 from types import SimpleNamespace
-from sentence_transformers import SentenceTransformer, util
 from prompt_utils import Question, prompt_config, keyword_extact_prompt
+from embedding_store import CachedEncoder, load_cached_encoder
+
+# Serialize the writes of the QA threads to the shared log file
+LOG_LOCK = threading.Lock()
 
 # -----------------------------------------------------------------------------
 # LLM Question keyword extractor methods
@@ -144,11 +152,12 @@ def qa_ask_llm(cur_model, ques, context, log_file=None):
         final = prompt + response
 
         if config.INFO_TRACE:
-            print("\n" + "-"*80 + "\n")
-            print(f'LLM QA cnt-{cnt+1}') 
-            print(f'context: {context}')
-            print(f'q: {qbody}')
-            print(f'a: {response}')
+            # One print call, so the traces of concurrent questions don't interleave
+            print("\n" + "-"*80 + "\n\n"
+                  f'LLM QA cnt-{cnt+1}\n'
+                  f'context: {context}\n'
+                  f'q: {qbody}\n'
+                  f'a: {response}')
 
         # Find the position of last ideal answer tag in final string
         ideal_answer_start = final.rfind(ideal_answer_tag)
@@ -180,10 +189,11 @@ def qa_ask_llm(cur_model, ques, context, log_file=None):
 
         print(f'Unable to parse output, retry {next_step}')
         if log_file:
-            log_file.write(f"\n> {datetime.datetime.now()}\n")
-            log_file.write(final)
-            json.dump(req, log_file, indent=2)
-            log_file.write(cur_model)
+            with LOG_LOCK:
+                log_file.write(f"\n> {datetime.datetime.now()}\n")
+                log_file.write(final)
+                json.dump(req, log_file, indent=2)
+                log_file.write(cur_model)
             print('write result to file')
 
     return answer, raw_answers
@@ -191,12 +201,97 @@ def qa_ask_llm(cur_model, ques, context, log_file=None):
 # -----------------------------------------------------------------------------
 # Snippet extraction helpers
 # -----------------------------------------------------------------------------
-def extract_snippets(article_list, qbody, st_model):
+def load_st_model(model_name="all-MiniLM-L6-v2"):
+    '''
+        Return the shared sentence embedder of EMBEDDING_BACKEND, behind the embedding store if
+        ENABLE_EMBEDDING_STORE. It is loaded on the first call
+    '''
+    if config.EMBEDDING_BACKEND == 'ONNX_INT8':
+        load_fn = lambda: model_manager.get_onnx_embedder(config.ONNX_MODEL_DIR, num_threads=config.ONNX_NUM_THREADS)
+        # The int8 vectors are not the torch ones, they are stored apart
+        store_name = f'{model_name}-onnx-int8'
+    else:
+        load_fn = lambda: model_manager.get_sentence_transformer(model_name)
+        store_name = model_name
+    if not config.ENABLE_EMBEDDING_STORE:
+        return load_fn()
+    return model_manager.get_model(('cached_encoder', store_name, config.EMBEDDING_STORE_PATH),
+        lambda: load_cached_encoder(load_fn(), store_name, config.EMBEDDING_STORE_PATH))
+
+def get_article_sentences(article):
+    '''Split the abstract of an article in sentences, the title is the last sentence'''
+    all_sentences = []
+    for abstract_clip in article['abstract_list']:
+        abstract_sentences = abstract_clip.split('. ')
+        all_sentences.extend(abstract_sentences)
+    # add title sentence
+    if article['title']:
+        all_sentences.append(article['title'])
+    return all_sentences
+
+def score_article_sentences(st_model, question_embedding, sentence_lists):
+    '''
+        Given the normalized question embedding and the sentence list of each article, encode
+        all sentences in one batched call and return the similarity scores of each article's sentences
+    '''
+    sentences = [sentence for sentence_list in sentence_lists for sentence in sentence_list]
+    sentence_embeddings = st_model.encode(sentences, batch_size=config.ST_BATCH_SIZE, normalize_embeddings=True)
+    scores = np.asarray(sentence_embeddings, dtype=np.float32) @ np.asarray(question_embedding, dtype=np.float32)
+    # split the scores in each article's segment
+    score_lists = []
+    offset = 0
+    for sentence_list in sentence_lists:
+        score_lists.append(scores[offset:offset + len(sentence_list)])
+        offset += len(sentence_list)
+    return score_lists
+
+def make_snippet(article, snippet_str, section, begin_loc, end_loc):
+    snip = {}
+    snip['document'] = 'http://www.ncbi.nlm.nih.gov/pubmed/' + article['pmid']
+    snip['offsetInBeginSection'] = begin_loc
+    snip['offsetInEndSection'] = end_loc
+    snip['beginSection'] = section
+    snip['endSection'] = section
+    snip['text'] = snippet_str
+    return snip
+
+def extract_snippets(article_list, qbody, st_model, question_embedding=None, reranker=None):
     ''' 
         Given a list of article, a question and an embeding model, return the
-        most relevant sentence in each article according to embedding simliarity. 
+        most relevant sentence in each article according to embedding simliarity.
+        The question is encoded once (or question_embedding, normalized, is used) and the
+        sentences of consecutive articles are encoded together in batches of ST_BATCH_SIZE.
+        With SNIP_RERANK_MODE, the sentences of all articles are reranked by the cross encoder instead.
     '''
+    if reranker is None:
+        reranker = snippet_rerank.get_reranker()
     snip_list = []
+    # (bi-encoder score, sentence, pmid, article) of all sentences for the reranker
+    rerank_candidates = []
+    # (index in snip_list, article, sentences) of the articles waiting for the batched encoding
+    pending = []
+    pending_cnt = 0
+
+    def _rank_pending():
+        nonlocal question_embedding, pending_cnt
+        if len(pending) == 0:
+            return
+        if question_embedding is None:
+            question_embedding = st_model.encode(qbody, normalize_embeddings=True)
+        score_lists = score_article_sentences(st_model, question_embedding, [sentences for _, _, sentences in pending])
+        for (ind, article, sentences), scores in zip(pending, score_lists):
+            if reranker is not None:
+                rerank_candidates.extend((float(score), sentence, article['pmid'], article)
+                                         for score, sentence in zip(scores, sentences) if sentence != '')
+                continue
+            snippet_str = sentences[int(np.argmax(scores))]
+            if snippet_str == '':
+                continue
+            section, begin_loc, end_loc = helper.locate_snip(snippet_str, article)
+            snip_list[ind] = make_snippet(article, snippet_str, section, begin_loc, end_loc)
+        pending.clear()
+        pending_cnt = 0
+
     for article in article_list:
         begin_loc = 0
         if article['abstract_raw']:
@@ -210,21 +305,18 @@ def extract_snippets(article_list, qbody, st_model):
                 section = 'abstract'
             elif config.SNIP_EXTRACT_MODE == 'TRANSFORMER':
                 # embedding using transformer
-                abstract_list = article['abstract_list']
-                all_sentences = []
-                for abstract_clip in abstract_list:
-                    abstract_sentences = abstract_clip.split('. ')
-                    all_sentences.extend(abstract_sentences)
-                # add title sentence
-                if article['title']:
-                    all_sentences.append(article['title'])
+                all_sentences = get_article_sentences(article)
                 if config.VERBOSE:
                     print('pmid', article['pmid'])
-                sentence_rank = helper.get_top_results(st_model, qbody, all_sentences, 3)
-                snippet_str = all_sentences[sentence_rank[1][0]]
-                if snippet_str == '':
+                if len(all_sentences) == 0:
                     continue
-                section, begin_loc, end_loc = helper.locate_snip(snippet_str, article)
+                # keep the article's place in the snippet list until its sentences are ranked
+                snip_list.append(None)
+                pending.append((len(snip_list) - 1, article, all_sentences))
+                pending_cnt += len(all_sentences)
+                if pending_cnt >= config.ST_BATCH_SIZE:
+                    _rank_pending()
+                continue
             else:
                 assert(not 'unrecognized extract mode')
         elif article['title']:
@@ -234,17 +326,18 @@ def extract_snippets(article_list, qbody, st_model):
             section = 'title'
         else:
             continue
-        snip = {}
-        snip['document'] = 'http://www.ncbi.nlm.nih.gov/pubmed/' + article['pmid']
-        snip['offsetInBeginSection'] = begin_loc
-        snip['offsetInEndSection'] = end_loc
-        snip['beginSection'] = section
-        snip['endSection'] = section
-        snip['text'] = snippet_str
-        snip_list.append(snip)
+        snip_list.append(make_snippet(article, snippet_str, section, begin_loc, end_loc))
+    _rank_pending()
+    snip_list = [snip for snip in snip_list if snip is not None]
+    if reranker is not None:
+        reranked_list = []
+        for _, snippet_str, _, article in reranker.select(qbody, rerank_candidates):
+            section, begin_loc, end_loc = helper.locate_snip(snippet_str, article)
+            reranked_list.append(make_snippet(article, snippet_str, section, begin_loc, end_loc))
+        # the articles without abstract keep their title snippet
+        snip_list = reranked_list + snip_list
     return snip_list
 
-
 def get_context_snippet_groups(ques_obj):
     '''
         Given a question and a list of golden snippets, compose the question
@@ -303,16 +396,72 @@ def get_context_snippet_groups(ques_obj):
         selected_context_grp = context_group[:1]
     return selected_context_grp
 
+def qa_submit_question(executor, ques_obj, log_file):
+    '''
+    Submit the LLM QA requests of every context group of the question to the executor.
+    Return the futures in context group order, and whether the answers need post-processing
+    '''
+    if not config.ADD_QA_CONTEXT:
+        return [executor.submit(qa_ask_llm, config.LLM_MODEL, ques_obj, '', log_file)], False
+    context_group = get_context_snippet_groups(ques_obj)
+    if len(context_group) == 0:
+        return [executor.submit(qa_ask_llm, config.LLM_MODEL, ques_obj, '', log_file)], False
+    futures = []
+    for context in context_group:
+        if config.VERBOSE:
+            print('context')
+            print(context)
+        assert(len(context) > 0)
+        futures.append(executor.submit(qa_ask_llm, config.LLM_MODEL, ques_obj, context, log_file))
+    return futures, True
+
+def qa_collect_question(ques_obj, futures, postproc):
+    '''
+    Wait for the answers of the context groups in order and combine them to the final answer
+    '''
+    raw_ans_list = []
+    llm_pred_list = []
+    for future in futures:
+        llm_partial_ans, raw_ans_partial_list = future.result()
+        raw_ans_list.extend(raw_ans_partial_list)
+        llm_pred_list.append(llm_partial_ans)
+    if postproc:
+        llm_ans = qa_module.qa_postproc_prediction(ques_obj, llm_pred_list)
+    else:
+        llm_ans = llm_pred_list[0]
+    return llm_ans, raw_ans_list
+
 def append_log(filename, log_data):
     """Append a log entry to a JSONL file."""
     with open(filename, 'a') as file:  
         json_string = json.dumps(log_data)
         file.write(json_string + '\n')  
 
-
-def run(input_filename, stage, do_validation):
+def load_checkpoint(res_file_path):
+    """Return {id: submission record} of the questions answered in an incremental result log."""
+    records = {}
+    with open(res_file_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line is cut when the run was killed while writing it
+                print(f'Skip malformed checkpoint line: {line.strip()[:80]}')
+                continue
+            records[record['id']] = record
+    return records
+
+def get_checkpoint_time(res_file_path):
+    """Return the run time stamp of logs/res_inc_<time>.jsonl, the resumed run keeps its file names."""
+    match = re.fullmatch(r'res_inc_(\d+)\.jsonl', Path(res_file_path).name)
+    assert match, f'{res_file_path} is not an incremental result log (logs/res_inc_<time>.jsonl)'
+    return int(match.group(1))
+
+def run(input_filename, stage, do_validation, resume=None):
     input_path = f'input/{input_filename}.json'
-    cur_time = int(time.time())
+    # A resumed run appends to the logs of the checkpoint and writes the outputs under the same names
+    assert resume is None or stage == 'B', 'Only stage B runs can be resumed'
+    cur_time = get_checkpoint_time(resume) if resume else int(time.time())
     output_path = f'output/res_stage{stage}_{input_filename}_{cur_time}.json'
     submission_path = f'output/submission_stage{stage}_{input_filename}_{cur_time}.json'
     output_file = open(output_path, 'w')
@@ -326,6 +475,16 @@ def run(input_filename, stage, do_validation):
         qa_results = {}
 
     questions = helper.parse_input(input_path)
+    checkpoint = {}
+    if resume:
+        checkpoint = load_checkpoint(resume)
+        print(f'Resume from {resume}: {len(checkpoint)} questions already answered')
+        # End the line cut by the crash, the new answers are appended after it
+        with open(resume, 'rb+') as f:
+            if f.seek(0, 2) > 0:
+                f.seek(-1, 2)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
 
     print(f'LLM model: {config.LLM_MODEL}, SEARCH_WORD_MODE: {config.SEARCH_WORD_MODE}, Input: {input_path}, Validate: {do_validation}')
     print(f'ADD_QA_CONTEXT: {config.ADD_QA_CONTEXT}, ENABLE_SYNONYM_GROUPING: {config.ENABLE_SYNONYM_GROUPING}, FAKE_LLM: {config.FAKE_LLM}, LIST_SINGLE_PROMPT: {config.LIST_SINGLE_PROMPT}')
@@ -333,15 +492,40 @@ def run(input_filename, stage, do_validation):
     spacy_model = None
     st_model = None
     if stage == 'A':
+        # Load the models in parallel
+        if config.SNIP_EXTRACT_MODE == 'TRANSFORMER' or config.SEARCH_WORD_MODE == 'HYBRID':
+            model_manager.warm_up(load_st_model)
         if config.SEARCH_WORD_MODE == 'SPACY':
             spacy_model = search_utils.load_spacy_model()
-        if config.SNIP_EXTRACT_MODE == 'TRANSFORMER':
-            st_model = SentenceTransformer("all-MiniLM-L6-v2")
+        if config.SNIP_EXTRACT_MODE == 'TRANSFORMER' or config.SEARCH_WORD_MODE == 'HYBRID':
+            st_model = load_st_model()
+        if config.SEARCH_WORD_MODE == 'HYBRID':
+            hybrid_retriever = hybrid_search.load_hybrid_retriever()
     output_dict = {'questions': []}
     submission_dict = {'questions': []}
     proc_rec = 0
     proc_qa = 0
+    proc_resumed = 0
     total_rec = len(questions)
+    # The fake LLM replies the proxy answers in request order, keep it sequential to stay deterministic
+    qa_executor = ThreadPoolExecutor(max_workers=1 if config.FAKE_LLM else config.QA_MAX_WORKERS)
+    pending_qa = []
+
+    def _finish_pending_qa():
+        '''Collect the answers of the pending questions in input order and log them'''
+        nonlocal proc_qa
+        for ques_obj, futures, postproc in pending_qa:
+            llm_ans, raw_ans_list = qa_collect_question(ques_obj, futures, postproc)
+            if collect_llm_qa:
+                qa_results[ques_obj.id] = raw_ans_list
+            ques_obj.ideal_answer = llm_ans['ideal']
+            ques_obj.exact_answer = llm_ans['exact']
+            proc_qa += 1
+            append_log(incremental_res_file_path, ques_obj.to_submission_dict(stage))
+            output_dict['questions'].append(ques_obj.to_dict())
+            submission_dict['questions'].append(ques_obj.to_submission_dict(stage))
+        pending_qa.clear()
+
     # questions = questions[:10]
     for ques_dict in questions:
         ques_obj = helper.init_ques(ques_dict, stage=stage)
@@ -392,6 +576,9 @@ def run(input_filename, stage, do_validation):
 
                         pmid_list = search_utils.get_pmids(query_term, verbose=config.VERBOSE)
                         break
+            elif config.SEARCH_WORD_MODE == 'HYBRID':
+                ir_log_obj['outputs'].append(qbody)
+                pmid_list = hybrid_retriever.get_pmids(st_model, qbody)
             else:
                 assert(not 'Unrecognized search mode')
 
@@ -400,42 +587,33 @@ def run(input_filename, stage, do_validation):
                 
             if config.INFO_TRACE:
                 print('PUBMED list length:', len(pmid_list))
-            article_list = search_utils.query_by_pmids(pmid_list, verbose=config.VERBOSE)
+            # The snippets are extracted while the articles are downloaded
+            article_iter = search_utils.iter_articles_by_pmids(pmid_list, verbose=config.VERBOSE)
 
             ques_obj.documents = pmid_list
-            ques_obj.snippets = extract_snippets(article_list, qbody, st_model)
+            ques_obj.snippets = extract_snippets(article_iter, qbody, st_model)
 
         # 2. Perform QA task. In stage B, Golden Documents and snippets are already loaded from inputs file
-        # elif stage == 'B' and ques_dict['type'] == 'list':
+        # The answers of a resumed run are taken from the checkpoint, after the pending ones to keep the input order
+        elif stage == 'B' and ques_obj.id in checkpoint:
+            _finish_pending_qa()
+            ques_obj.ideal_answer = checkpoint[ques_obj.id]['ideal_answer']
+            ques_obj.exact_answer = checkpoint[ques_obj.id]['exact_answer']
+            proc_resumed += 1
+        # The context groups of a window of questions are answered concurrently
         elif stage == 'B':
-            if not config.ADD_QA_CONTEXT:
-                llm_ans, raw_ans_list = qa_ask_llm(config.LLM_MODEL, ques_obj, '', log_file,)
-            else:
-                raw_ans_list = []
-                llm_pred_list = []
-                context_group = get_context_snippet_groups(ques_obj)
-                if len(context_group) == 0:
-                    llm_ans, raw_ans_list = qa_ask_llm(config.LLM_MODEL, ques_obj, '', log_file)
-                else:
-                    for context in context_group:
-                        if config.VERBOSE:
-                            print('context')
-                            print(context)
-                        assert(len(context) > 0)
-                        llm_partial_ans, raw_ans_partial_list = qa_ask_llm(config.LLM_MODEL, ques_obj, context, log_file)
-                        raw_ans_list.extend(raw_ans_partial_list)
-                        llm_pred_list.append(llm_partial_ans)
-                    llm_ans = qa_module.qa_postproc_prediction(ques_obj, llm_pred_list)
-            if collect_llm_qa:
-                qa_results[ques_obj.id] = raw_ans_list
-            ques_obj.ideal_answer = llm_ans['ideal']
-            ques_obj.exact_answer = llm_ans['exact']
-            proc_qa += 1
-            append_log(incremental_res_file_path, ques_obj.to_submission_dict(stage))
-            
+            pending_qa.append((ques_obj, *qa_submit_question(qa_executor, ques_obj, log_file)))
+            if len(pending_qa) >= config.QA_QUESTION_WINDOW:
+                _finish_pending_qa()
+            continue
+
         output_dict['questions'].append(ques_obj.to_dict())
         submission_dict['questions'].append(ques_obj.to_submission_dict(stage))
 
+    if stage == 'B':
+        _finish_pending_qa()
+        qa_executor.shutdown()
+
     # Write the output json object to a file
     json.dump(output_dict, output_file, indent=2, sort_keys=False)
     json.dump(submission_dict, submission_file, indent=2, sort_keys=False)
@@ -452,16 +630,20 @@ def run(input_filename, stage, do_validation):
 
     print('\n## Output\n')
     print(f'For input file \"{input_path}\"')
-    print(f'Proccessed record count: {proc_rec}, qa_rec: {proc_qa}')
+    print(f'Proccessed record count: {proc_rec}, qa_rec: {proc_qa}, resumed_rec: {proc_resumed}')
     print(f'See result in output file \"{output_path}\"')
     print(f'See submission file \"{submission_path}\"')
     print(f'Start time: {start_time}')
     print(f'End time: {datetime.datetime.now()}')
+    llm.print_llm_report()
+    if isinstance(st_model, CachedEncoder):
+        st_model.print_stats()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Task12b model runner')
     parser.add_argument('--input', type=str, default = 'small_question', help="The file name of the input json file")
     parser.add_argument('--stage', type=str, default = 'B', help="Stage A or B of the task")
     parser.add_argument('--validate', action='store_true', help="Run validation code to calculate the accuracy given the golden answer")
+    parser.add_argument('--resume', type=str, default=None, help="Resume a stage B run from its logs/res_inc_<time>.jsonl")
     args = parser.parse_args()
-    run(args.input, args.stage, args.validate)
+    run(args.input, args.stage, args.validate, args.resume)
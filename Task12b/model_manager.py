@@ -0,0 +1,59 @@
+'''
+Process wide registry of the heavy models (sentence transformer, cross encoder, spaCy).
+A model is imported and loaded on the first get_* call and shared by all callers and threads
+afterwards; concurrent first calls wait for the same load. warm_up starts the loads in background
+threads, e.g. while the LLM query expansion runs, so the first use doesn't wait for them.
+Nothing heavy is imported by this module, the metric-only entry points stay fast to start.
+'''
+import threading
+
+MODELS = {}
+MODEL_LOCKS = {}
+REGISTRY_LOCK = threading.Lock()
+
+def get_model(key, load_fn):
+    '''Return the model registered under key, load_fn() loads it on the first call'''
+    model = MODELS.get(key)
+    if model is not None:
+        return model
+    with REGISTRY_LOCK:
+        lock = MODEL_LOCKS.setdefault(key, threading.Lock())
+    # One lock per model, loading a model doesn't block the users of the others
+    with lock:
+        if key not in MODELS:
+            MODELS[key] = load_fn()
+        return MODELS[key]
+
+def get_sentence_transformer(model_name="all-MiniLM-L6-v2"):
+    def _load():
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(model_name)
+    return get_model(('sentence_transformer', model_name), _load)
+
+def get_cross_encoder(model_name, device='cpu'):
+    def _load():
+        from sentence_transformers import CrossEncoder
+        return CrossEncoder(model_name, device=device)
+    return get_model(('cross_encoder', model_name, device), _load)
+
+def get_onnx_embedder(model_dir, quantized=True, num_threads=0):
+    def _load():
+        from onnx_embedder import load_onnx_embedder
+        return load_onnx_embedder(model_dir, quantized, num_threads)
+    return get_model(('onnx_embedder', model_dir, quantized, num_threads), _load)
+
+def get_spacy_model(model_name="en_ner_bc5cdr_md"):
+    def _load():
+        import spacy
+        return spacy.load(model_name)
+    return get_model(('spacy', model_name), _load)
+
+def warm_up(*load_fns):
+    '''Call the get_* functions in background threads, return the threads'''
+    threads = [threading.Thread(target=load_fn, daemon=True) for load_fn in load_fns]
+    for thread in threads:
+        thread.start()
+    return threads
+
+def is_loaded(key):
+    return key in MODELS
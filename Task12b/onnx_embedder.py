@@ -0,0 +1,179 @@
+'''
+ONNX Runtime CPU backend of the sentence embedder, with dynamic int8 quantization of the weights.
+export_onnx converts the transformer of a SentenceTransformer model to ONNX, quantizes it and saves
+the tokenizer next to it. OnnxEmbedder has the same encode() interface as SentenceTransformer
+(mean pooling over the tokens, normalization if the model normalizes), so get_top_results, one_ir
+and the embedding store use it as is. Select it with EMBEDDING_BACKEND = 'ONNX_INT8' in config.py.
+
+onnxruntime and onnx are optional, they are imported on use (pip install onnxruntime onnx).
+    python onnx_embedder.py --export      # writes ONNX_MODEL_DIR
+    python onnx_embedder.py --check       # cosine and top-k neighbour agreement with the torch model on the fixture sentences
+    python onnx_embedder.py --benchmark   # sentences per second of the torch and ONNX backends
+'''
+import argparse
+import inspect
+import json
+import os
+import time
+import numpy as np
+import model_manager
+import config
+
+PARITY_FIXTURE_PATH = 'input/embedding_fixture.txt'
+
+def export_onnx(model_name, output_dir, opset_version=14):
+    '''Export the transformer of the SentenceTransformer model to output_dir/model.onnx and model_int8.onnx'''
+    import torch
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    st_model = model_manager.get_sentence_transformer(model_name)
+    transformer = st_model[0]
+    os.makedirs(output_dir, exist_ok=True)
+    transformer.tokenizer.save_pretrained(output_dir)
+    auto_model = transformer.auto_model.eval()
+    dummy = transformer.tokenizer(['An example sentence to trace the model'], return_tensors='pt')
+    input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in dummy]
+
+    class TokenEmbeddings(torch.nn.Module):
+        '''Pass the inputs by name, the positional arguments of forward() differ between transformers versions'''
+        def __init__(self):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(self, *inputs):
+            return self.auto_model(**dict(zip(input_names, inputs)), return_dict=True).last_hidden_state
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+    dynamic_axes['token_embeddings'] = {0: 'batch', 1: 'sequence'}
+    export_args = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # the newer exporter doesn't take dynamic_axes, keep the TorchScript one
+        export_args['dynamo'] = False
+    fp32_path = os.path.join(output_dir, 'model.onnx')
+    with torch.no_grad():
+        torch.onnx.export(TokenEmbeddings(), tuple(dummy[name] for name in input_names), fp32_path,
+            input_names=input_names, output_names=['token_embeddings'], dynamic_axes=dynamic_axes,
+            opset_version=opset_version, **export_args)
+    quantize_dynamic(fp32_path, os.path.join(output_dir, 'model_int8.onnx'), weight_type=QuantType.QInt8)
+    # all-MiniLM-L6-v2 is Transformer -> Pooling (mean) -> Normalize
+    normalize = any(type(module).__name__ == 'Normalize' for module in st_model)
+    with open(os.path.join(output_dir, 'meta.json'), 'w') as f:
+        json.dump({'model': model_name, 'dim': st_model.get_sentence_embedding_dimension(),
+            'max_seq_length': st_model.max_seq_length, 'input_names': input_names, 'normalize': normalize}, f)
+
+def mean_pooling(token_embeddings, attention_mask):
+    '''Mean of the token embeddings over the attention mask, as the Pooling module of sentence_transformers'''
+    mask = attention_mask[..., None].astype(np.float32)
+    return (token_embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+
+class OnnxEmbedder:
+    def __init__(self, session, tokenizer, meta):
+        self.session = session
+        self.tokenizer = tokenizer
+        self.meta = meta
+        self.max_seq_length = meta['max_seq_length']
+
+    def get_sentence_embedding_dimension(self):
+        return self.meta['dim']
+
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, convert_to_tensor=False, **kwargs):
+        '''Same as SentenceTransformer.encode, return a float32 numpy array'''
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        # Sentences of similar length are batched together, less padding
+        order = sorted(range(len(texts)), key=lambda ind: -len(texts[ind]))
+        res = np.zeros((len(texts), self.meta['dim']), dtype=np.float32)
+        for start in range(0, len(order), batch_size):
+            batch_ind = order[start:start + batch_size]
+            features = self.tokenizer([texts[ind] for ind in batch_ind], padding=True, truncation=True,
+                max_length=self.max_seq_length, return_tensors='np')
+            inputs = {name: np.asarray(features[name], dtype=np.int64) for name in self.meta['input_names']}
+            token_embeddings = self.session.run(['token_embeddings'], inputs)[0]
+            res[batch_ind] = mean_pooling(token_embeddings, inputs['attention_mask'])
+        if self.meta['normalize'] or normalize_embeddings:
+            res = res / np.maximum(np.linalg.norm(res, axis=1, keepdims=True), 1e-12)
+        res = res[0] if single else res
+        if convert_to_tensor:
+            import torch
+            res = torch.from_numpy(res)
+        return res
+
+def load_onnx_embedder(model_dir, quantized=True, num_threads=0):
+    '''Load the exported model of model_dir, num_threads 0 lets ONNX Runtime choose'''
+    import onnxruntime as ort
+    from transformers import AutoTokenizer
+    with open(os.path.join(model_dir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = num_threads
+    session = ort.InferenceSession(os.path.join(model_dir, 'model_int8.onnx' if quantized else 'model.onnx'),
+        options, providers=['CPUExecutionProvider'])
+    return OnnxEmbedder(session, AutoTokenizer.from_pretrained(model_dir), meta)
+
+def get_top_neighbours(embeddings, top_k):
+    '''Return the indices of the top_k most similar other sentences of every sentence'''
+    normed = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    similarities = normed @ normed.T
+    np.fill_diagonal(similarities, -np.inf)
+    return np.argsort(-similarities, axis=1, kind='stable')[:, :top_k]
+
+def check_parity(reference_model, model, sentences, min_cosine=0.98, top_k=5, min_overlap=0.8):
+    '''
+    Compare the embeddings of the two models. Return the minimum and mean cosine similarity of the
+    embeddings of each sentence, the mean overlap of the top_k nearest sentences of each sentence
+    (the retrieval each model would do), and whether they are above min_cosine and min_overlap
+    '''
+    reference = np.asarray(reference_model.encode(sentences), dtype=np.float32)
+    embeddings = np.asarray(model.encode(sentences), dtype=np.float32)
+    norms = np.linalg.norm(reference, axis=1) * np.linalg.norm(embeddings, axis=1)
+    cosines = np.sum(reference * embeddings, axis=1) / np.maximum(norms, 1e-12)
+    top_k = min(top_k, len(sentences) - 1)
+    overlap = 1.0
+    if top_k > 0:
+        reference_top = get_top_neighbours(reference, top_k)
+        model_top = get_top_neighbours(embeddings, top_k)
+        overlap = float(np.mean([len(set(ref_row) & set(row)) / top_k for ref_row, row in zip(reference_top, model_top)]))
+    return {'min_cosine': float(cosines.min()), 'mean_cosine': float(cosines.mean()), 'topk_overlap': overlap,
+            'passed': bool(cosines.min() >= min_cosine and overlap >= min_overlap)}
+
+def benchmark(models, sentences, batch_size=32, repeat=3):
+    '''Return the best sentences per second of each model of the {name: model} dictionary'''
+    res = {}
+    for name, model in models.items():
+        model.encode(sentences[:batch_size], batch_size=batch_size) # warm up
+        best_time = None
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            model.encode(sentences, batch_size=batch_size)
+            elapsed = time.perf_counter() - start_time
+            best_time = elapsed if best_time is None else min(best_time, elapsed)
+        res[name] = len(sentences) / max(best_time, 1e-9)
+    return res
+
+def load_fixture_sentences(path=PARITY_FIXTURE_PATH):
+    with open(path, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ONNX Runtime int8 backend of the sentence embedder')
+    parser.add_argument('--export', action='store_true', help="Export and quantize the model to --model-dir")
+    parser.add_argument('--check', action='store_true', help="Compare the ONNX and torch embeddings of the fixture sentences")
+    parser.add_argument('--benchmark', action='store_true', help="Compare the throughput of the ONNX and torch backends")
+    parser.add_argument('--model-dir', type=str, default=config.ONNX_MODEL_DIR, help="Directory of the exported model")
+    parser.add_argument('--batch-size', type=int, default=config.ST_BATCH_SIZE)
+    args = parser.parse_args()
+    model_name = config.DENSE_MODEL_NAME
+    if args.export:
+        export_onnx(model_name, args.model_dir)
+        print(f'Exported {model_name} to {args.model_dir}')
+    if args.check or args.benchmark:
+        st_model = model_manager.get_sentence_transformer(model_name)
+        models = {'torch_fp32': st_model,
+                  'onnx_fp32': load_onnx_embedder(args.model_dir, quantized=False, num_threads=config.ONNX_NUM_THREADS),
+                  'onnx_int8': load_onnx_embedder(args.model_dir, quantized=True, num_threads=config.ONNX_NUM_THREADS)}
+        sentences = load_fixture_sentences()
+        if args.check:
+            for name in ('onnx_fp32', 'onnx_int8'):
+                print(f'{name} parity with torch_fp32: {check_parity(st_model, models[name], sentences)}')
+        if args.benchmark:
+            # Repeat the fixture for a measurable run
+            for name, rate in benchmark(models, sentences * 20, args.batch_size).items():
+                print(f'{name}: {rate:.1f} sentences/s')
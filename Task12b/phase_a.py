@@ -3,7 +3,6 @@ import datetime
 import json
 import re
 import time
-import torch
 import search_utils
 import textsynth_api as llm
 import helper_utils as helper
@@ -13,9 +12,12 @@ import qa_module
 from pathlib import Path
 from pprint import pprint
 from types import SimpleNamespace
-from sentence_transformers import SentenceTransformer, util
 from prompt_utils import Question, prompt_config, keyword_extact_prompt
 import model
+import model_manager
+from dense_index import DenseIndex
+from hybrid_search import load_hybrid_retriever
+from embedding_store import CachedEncoder
 
 
 # a_setup
@@ -34,6 +36,7 @@ def a_setup(input_filename):
             'LLM_MODEL': config.LLM_MODEL,
             'SNIP_EXTRACT_MODE': config.SNIP_EXTRACT_MODE,
             'PUBLIC_MAX_LENGTH': config.PUBMED_MAX_LENGTH,
+            'RETRIEVAL_MODE': config.RETRIEVAL_MODE,
         }
         json.dump(config_obj, f)
 
@@ -89,6 +92,9 @@ def one_query(ques_dict, spacy_model=None, mode='LLM'):
                 print(f'Last try with Keywords: {query_term}')
 
                 break
+    elif mode == 'HYBRID':
+        # The question is the query
+        ir_log_obj['outputs'].append(qbody)
     else:
         assert(not 'Unrecognized search mode')
 
@@ -133,12 +139,49 @@ def a_query(curr_folder, questions, spacy_model=None, query_file='query'):
 
     return questions
     
-def one_ir(question, pmid_list, st_model):
+def search_question_pmids(question, st_model=None, hybrid_retriever=None):
+    if question['mode'] == 'HYBRID':
+        return hybrid_retriever.get_pmids(st_model, question['outputs'][-1])
+    # Query from Pubmed
+    if question['mode'] == 'SPACY' or question['mode'] == 'LLM':
+        keywords = question['outputs'][-1] # get the last try's keywords
+        return search_utils.query_by_keywords(keywords, verbose=config.VERBOSE)
+    elif question['mode'] == 'MIXTRAL_47B' or question['mode'] == 'OPENAI':
+        query_term = question['outputs'][-1] # get the last try's query
+        return search_utils.get_pmids(query_term, verbose=config.VERBOSE)
+
+def load_dense_index():
+    '''Return the dense index used by RETRIEVAL_MODE, None in KEYWORD mode'''
+    if config.RETRIEVAL_MODE == 'KEYWORD':
+        return None
+    dense_index = DenseIndex(config.DENSE_INDEX_PATH)
+    assert dense_index.meta['model'] == config.DENSE_MODEL_NAME, \
+        f"The dense index was built with {dense_index.meta['model']}, not {config.DENSE_MODEL_NAME}"
+    print(f'Loaded the dense index of {len(dense_index.pmids)} articles')
+    return dense_index
+
+def retrieve_question_pmids(question, keyword_pmids, st_model, dense_index):
+    '''Combine the keyword query pmids with the dense index pmids according to RETRIEVAL_MODE'''
+    if dense_index is None or config.RETRIEVAL_MODE == 'KEYWORD':
+        return keyword_pmids
+    if config.RETRIEVAL_MODE == 'FALLBACK' and len(keyword_pmids) > 0:
+        return keyword_pmids
+    dense_pmids = dense_index.get_pmids(st_model, question['body'], config.DENSE_TOP_K)
+    if config.INFO_TRACE and config.RETRIEVAL_MODE == 'FALLBACK':
+        print(f'No keyword results, {len(dense_pmids)} articles from the dense index')
+    return dense_pmids
+
+def one_ir(question, pmid_list, st_model, prefetched_articles=None):
+    import torch
+    from sentence_transformers import util
     # Get embedding for qbody
-    question_embedding = st_model.encode(question['body'])
+    question_embedding = st_model.encode(question['body'], normalize_embeddings=True)
 
     # Get the abstracts and embeddings
-    articles = search_utils.query_by_pmids(pmid_list, verbose=config.VERBOSE)
+    if prefetched_articles is None:
+        articles = search_utils.query_by_pmids(pmid_list, verbose=config.VERBOSE)
+    else:
+        articles = [prefetched_articles[pmid] for pmid in dict.fromkeys(pmid_list) if pmid in prefetched_articles]
 
     articles_embeddings = st_model.encode([article['abstract_raw'] for article in articles])
     similarity_scores = util.pytorch_cos_sim(question_embedding, articles_embeddings)
@@ -150,7 +193,7 @@ def one_ir(question, pmid_list, st_model):
     sorted_articles = [articles[i] for i in sorted_indices]
 
     # create snippets
-    snippets = model.extract_snippets(sorted_articles, question['body'], st_model)
+    snippets = model.extract_snippets(sorted_articles, question['body'], st_model, question_embedding)
 
     # get pmids
     sorted_pmids = [article['pmid'] for article in sorted_articles]
@@ -158,7 +201,7 @@ def one_ir(question, pmid_list, st_model):
     return sorted_pmids, snippets
     
 # a_ir
-def a_ir(questions_with_queries, curr_folder, st_model):
+def a_ir(questions_with_queries, curr_folder, st_model, dense_index=None, hybrid_retriever=None):
     print('-'*50)
     print('IR Processing')
     print('-'*50)
@@ -179,16 +222,22 @@ def a_ir(questions_with_queries, curr_folder, st_model):
     questions_with_queries = [q for q in questions_with_queries if q['id'] not in ids]
     print(f'Processing IR for {len(questions_with_queries)} questions')
 
-    for idx, question in enumerate(questions_with_queries):
+    # Search all questions concurrently, then fetch the articles of all questions in batched EFetch requests
+    if config.RETRIEVAL_MODE == 'DENSE':
+        keyword_pmid_lists = [[] for _ in questions_with_queries]
+    elif hybrid_retriever is not None:
+        # Local search, the questions are embedded one after the other
+        keyword_pmid_lists = [search_question_pmids(question, st_model, hybrid_retriever) for question in questions_with_queries]
+    else:
+        keyword_pmid_lists = list(search_utils.NCBI_EXECUTOR.map(search_question_pmids, questions_with_queries))
+    pmid_lists = [retrieve_question_pmids(question, keyword_pmids, st_model, dense_index)
+                  for question, keyword_pmids in zip(questions_with_queries, keyword_pmid_lists)]
+    all_pmids = [pmid for pmid_list in pmid_lists for pmid in pmid_list]
+    prefetched_articles = search_utils.fetch_articles(all_pmids, verbose=config.VERBOSE)
+    print(f'Fetched {len(prefetched_articles)} articles')
+
+    for idx, (question, pmid_list) in enumerate(zip(questions_with_queries, pmid_lists)):
         print(f'IR Processing {idx+1}/{len(questions_with_queries)}')
-        # Query from Pubmed
-        if question['mode'] == 'SPACY' or question['mode'] == 'LLM':
-            keywords = question['outputs'][-1] # get the last try's keywords
-            pmid_list = search_utils.query_by_keywords(keywords, verbose=config.VERBOSE)
-        elif question['mode'] == 'MIXTRAL_47B' or question['mode'] == 'OPENAI':
-            query_term = question['outputs'][-1] # get the last try's query
-            pmid_list = search_utils.get_pmids(query_term, verbose=config.VERBOSE)
-
         if len(pmid_list) == 0:
             print(f'***No articles found for question {question["body"]} - {question["id"]}')
             # save in a file
@@ -196,7 +245,7 @@ def a_ir(questions_with_queries, curr_folder, st_model):
             model.append_log(difficult_questions_log_path, question)
             continue
         else:
-            sorted_pmids, snippets = one_ir(question, pmid_list, st_model)
+            sorted_pmids, snippets = one_ir(question, pmid_list, st_model, prefetched_articles)
 
             # save the results
             ir_log_obj = {'id': question['id'], 'body': question['body'], 'type': question['type'], 'documents': sorted_pmids, 'snippets': snippets}
@@ -224,7 +273,7 @@ def prepare_phase_a_outputs(curr_folder, input_filename):
 
     return
 
-def retry_difficult_questions(curr_folder, st_model):
+def retry_difficult_questions(curr_folder, st_model, dense_index=None):
     # read the difficult questions
     difficult_questions_log_path = f'{curr_folder}/difficult_questions.jsonl'
     difficult_ir_output = f'{curr_folder}/difficult_ir.jsonl'
@@ -244,6 +293,7 @@ def retry_difficult_questions(curr_folder, st_model):
             # run IR on difficult questions
             keywords = ir_log_obj['outputs'][-1]
             pmid_list = search_utils.query_by_keywords(keywords, verbose=config.VERBOSE)
+            pmid_list = retrieve_question_pmids(question, pmid_list, st_model, dense_index)
 
             if len(pmid_list) == 0:
                 print(f'***No articles found for question {question["body"]} - {question["id"]}')
@@ -264,18 +314,25 @@ def main():
     input_filename = '12B3PhaseA'   
     questions, curr_folder = a_setup(input_filename)
 
+    # The sentence transformer loads while the queries are built
+    model_manager.warm_up(model.load_st_model)
     if config.SEARCH_WORD_MODE == 'SPACY':
         spacy_model = search_utils.load_spacy_model()
     else:
         spacy_model = None
     questions_with_queries = a_query(curr_folder, questions, spacy_model)
 
-    st_model = SentenceTransformer("all-MiniLM-L6-v2")
-    a_ir(questions_with_queries, curr_folder, st_model)
+    st_model = model.load_st_model()
+    dense_index = load_dense_index()
+    hybrid_retriever = load_hybrid_retriever() if config.SEARCH_WORD_MODE == 'HYBRID' else None
+    a_ir(questions_with_queries, curr_folder, st_model, dense_index, hybrid_retriever)
 
-    retry_difficult_questions(curr_folder, st_model)
+    retry_difficult_questions(curr_folder, st_model, dense_index)
 
     prepare_phase_a_outputs(curr_folder, input_filename)
+    llm.print_llm_report()
+    if isinstance(st_model, CachedEncoder):
+        st_model.print_stats()
     
     return
 
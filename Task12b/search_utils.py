@@ -1,13 +1,60 @@
 # Copy from search/search-utils.py
-import spacy
+import io
+import os
+import time
 import requests
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from concurrency_utils import TokenBucket
+from article_store import ArticleStore
+import model_manager
+import baseline_index
 import config
 
+load_dotenv()
+
 MINDATE = '2000/01/01' # TODO: find a better starting date
 MAXDATE = '2024/01/01' # TODO: BioASQ 12b requires us to use PubMed 2024 annual baseline version.
                        # Setting the end date to 2024 is a good approximation?
 
+EUTILS_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils'
+# NCBI allows 3 requests per second without an API key, 10 with an API key
+NCBI_API_KEY = os.getenv('NCBI_API_KEY')
+NCBI_RATE_LIMITER = TokenBucket(10 if NCBI_API_KEY else 3, 1)
+NCBI_SESSION = requests.Session()
+NCBI_SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=config.NCBI_MAX_WORKERS))
+NCBI_EXECUTOR = ThreadPoolExecutor(max_workers=config.NCBI_MAX_WORKERS)
+# Articles fetched by previous questions and runs
+ARTICLE_STORE = ArticleStore(config.ARTICLE_STORE_PATH) if config.ENABLE_ARTICLE_STORE else None
+# Local index of the PubMed baseline, replaces ESearch and answers the article lookups
+BASELINE_INDEX = baseline_index.BaselineIndex(config.BASELINE_INDEX_PATH) if config.PUBMED_SEARCH_BACKEND == 'BASELINE' else None
+
+def make_eutils_request(endpoint, params, max_tries=3, stream=False):
+    '''
+    Send a rate limited POST request to the E-utilities endpoint. The parameters are sent in the
+    body, so a long id list doesn't hit the URL length limit. Retry on rate limit and server errors
+    '''
+    params = dict(params)
+    if NCBI_API_KEY:
+        params['api_key'] = NCBI_API_KEY
+    response = None
+    for attempt in range(max_tries):
+        NCBI_RATE_LIMITER.acquire()
+        try:
+            response = NCBI_SESSION.post(f'{EUTILS_URL}/{endpoint}', data=params, timeout=60, stream=stream)
+        except requests.RequestException as e:
+            print(f'E-utilities {endpoint} request failed: {e}')
+            response = None
+        if response is not None and response.status_code not in (429, 500, 502, 503, 504):
+            return response
+        if response is not None:
+            response.close()
+        if attempt + 1 < max_tries:
+            time.sleep(2 ** attempt)
+    return response
+
 def extract_entities(model, sentence):
     """Given a spacy model and a sentence, it extract medical entities and return as list of tuple [(text_extraction, entity), ...]"""
 
@@ -15,46 +62,43 @@ def extract_entities(model, sentence):
 
     return [(ent.text, ent.label_) for ent in doc.ents]
 
-def get_pmids(query_term, max_length=config.PUBMED_MAX_LENGTH, verbose=True):  
+def get_pmids(query_term, max_length=config.PUBMED_MAX_LENGTH, verbose=True):
     """Given a search term, query for relevant pubmed articles"""
-    base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
-    db_param = "db=pubmed"
-    retmax_param = f"retmax={max_length}"
-    term_param = f"term={query_term}"
-    date_range_param = f'mindate={MINDATE}&maxdate={MAXDATE}'
-    full_url = f"{base_url}?{db_param}&{term_param}&{retmax_param}&{date_range_param}"
-  
+    if BASELINE_INDEX is not None:
+        return BASELINE_INDEX.get_pmids(query_term, max_length, verbose, MINDATE, MAXDATE)
+    params = {'db': 'pubmed', 'term': query_term, 'retmax': max_length, 'mindate': MINDATE, 'maxdate': MAXDATE}
+
     if verbose:
-        print('Querying from ', full_url)
+        print('Querying from ', f'{EUTILS_URL}/esearch.fcgi', params)
     if config.INFO_TRACE:
         print('Query term: ', query_term)
 
     # Send the request
-    response = requests.get(full_url)
+    response = make_eutils_request('esearch.fcgi', params)
 
     # Check if the request was successful
-    if response.status_code == 200:
+    if response is not None and response.status_code == 200:
         # Parse the XML response
         root = ET.fromstring(response.content)
 
         # Extract PubMed IDs (PMIDs)
         pmids = [id_elem.text for id_elem in root.findall('.//IdList/Id')]
-        
+
         # Display the PMIDs
         if verbose:
             for pmid in pmids:
                 print("PMID:", pmid)
         return pmids
-    
+
     else:
-        print("Failed to retrieve data. Status code:", response.status_code)
+        print("Failed to retrieve data. Status code:", response.status_code if response is not None else None)
         return []
-    
+
 def formulate_query(kws, qbody=''):
     """Given a list of keywords, formulate a query term"""
     if not kws or len(kws) == 0:
         return qbody #fallback to qbody
-    
+
     return ' AND '.join(keyword.replace(' ', '+') for keyword in kws)
 
 def query_by_keywords(kws, max_length=10, verbose=True):
@@ -63,69 +107,155 @@ def query_by_keywords(kws, max_length=10, verbose=True):
     query_term = formulate_query(kws)
     return get_pmids(query_term, max_length, verbose)
 
-def query_by_pmids(pmids, verbose=True):
-    """Given a list of pmid, return a dictionary of the corresponding article title and abstract"""
-    # Construct the EFetch query
-    efetch_url = f"https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pubmed&id={','.join(pmids)}&retmode=xml"
+def get_article_item(article, verbose=True):
+    """Given a PubmedArticle element, return the article pmid, title and abstract"""
+    item = {}
+    # Direct child paths, a './/' search would scan the whole article (references, mesh terms, ...)
+    citation = article.find('MedlineCitation')
+    # Extract and display the PMID
+    pmid_elem = citation.find('PMID') if citation is not None else None
+    pmid = pmid_elem.text if pmid_elem is not None else ''
+    item['pmid'] = pmid
+    if verbose:
+        print("PMID:", pmid)
 
-    # Send the request
-    response = requests.get(efetch_url)
-    # print(response.content)
+    # Extract and display the article title
+    article_elem = citation.find('Article') if citation is not None else None
+    article_title_elem = article_elem.find('ArticleTitle') if article_elem is not None else None
+    article_title = article_title_elem.text if article_title_elem is not None else ''
+    item['title'] = article_title
+    if verbose:
+        print("Title:", article_title)
 
-    res = []
-    # Check if the request was successful
-    if response.status_code == 200:
-        # Parse the XML response
-        root = ET.fromstring(response.content)
-        # Iterate through each article in the response
-        for article in root.findall('.//PubmedArticle'):
-            item = {}
-            # Extract and display the PMID
-            pmid_elem = article.find('.//PMID')
-            pmid = pmid_elem.text if pmid_elem is not None else ''
-            item['pmid'] = pmid
-            if verbose:
-                print("PMID:", pmid)
+    # Extract and display the abstract
+    abstract_elem = article_elem.find('Abstract') if article_elem is not None else None
+    abstract_full_text = ''
+    abstract_list = []
+    if abstract_elem is not None and len(abstract_elem) > 0:
+        for abs_nested_ele in abstract_elem:
+            if abs_nested_ele.tag == 'AbstractText':
+                # NLM uses all uppercase letters followed by a colon and space for the labels
+                # that appear in structured abstracts in MEDLINE/PubMed® citations
+                if abs_nested_ele.attrib and ('Label' in abs_nested_ele.attrib):
+                    abstract_full_text += abs_nested_ele.attrib['Label'] + ': '
+                if abs_nested_ele.text:
+                    abstract_full_text += (abs_nested_ele.text)
+                    abstract_list.append(abs_nested_ele.text)
+                else:
+                    for ele_next in abs_nested_ele.itertext():
+                        abstract_full_text += ele_next
+                        abstract_list.append(ele_next)
 
-            # Extract and display the article title
-            article_title_elem = article.find('.//ArticleTitle')
-            article_title = article_title_elem.text if article_title_elem is not None else ''
-            item['title'] = article_title
-            if verbose:
-                print("Title:", article_title)
-
-            # Extract and display the abstract
-            abstract_elem = article.find('.//Abstract')
-            abstract_full_text = ''
-            abstract_list = []
-            if abstract_elem:
-                for abs_nested_ele in abstract_elem:
-                    if abs_nested_ele.tag == 'AbstractText':
-                        # NLM uses all uppercase letters followed by a colon and space for the labels
-                        # that appear in structured abstracts in MEDLINE/PubMed® citations 
-                        if abs_nested_ele.attrib and ('Label' in abs_nested_ele.attrib):
-                            abstract_full_text += abs_nested_ele.attrib['Label'] + ': '
-                        if abs_nested_ele.text:
-                            abstract_full_text += (abs_nested_ele.text)
-                            abstract_list.append(abs_nested_ele.text)
-                        else:
-                            for ele_next in abs_nested_ele.itertext():
-                                abstract_full_text += ele_next
-                                abstract_list.append(ele_next)
-
-            item['abstract_raw'] = abstract_full_text
-            item['abstract_list'] = abstract_list
-            if verbose:
-                print("Abstract:", abstract_full_text)
-                print("\n" + "-"*80 + "\n")
-
-            res.append(item)
-    else:
-        print("Failed to retrieve data. Status code:", response.status_code)
-    return res
+    item['abstract_raw'] = abstract_full_text
+    item['abstract_list'] = abstract_list
+    if verbose:
+        print("Abstract:", abstract_full_text)
+        print("\n" + "-"*80 + "\n")
+    return item
+
+def iter_pubmed_articles(source, verbose=True):
+    """
+    Given a file object of the EFetch XML response, yield the articles while the response is read.
+    The parsed elements are cleared, so the memory doesn't grow with the number of articles
+    """
+    root = None
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            continue
+        if elem.tag == 'PubmedArticle':
+            yield get_article_item(elem, verbose)
+            root.clear()
+
+def parse_pubmed_articles(content, verbose=True):
+    """Given the EFetch XML response, return the list of article pmid, title and abstract"""
+    return list(iter_pubmed_articles(io.BytesIO(content), verbose))
+
+def stream_pmid_chunk(pmids, verbose=True):
+    """EFetch one chunk of pmids, yield the articles while they are downloaded"""
+    response = make_eutils_request('efetch.fcgi', {'db': 'pubmed', 'id': ','.join(pmids), 'retmode': 'xml'}, stream=True)
+    if response is None or response.status_code != 200:
+        print("Failed to retrieve data. Status code:", response.status_code if response is not None else None)
+        return
+    try:
+        response.raw.decode_content = True # let urllib3 undo the gzip transfer encoding
+        yield from iter_pubmed_articles(response.raw, verbose)
+    finally:
+        response.close()
+
+def fetch_pmid_chunk(pmids, verbose=True):
+    """EFetch one chunk of pmids, return the list of articles"""
+    return list(stream_pmid_chunk(pmids, verbose))
+
+def get_local_articles(pmids):
+    """Return the articles found in BASELINE_INDEX and ARTICLE_STORE, without any request"""
+    articles = BASELINE_INDEX.get_articles(pmids) if BASELINE_INDEX is not None else {}
+    missing_pmids = [pmid for pmid in pmids if pmid not in articles]
+    if ARTICLE_STORE is not None and len(missing_pmids) > 0:
+        articles.update(ARTICLE_STORE.get_many(missing_pmids))
+    return articles
+
+def fetch_articles(pmids, verbose=True):
+    """
+    Given a list of pmid, return a dictionary with the pmid as key and the article as value.
+    The articles in BASELINE_INDEX or ARTICLE_STORE are not fetched again, the others are fetched in chunks of
+    EFETCH_CHUNK_SIZE, the chunks run concurrently
+    """
+    unique_pmids = list(dict.fromkeys(pmids))
+    articles = get_local_articles(unique_pmids)
+    missing_pmids = [pmid for pmid in unique_pmids if pmid not in articles]
+    chunk_size = config.EFETCH_CHUNK_SIZE
+    chunks = [missing_pmids[start:start + chunk_size] for start in range(0, len(missing_pmids), chunk_size)]
+    fetched = []
+    for chunk_res in NCBI_EXECUTOR.map(lambda chunk: fetch_pmid_chunk(chunk, verbose), chunks):
+        fetched.extend(chunk_res)
+    for item in fetched:
+        articles[item['pmid']] = item
+    if ARTICLE_STORE is not None and len(fetched) > 0:
+        ARTICLE_STORE.put_many(fetched)
+    if config.INFO_TRACE:
+        print(f'Articles: {len(unique_pmids) - len(missing_pmids)} from the store, {len(fetched)} fetched')
+    return articles
+
+def iter_articles_by_pmids(pmids, verbose=True):
+    """
+    Given a list of pmid, yield the articles in pmid order as soon as they are read from BASELINE_INDEX,
+    ARTICLE_STORE or the EFetch response, so the first article can be processed before the download finishes
+    """
+    unique_pmids = list(dict.fromkeys(pmids))
+    stored = get_local_articles(unique_pmids)
+    chunk_size = config.EFETCH_CHUNK_SIZE
+    for start in range(0, len(unique_pmids), chunk_size):
+        chunk = unique_pmids[start:start + chunk_size]
+        ready = {pmid: stored[pmid] for pmid in chunk if pmid in stored}
+        missing_pmids = [pmid for pmid in chunk if pmid not in stored]
+        fetched = []
+        ind = 0
+        while ind < len(chunk) and chunk[ind] in ready:
+            yield ready.pop(chunk[ind])
+            ind += 1
+        if len(missing_pmids) > 0:
+            for item in stream_pmid_chunk(missing_pmids, verbose):
+                fetched.append(item)
+                ready[item['pmid']] = item
+                while ind < len(chunk) and chunk[ind] in ready:
+                    yield ready.pop(chunk[ind])
+                    ind += 1
+        # The pmids not found by EFetch are skipped
+        for pmid in chunk[ind:]:
+            if pmid in ready:
+                yield ready.pop(pmid)
+        if ARTICLE_STORE is not None and len(fetched) > 0:
+            ARTICLE_STORE.put_many(fetched)
+
+def query_by_pmids(pmids, verbose=True):
+    """Given a list of pmid, return the list of the corresponding article title and abstract in pmid order"""
+    articles = fetch_articles(pmids, verbose)
+    return [articles[pmid] for pmid in dict.fromkeys(pmids) if pmid in articles]
 
 def load_spacy_model():
-    return spacy.load("en_ner_bc5cdr_md")
+    return model_manager.get_spacy_model("en_ner_bc5cdr_md")
 
 if __name__ == '__main__':
     model = load_spacy_model()
@@ -136,5 +266,3 @@ if __name__ == '__main__':
 
     pmids = query_by_keywords([t[0] for t in res])
     res = query_by_pmids(pmids)
-
-
@@ -0,0 +1,67 @@
+'''
+Second stage of the snippet extraction: a cross encoder reranks the best bi-encoder sentences of
+all articles of a question. The candidates are scored in batches, best bi-encoder score first, until
+the latency budget of the question is spent; the candidates left keep the bi-encoder order after
+the reranked ones. Several snippets of an article can be selected when they score well.
+'''
+import time
+import model_manager
+import config
+
+class SnippetReranker:
+    def __init__(self, cross_encoder, batch_size=config.RERANK_BATCH_SIZE, latency_budget=config.RERANK_LATENCY_BUDGET,
+                 clock=time.monotonic):
+        self.cross_encoder = cross_encoder
+        self.batch_size = batch_size
+        self.latency_budget = latency_budget # seconds per question, 0 for no limit
+        self.clock = clock
+        self.stats = {'scored': 0, 'skipped': 0}
+
+    def rerank(self, qbody, candidates):
+        '''
+        Given candidates [(bi_score, sentence, ...)], return them in cross encoder order, the
+        candidates not scored within the budget follow in bi-encoder order
+        '''
+        candidates = sorted(candidates, key=lambda cand: -cand[0])
+        start_time = self.clock()
+        scored = []
+        ind = 0
+        while ind < len(candidates):
+            if self.latency_budget > 0 and self.clock() - start_time > self.latency_budget:
+                break
+            batch = candidates[ind:ind + self.batch_size]
+            scores = self.cross_encoder.predict([(qbody, cand[1]) for cand in batch], batch_size=self.batch_size)
+            scored.extend(zip([float(score) for score in scores], range(ind, ind + len(batch))))
+            ind += len(batch)
+        self.stats['scored'] += ind
+        self.stats['skipped'] += len(candidates) - ind
+        if config.INFO_TRACE and ind < len(candidates):
+            print(f'Snippet rerank over budget, {len(candidates) - ind} of {len(candidates)} candidates keep the bi-encoder order')
+        # Ties keep the bi-encoder order
+        scored.sort(key=lambda score_ind: (-score_ind[0], score_ind[1]))
+        return [candidates[cand_ind] for _, cand_ind in scored] + candidates[ind:]
+
+    def select(self, qbody, candidates, max_snippets=config.RERANK_MAX_SNIPPETS, max_per_article=config.RERANK_MAX_PER_ARTICLE):
+        '''
+        Given candidates [(bi_score, sentence, pmid, ...)], rerank the RERANK_CANDIDATES best ones and
+        return at most max_snippets of them, with at most max_per_article per pmid
+        '''
+        candidates = sorted(candidates, key=lambda cand: -cand[0])[:config.RERANK_CANDIDATES]
+        selected = []
+        article_cnt = {}
+        for cand in self.rerank(qbody, candidates):
+            pmid = cand[2]
+            if article_cnt.get(pmid, 0) >= max_per_article:
+                continue
+            article_cnt[pmid] = article_cnt.get(pmid, 0) + 1
+            selected.append(cand)
+            if len(selected) == max_snippets:
+                break
+        return selected
+
+def get_reranker():
+    '''Return the shared snippet reranker of SNIP_RERANK_MODE, the cross encoder is loaded on first use'''
+    if config.SNIP_RERANK_MODE == 'OFF':
+        return None
+    return model_manager.get_model(('snippet_reranker', config.CROSS_ENCODER_MODEL),
+        lambda: SnippetReranker(model_manager.get_cross_encoder(config.CROSS_ENCODER_MODEL)))
@@ -5,22 +5,40 @@ import requests
 import json
 import time
 import datetime
+import threading
+from requests.adapters import HTTPAdapter
 from tokens import * 
 from prompt_utils import query_expansion_prompt, synonym_grouping_prompt
 import re
-from openai import OpenAI
 from dotenv import load_dotenv
 from ast import literal_eval
+from concurrency_utils import TokenBucket
+from llm_cache import LLMCache, LLMCacheMiss
+from llm_replay import LLMRecorder, LLMReplay, get_empty_response
 import config
 
 load_dotenv()
 
 URL = 'https://api.textsynth.com'
 PROXY_CNT = 0
+PROXY_LOCK = threading.Lock()
 QA_PROXY = {}
 with open(f'cache/{config.QA_PROXY_CACHE_PATH}', "r") as proxy_cache_file:
     QA_PROXY = json.load(proxy_cache_file)
 
+# Concurrency limits of the TextSynth requests, shared by all threads of the process
+LLM_SESSION = requests.Session()
+LLM_SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=config.LLM_MAX_IN_FLIGHT))
+LLM_IN_FLIGHT = threading.BoundedSemaphore(config.LLM_MAX_IN_FLIGHT)
+LLM_RATE_LIMITER = TokenBucket(config.LLM_RATE_LIMIT, config.LLM_RATE_BURST)
+
+# Every request is recorded, the REPLAY backend serves the recorded responses instead of the LLM
+LLM_RECORDER = LLMRecorder(config.LLM_HISTORY_PATH, config.LLM_HISTORY_MAX_BYTES,
+    config.LLM_HISTORY_BACKUP_COUNT, config.LLM_HISTORY_COMPRESS)
+LLM_REPLAY = LLMReplay(config.LLM_REPLAY_PATH) if config.LLM_BACKEND == 'REPLAY' else None
+
+LLM_CACHE = LLMCache(config.LLM_CACHE_PATH, config.LLM_CACHE_MODE, config.LLM_CACHE_TTL, config.LLM_CACHE_MAX_ENTRIES)
+
 def use_llm_proxy(orig_question):
     result = {}
     qtype = orig_question.type
@@ -36,31 +54,52 @@ def use_llm_proxy(orig_question):
     if qid in QA_PROXY:
         potential_ans_sz = len(QA_PROXY[qid])
         global PROXY_CNT
-        result['text'] = QA_PROXY[qid][PROXY_CNT % potential_ans_sz]
-        PROXY_CNT += 1
+        with PROXY_LOCK:
+            result['text'] = QA_PROXY[qid][PROXY_CNT % potential_ans_sz]
+            PROXY_CNT += 1
     result['reached_end'] = True
     result['input_tokens'] = 63
     result['output_tokens'] = 3
     result['finish_reason'] = 'length'
     return result
 
+def cached_llm_request(engine, params, request_fn):
+    '''
+    Return the response of the request through LLM_CACHE. A request missing from a READ_ONLY cache
+    isn't sent, it gets an empty completion and is listed in the cache report
+    '''
+    if LLM_REPLAY is not None:
+        # The replay answers every request itself: caching its empty completions of the requests
+        # without recording would serve them to later live runs, and cache hits would hide them from the report
+        return request_fn()
+    try:
+        return LLM_CACHE.cached_call(engine, params, request_fn)
+    except LLMCacheMiss:
+        return get_empty_response(engine, params)
+
 def make_textsynth_request(model, query_param):
+    return cached_llm_request(f'textsynth:{model}', query_param, lambda: post_textsynth_request(model, query_param))
+
+def post_textsynth_request(model, query_param):
     path = f"/v1/engines/{model}/completions"
-    response = requests.post(URL + path,
-        headers = { "Authorization": f"Bearer {TEXTSYNTH_TOKEN}"},
-        json = query_param)
-    
-    with open('logs/llm_history.txt', "a") as llm_log_file:
-        llm_log_file.write(f"\n# {datetime.datetime.now()}\n")
-        llm_log_file.write(f'{URL + path}\n')
-        json.dump(query_param, llm_log_file, indent=2)
-        llm_log_file.write('\nResponse\n')
-        json.dump(response.json(), llm_log_file, indent=2)
+    if LLM_REPLAY is not None:
+        return LLM_REPLAY.get(URL + path, query_param)
+    LLM_RATE_LIMITER.acquire()
+    with LLM_IN_FLIGHT:
+        response = LLM_SESSION.post(URL + path,
+            headers = { "Authorization": f"Bearer {TEXTSYNTH_TOKEN}"},
+            json = query_param)
+
+    try:
+        response_json = response.json()
+    except ValueError:
+        response_json = None
+    LLM_RECORDER.record(URL + path, query_param, response.status_code, response_json)
         
     if response.status_code != 200:
         print("Request error:", response.text)
         sys.exit(1)
-    return response.json()
+    return response_json
 
 
 def textsynth_completion(model, query_param, task, fake_llm=True, orig_question=None):
@@ -80,6 +119,28 @@ def textsynth_completion(model, query_param, task, fake_llm=True, orig_question=
 
     return make_textsynth_request(model, query_param)
 
+def openai_chat_completion(params_chat):
+    '''Return the message content of the OpenAI chat completion, the responses go through LLM_CACHE'''
+    url = f"openai:{params_chat['model']}"
+    def _request():
+        if LLM_REPLAY is not None:
+            return LLM_REPLAY.get(url, params_chat)
+        from openai import OpenAI # imported on use, the package takes most of the import time of this module
+        client = OpenAI()
+        response = client.chat.completions.create(
+            **params_chat
+        )
+        res = {'content': response.choices[0].message.content}
+        LLM_RECORDER.record(url, params_chat, 200, res)
+        return res
+    return cached_llm_request(url, params_chat, _request)['content']
+
+def print_llm_report():
+    '''Print the LLM cache and replay statistics of the run'''
+    LLM_CACHE.print_stats()
+    if LLM_REPLAY is not None:
+        LLM_REPLAY.print_report()
+
 def group_synonym_entity(entity_str):
     '''Group the synonyms in the entity string together'''
     query_param = {
@@ -107,7 +168,6 @@ def query_expansion(question, fake_llm=True, model_name="MIXTRAL_47B"):
         return response['text']
     else:
         # use GPT
-        client = OpenAI()
         model_name = config.OPENAI_MODEL_NAME
         params_chat = {
             "model": model_name, # model name
@@ -121,18 +181,13 @@ def query_expansion(question, fake_llm=True, model_name="MIXTRAL_47B"):
             "frequency_penalty": 0.5, # discourage repetition of words or phrases
             "presence_penalty": 0.1, # discourage new topics or entities
         }
-        response = client.chat.completions.create(
-            **params_chat
-        )
-        
-        return response.choices[0].message.content
+        return openai_chat_completion(params_chat)
 
 def query_expansion_retry(question, original_query, fake_llm):
     if fake_llm:
         return question # We just let the model query the original question
     
     # use GPT
-    client = OpenAI()
     model_name = config.OPENAI_MODEL_NAME
 
     params_chat = {
@@ -151,18 +206,13 @@ def query_expansion_retry(question, original_query, fake_llm):
         "presence_penalty": 0.2, # discourage new topics or entities
     }
     
-    response = client.chat.completions.create(
-        **params_chat
-    )
-    
-    return response.choices[0].message.content
+    return openai_chat_completion(params_chat)
 
 def query_expansion_last_try(question, fake_llm):
     if fake_llm:
         return question # We just let the model query the original question
     
       # use GPT
-    client = OpenAI()
     model_name = config.OPENAI_MODEL_NAME
 
     params_chat = {
@@ -183,11 +233,7 @@ def query_expansion_last_try(question, fake_llm):
         "presence_penalty": 0.2, # discourage new topics or entities
     }
     
-    response = client.chat.completions.create(
-        **params_chat
-    )
-    
-    res = response.choices[0].message.content
+    res = openai_chat_completion(params_chat)
     try:
         l = literal_eval(res)
         if isinstance(l, list):
@@ -256,8 +256,629 @@ def test_postproc_predict():
     print('\nList answer')
     print(ans)
 
+def test_token_bucket():
+    import time
+    from concurrency_utils import TokenBucket
+    bucket = TokenBucket(rate=20, capacity=2)
+    start = time.monotonic()
+    for _ in range(4):
+        bucket.acquire()
+    # The burst of 2 passes right away, the next 2 wait for the refill at 20 per second
+    assert time.monotonic() - start >= 0.09
+
+def test_llm_cache():
+    import os
+    import tempfile
+    from llm_cache import LLMCache, LLMCacheMiss
+    db_file = os.path.join(tempfile.mkdtemp(), 'llm_cache.sqlite')
+    calls = []
+    def _request():
+        calls.append(1)
+        return {'text': f'answer {len(calls)}'}
+    cache = LLMCache(db_file, 'DETERMINISTIC', max_entries=2)
+    greedy = {'prompt': 'q1', 'max_tokens': 10, 'temperature': 0}
+    sampled = {'prompt': 'q1', 'max_tokens': 10}
+    assert cache.cached_call('textsynth:mistral_7B', greedy, _request) == {'text': 'answer 1'}
+    assert cache.cached_call('textsynth:mistral_7B', dict(reversed(greedy.items())), _request) == {'text': 'answer 1'}
+    assert cache.cached_call('textsynth:llama2_7B', greedy, _request) == {'text': 'answer 2'}
+    # Sampled requests aren't cached in DETERMINISTIC mode
+    cache.cached_call('textsynth:mistral_7B', sampled, _request)
+    cache.cached_call('textsynth:mistral_7B', sampled, _request)
+    assert len(calls) == 4
+    # The least recently used entry is evicted
+    cache.cached_call('textsynth:mistral_7B', {**greedy, 'prompt': 'q2'}, _request)
+    assert cache.cached_call('textsynth:llama2_7B', greedy, _request) == {'text': 'answer 2'}
+    assert cache.cached_call('textsynth:mistral_7B', greedy, _request) == {'text': 'answer 6'}
+    # READ_ONLY replays the stored responses, a request not cached is never sent
+    replay = LLMCache(db_file, 'READ_ONLY')
+    assert replay.cached_call('textsynth:mistral_7B', greedy, _request) == {'text': 'answer 6'}
+    call_cnt = len(calls)
+    for _ in range(2):
+        try:
+            replay.cached_call('textsynth:mistral_7B', {**greedy, 'prompt': 'q3'}, _request)
+            assert False, 'READ_ONLY miss must raise'
+        except LLMCacheMiss:
+            pass
+    assert len(calls) == call_cnt
+    assert replay.stats == {'hit': 1, 'miss': 2}
+    assert replay.missing == [('textsynth:mistral_7B', 'q3')] * 2
+    # The caller answers the miss with an empty completion
+    import textsynth_api
+    orig_cache = textsynth_api.LLM_CACHE
+    textsynth_api.LLM_CACHE = replay
+    try:
+        assert textsynth_api.cached_llm_request('textsynth:mistral_7B', {'prompt': 'q4', 'temperature': 0}, _request)['text'] == ''
+        assert textsynth_api.cached_llm_request('openai:gpt-4', {'messages': []}, _request) == {'content': ''}
+    finally:
+        textsynth_api.LLM_CACHE = orig_cache
+    assert len(calls) == call_cnt
+
+def test_llm_replay():
+    import os
+    import tempfile
+    from llm_replay import LLMRecorder, LLMReplay
+    log_path = os.path.join(tempfile.mkdtemp(), 'llm_history.jsonl')
+    url = 'https://api.textsynth.com/v1/engines/mistral_7B/completions'
+    recorder = LLMRecorder(log_path)
+    recorder.record(url, {'prompt': 'q1', 'n': 2}, 200, {'text': ['a1', 'a2']})
+    recorder.record(url, {'prompt': 'q2'}, 200, {'text': 'first'})
+    recorder.record(url, {'prompt': 'q2'}, 200, {'text': 'second'})
+    recorder.record(url, {'prompt': 'q3'}, 500, None)
+    recorder.close()
+    replay = LLMReplay(log_path)
+    assert replay.get(url, {'n': 2, 'prompt': 'q1'}) == {'text': ['a1', 'a2']}
+    assert replay.get(url, {'prompt': 'q2'})['text'] == 'first'
+    assert replay.get(url, {'prompt': 'q2'})['text'] == 'second'
+    # Failed requests aren't replayed, a request without recording gets an empty completion
+    assert replay.get(url, {'prompt': 'q3'})['text'] == ''
+    assert replay.get('openai:gpt-4', {'messages': []}) == {'content': ''}
+    assert replay.stats == {'hit': 3, 'miss': 2}
+    replay.print_report()
+
+def test_llm_replay_bypasses_cache():
+    import os
+    import tempfile
+    import textsynth_api
+    from llm_cache import LLMCache
+    from llm_replay import LLMRecorder, LLMReplay
+    tmp_dir = tempfile.mkdtemp()
+    log_path = os.path.join(tmp_dir, 'llm_history.jsonl')
+    recorder = LLMRecorder(log_path)
+    recorder.record(textsynth_api.URL + '/v1/engines/mistral_7B/completions', {'prompt': 'q1', 'temperature': 0}, 200, {'text': 'a1'})
+    recorder.close()
+    cache = LLMCache(os.path.join(tmp_dir, 'llm_cache.sqlite'), 'DETERMINISTIC')
+    replay = LLMReplay(log_path)
+    orig_cache, orig_replay = textsynth_api.LLM_CACHE, textsynth_api.LLM_REPLAY
+    textsynth_api.LLM_CACHE, textsynth_api.LLM_REPLAY = cache, replay
+    try:
+        for _ in range(2):
+            assert textsynth_api.make_textsynth_request('mistral_7B', {'prompt': 'q1', 'temperature': 0})['text'] == 'a1'
+            assert textsynth_api.make_textsynth_request('mistral_7B', {'prompt': 'q2', 'temperature': 0})['text'] == ''
+            assert textsynth_api.openai_chat_completion({'model': 'gpt-4', 'messages': [], 'temperature': 0}) == ''
+    finally:
+        textsynth_api.LLM_CACHE, textsynth_api.LLM_REPLAY = orig_cache, orig_replay
+    # Every request reaches the replay report and nothing is stored for the later live runs
+    assert replay.stats == {'hit': 2, 'miss': 4}
+    assert cache.stats == {'hit': 0, 'miss': 0}
+    assert cache.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0] == 0
+
+def test_llm_recorder_rotation():
+    import os
+    import tempfile
+    from llm_replay import LLMRecorder, LLMReplay
+    log_path = os.path.join(tempfile.mkdtemp(), 'llm_history.jsonl')
+    url = 'https://api.textsynth.com/v1/engines/mistral_7B/completions'
+    recorder = LLMRecorder(log_path, max_bytes=300, backup_count=2, compress=True)
+    for ind in range(10):
+        request = {'prompt': f'q{ind}'}
+        recorder.record(url, request, 200, {'text': f'a{ind}'})
+        request['prompt'] = 'changed after the record'
+        recorder.flush()
+    recorder.close()
+    assert os.path.exists(log_path + '.1.gz') and os.path.exists(log_path + '.2.gz')
+    assert not os.path.exists(log_path + '.3.gz')
+    # The replay reads the rotated logs too, the oldest ones were removed
+    replay = LLMReplay(log_path)
+    assert replay.get(url, {'prompt': 'q9'})['text'] == 'a9'
+    assert replay.get(url, {'prompt': 'q0'})['text'] == ''
+
+def test_query_by_pmids_chunks():
+    import config
+    import search_utils
+    chunks = []
+    def _fetch_pmid_chunk(pmids, verbose=True):
+        chunks.append(pmids)
+        # EFetch doesn't keep the order of the ids, and skips the unknown ones
+        return [{'pmid': pmid, 'title': f'title {pmid}'} for pmid in reversed(pmids) if pmid != '404']
+    orig_fetch, orig_chunk_size, orig_store = search_utils.fetch_pmid_chunk, config.EFETCH_CHUNK_SIZE, search_utils.ARTICLE_STORE
+    search_utils.fetch_pmid_chunk, config.EFETCH_CHUNK_SIZE, search_utils.ARTICLE_STORE = _fetch_pmid_chunk, 2, None
+    try:
+        articles = search_utils.query_by_pmids(['5', '3', '404', '3', '1', '2'], verbose=False)
+    finally:
+        search_utils.fetch_pmid_chunk, config.EFETCH_CHUNK_SIZE, search_utils.ARTICLE_STORE = orig_fetch, orig_chunk_size, orig_store
+    assert sorted(chunks) == [['2'], ['404', '1'], ['5', '3']]
+    assert [article['pmid'] for article in articles] == ['5', '3', '1', '2']
+
+def test_parse_pubmed_articles():
+    import io
+    import search_utils
+    xml = b'''<?xml version="1.0" ?>
+    <PubmedArticleSet>
+    <PubmedArticle><MedlineCitation><PMID Version="1">123</PMID><Article>
+        <ArticleTitle>Title one</ArticleTitle><Abstract>
+        <AbstractText Label="BACKGROUND">First part.</AbstractText><AbstractText>Second part.</AbstractText>
+        </Abstract></Article>
+        <CommentsCorrectionsList><CommentsCorrections><PMID Version="1">999</PMID></CommentsCorrections></CommentsCorrectionsList>
+        </MedlineCitation></PubmedArticle>
+    <PubmedArticle><MedlineCitation><PMID Version="1">456</PMID><Article>
+        <ArticleTitle>Title two</ArticleTitle><Abstract><AbstractText><b>Bold</b> text</AbstractText></Abstract>
+        </Article></MedlineCitation></PubmedArticle>
+    <PubmedArticle><MedlineCitation><PMID Version="1">789</PMID><Article>
+        <ArticleTitle>No abstract</ArticleTitle></Article></MedlineCitation></PubmedArticle>
+    </PubmedArticleSet>'''
+    articles = search_utils.parse_pubmed_articles(xml, verbose=False)
+    assert articles == [
+        {'pmid': '123', 'title': 'Title one', 'abstract_raw': 'BACKGROUND: First part.Second part.',
+            'abstract_list': ['First part.', 'Second part.']},
+        {'pmid': '456', 'title': 'Title two', 'abstract_raw': 'Bold text', 'abstract_list': ['Bold', ' text']},
+        {'pmid': '789', 'title': 'No abstract', 'abstract_raw': '', 'abstract_list': []}]
+    # The generator yields an article before the rest of the response is read
+    article_xml = b'<PubmedArticle><MedlineCitation><PMID>1</PMID><Article><ArticleTitle>T</ArticleTitle></Article></MedlineCitation></PubmedArticle>'
+    large_xml = b'<PubmedArticleSet>' + article_xml * 5000 + b'</PubmedArticleSet>'
+    source = io.BytesIO(large_xml)
+    article_iter = search_utils.iter_pubmed_articles(source, verbose=False)
+    assert next(article_iter)['pmid'] == '1'
+    assert source.tell() < len(large_xml)
+    assert sum(1 for _ in article_iter) == 4999
+
+def test_iter_articles_by_pmids():
+    import search_utils
+    events = []
+    def _stream_pmid_chunk(pmids, verbose=True):
+        for pmid in ['3', '1', '2']:
+            events.append(f'download {pmid}')
+            yield {'pmid': pmid, 'title': f'title {pmid}', 'abstract_raw': '', 'abstract_list': []}
+    orig_stream, orig_store = search_utils.stream_pmid_chunk, search_utils.ARTICLE_STORE
+    search_utils.stream_pmid_chunk, search_utils.ARTICLE_STORE = _stream_pmid_chunk, None
+    try:
+        for article in search_utils.iter_articles_by_pmids(['3', '2', '1'], verbose=False):
+            events.append(f'use {article["pmid"]}')
+    finally:
+        search_utils.stream_pmid_chunk, search_utils.ARTICLE_STORE = orig_stream, orig_store
+    # The articles are yielded in pmid order as soon as the preceding ones are available
+    assert events == ['download 3', 'use 3', 'download 1', 'download 2', 'use 2', 'use 1']
+
+def test_article_store():
+    import os
+    import tempfile
+    import search_utils
+    from article_store import ArticleStore
+    store = ArticleStore(os.path.join(tempfile.mkdtemp(), 'articles.sqlite'))
+    store.put_many([{'pmid': '1', 'title': 'cached', 'abstract_raw': 'a b', 'abstract_list': ['a', 'b']}])
+    fetched = []
+    def _fetch_pmid_chunk(pmids, verbose=True):
+        fetched.extend(pmids)
+        return [{'pmid': pmid, 'title': f'title {pmid}', 'abstract_raw': '', 'abstract_list': []} for pmid in pmids]
+    orig_fetch, orig_store = search_utils.fetch_pmid_chunk, search_utils.ARTICLE_STORE
+    search_utils.fetch_pmid_chunk, search_utils.ARTICLE_STORE = _fetch_pmid_chunk, store
+    try:
+        articles = search_utils.query_by_pmids(['2', '1'], verbose=False)
+        assert [article['title'] for article in articles] == ['title 2', 'cached']
+        assert articles[1]['abstract_list'] == ['a', 'b']
+        # The second query is answered from the store
+        search_utils.query_by_pmids(['1', '2'], verbose=False)
+    finally:
+        search_utils.fetch_pmid_chunk, search_utils.ARTICLE_STORE = orig_fetch, orig_store
+    assert fetched == ['2']
+    assert store.count() == 2
+
+def test_baseline_index():
+    import gzip
+    import os
+    import shutil
+    import tempfile
+    import baseline_index
+    tmp_dir = tempfile.mkdtemp()
+    # The update file replaces an article of the baseline file
+    update_path = os.path.join(tmp_dir, 'pubmed24n0002.xml.gz')
+    with gzip.open(update_path, 'wt') as update_file:
+        update_file.write('''<PubmedArticleSet><PubmedArticle><MedlineCitation><PMID Version="2">10000006</PMID><Article>
+            <Journal><JournalIssue><PubDate><Year>2012</Year><Month>Oct</Month></PubDate></JournalIssue></Journal>
+            <ArticleTitle>Enteric neural crest cells in Hirschsprung disease.</ArticleTitle></Article>
+            </MedlineCitation></PubmedArticle></PubmedArticleSet>''')
+    baseline_path = os.path.join(tmp_dir, 'pubmed24n0001.xml')
+    shutil.copy('input/pubmed24n_sample.xml', baseline_path)
+    index_path = os.path.join(tmp_dir, 'baseline.sqlite')
+    baseline_index.ingest_files([baseline_path, update_path], index_path)
+    # An ingested file is skipped
+    baseline_index.ingest_files([baseline_path], index_path)
+    index = baseline_index.BaselineIndex(index_path)
+    # 10000002 (1998) and 10000004 (2024) are out of the date range, 10000005 was deleted
+    pmids = index.get_pmids('Hirschsprung disease', verbose=False)
+    assert sorted(pmids) == ['10000001', '10000006']
+    assert sorted(index.get_pmids('Hirschsprung disease', verbose=False, mindate='1990/01/01', maxdate='2030/01/01')) == \
+        ['10000001', '10000002', '10000004', '10000006']
+    assert index.get_pmids('(RET[Gene] OR RET+proto-oncogene) AND "Hirschsprung disease"', verbose=False) == ['10000001']
+    assert index.get_pmids('Duchenne NOT osteoporosis', verbose=False) == []
+    # Malformed queries match any of their terms
+    assert index.get_pmids('osteoporosis AND (', verbose=False) == ['10000003']
+    assert index.get_pmids('"', verbose=False) == []
+    articles = index.get_articles(['10000003', '10000005', 'abc'])
+    assert list(articles) == ['10000003']
+    assert articles['10000003']['abstract_list'] == ['Osteoporosis and fractures are frequent in boys with Duchenne muscular dystrophy treated with glucocorticoids.']
+    assert baseline_index.to_fts_query('Duchenne+muscular+dystrophy[MeSH Terms] AND bone*') == '"Duchenne" "muscular" "dystrophy" AND "bone"*'
+
+class FakeEncoder:
+    '''Bag of words sentence encoder over a small vocabulary, in place of the sentence transformer'''
+    vocab = ['hirschsprung', 'ret', 'duchenne', 'bone', 'crest']
+    def get_sentence_embedding_dimension(self):
+        return len(self.vocab)
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False):
+        import numpy as np
+        single = isinstance(sentences, str)
+        vectors = np.array([[sentence.lower().count(word) for word in self.vocab] for sentence in ([sentences] if single else sentences)], dtype=np.float32)
+        if normalize_embeddings:
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors[0] if single else vectors
+
+def test_dense_index():
+    import os
+    import tempfile
+    import numpy as np
+    import dense_index
+    from article_store import ArticleStore
+    tmp_dir = tempfile.mkdtemp()
+    store = ArticleStore(os.path.join(tmp_dir, 'articles.sqlite'))
+    store.put_many([
+        {'pmid': '1', 'title': 'Hirschsprung disease', 'abstract_raw': 'RET mutations in Hirschsprung disease', 'abstract_list': []},
+        {'pmid': '2', 'title': 'Duchenne', 'abstract_raw': 'Bone health in Duchenne', 'abstract_list': []},
+        {'pmid': '3', 'title': 'Neural crest', 'abstract_raw': 'Enteric neural crest and Hirschsprung', 'abstract_list': []}])
+    collection_path = os.path.join(tmp_dir, 'articles.jsonl')
+    assert dense_index.export_article_store(os.path.join(tmp_dir, 'articles.sqlite'), collection_path) == 3
+    st_model = FakeEncoder()
+    index_dir = os.path.join(tmp_dir, 'dense_index')
+    assert dense_index.build_index(collection_path, index_dir, st_model, model_name='fake', batch_size=2) == 3
+    # A small block size checks the top-k merge across blocks
+    index = dense_index.DenseIndex(index_dir, block_size=2)
+    assert index.meta == {'model': 'fake', 'dim': 5, 'count': 3}
+    assert index.embeddings.dtype == np.float16
+    assert index.get_pmids(st_model, 'What causes Hirschsprung disease? Is RET involved?', top_k=2) == ['1', '3']
+    assert index.get_pmids(st_model, 'Duchenne bone fractures', top_k=1) == ['2']
+    results = index.search(st_model.encode('crest'), top_k=10)
+    assert [pmid for pmid, _ in results] == ['3', '1', '2'] and abs(results[0][1] - 2 / np.sqrt(5)) < 1e-3
+
+def test_hybrid_search():
+    import json
+    import os
+    import tempfile
+    import hybrid_search
+    assert hybrid_search.reciprocal_rank_fusion([['a', 'b', 'c'], ['c', 'd', 'a']], k=60) == ['a', 'c', 'b', 'd']
+    assert hybrid_search.reciprocal_rank_fusion([['a', 'b'], []], k=60, top_k=1) == ['a']
+    tmp_dir = tempfile.mkdtemp()
+    collection_path = os.path.join(tmp_dir, 'articles.jsonl')
+    with open(collection_path, 'w') as f:
+        for pmid, title, abstract in [
+                ('11', 'Hirschsprung disease', 'RET mutations cause Hirschsprung disease'),
+                ('12', 'Muscular dystrophy', 'Bone fractures and osteoporosis in Duchenne patients'),
+                ('13', 'Glucocorticoids', 'Steroid treatment and bone density')]:
+            f.write(json.dumps({'pmid': pmid, 'title': title, 'abstract': abstract}) + '\n')
+    lexical_path = os.path.join(tmp_dir, 'bm25.sqlite')
+    dense_dir = os.path.join(tmp_dir, 'dense_index')
+    hybrid_search.build_indexes(collection_path, lexical_path, dense_dir, FakeEncoder(), model_name='fake')
+    retriever = hybrid_search.HybridRetriever(lexical_path, dense_dir)
+    # 'osteoporosis' is not in the encoder vocabulary, only BM25 finds it
+    assert retriever.get_lexical_pmids('Is osteoporosis frequent?', 10) == ['12']
+    pmids = retriever.get_pmids(FakeEncoder(), 'What is the bone density of Duchenne patients with osteoporosis?', top_k=2)
+    assert pmids == ['12', '13']
+    # A rebuild from a changed collection replaces the BM25 index, both indexes hold the same articles
+    hybrid_search.build_indexes(collection_path, lexical_path, dense_dir, FakeEncoder(), model_name='fake')
+    retriever = hybrid_search.HybridRetriever(lexical_path, dense_dir)
+    assert retriever.lexical_index.count() == retriever.dense_index.meta['count'] == 3
+    with open(collection_path, 'w') as f:
+        f.write(json.dumps({'pmid': '13', 'title': 'Glucocorticoids', 'abstract': 'Steroid treatment and bone density'}) + '\n')
+    hybrid_search.build_indexes(collection_path, lexical_path, dense_dir, FakeEncoder(), model_name='fake')
+    retriever = hybrid_search.HybridRetriever(lexical_path, dense_dir)
+    assert retriever.lexical_index.count() == retriever.dense_index.meta['count'] == 1
+    assert retriever.get_lexical_pmids('Is osteoporosis frequent?', 10) == []
+
+def test_extract_snippets_batched():
+    import config
+    import helper_utils
+    import model
+    class _CountingEncoder(FakeEncoder):
+        def __init__(self):
+            self.calls = []
+        def encode(self, sentences, batch_size=32, normalize_embeddings=False):
+            self.calls.append(1 if isinstance(sentences, str) else len(sentences))
+            return super().encode(sentences, batch_size, normalize_embeddings)
+    articles = [
+        {'pmid': '1', 'title': 'Bone health', 'abstract_raw': 'Crest cells. RET and Hirschsprung',
+            'abstract_list': ['Crest cells. RET and Hirschsprung']},
+        {'pmid': '2', 'title': 'Only a title', 'abstract_raw': '', 'abstract_list': []},
+        {'pmid': '3', 'title': 'Duchenne', 'abstract_raw': 'Bone loss in Duchenne. Other', 'abstract_list': ['Bone loss in Duchenne. Other']},
+        {'pmid': '4', 'title': 'Crest', 'abstract_raw': 'Neural crest', 'abstract_list': ['Neural crest']}]
+    qbody = 'Is RET mutated in Hirschsprung disease and bone loss in Duchenne?'
+    orig_mode, orig_batch_size = config.SNIP_EXTRACT_MODE, config.ST_BATCH_SIZE
+    config.SNIP_EXTRACT_MODE, config.ST_BATCH_SIZE = 'TRANSFORMER', 64
+    try:
+        st_model = _CountingEncoder()
+        snippets = model.extract_snippets(iter(articles), qbody, st_model)
+        # The question is encoded once and all sentences in one call
+        assert st_model.calls == [1, 8]
+        # A small batch size ranks the articles in several calls, with the same snippets
+        config.ST_BATCH_SIZE = 3
+        st_model = _CountingEncoder()
+        assert model.extract_snippets(iter(articles), qbody, st_model) == snippets
+        assert st_model.calls == [1, 3, 3, 2]
+    finally:
+        config.SNIP_EXTRACT_MODE, config.ST_BATCH_SIZE = orig_mode, orig_batch_size
+    # Same snippets as ranking each article on its own
+    expected = []
+    for article in articles:
+        if not article['abstract_raw']:
+            expected.append(article['title'])
+            continue
+        sentences = model.get_article_sentences(article)
+        expected.append(sentences[int(helper_utils.get_top_results(FakeEncoder(), qbody, sentences, 3)[1][0])])
+    assert [snip['text'] for snip in snippets] == expected == ['RET and Hirschsprung', 'Only a title', 'Bone loss in Duchenne', 'Neural crest']
+    assert snippets[0]['beginSection'] == 'abstract' and snippets[0]['offsetInBeginSection'] == 13
+
+def test_embedding_store():
+    import os
+    import tempfile
+    import numpy as np
+    from embedding_store import EmbeddingStore, load_cached_encoder
+    class _CountingEncoder(FakeEncoder):
+        def __init__(self):
+            self.encoded = []
+        def encode(self, sentences, batch_size=32, normalize_embeddings=False):
+            self.encoded.extend(sentences)
+            return super().encode(sentences, batch_size, normalize_embeddings)
+    store_dir = tempfile.mkdtemp()
+    st_model = _CountingEncoder()
+    encoder = load_cached_encoder(st_model, 'fake/model', store_dir)
+    first = encoder.encode(['RET RET bone', 'Duchenne', 'RET RET bone'])
+    assert st_model.encoded == ['RET RET bone', 'Duchenne']
+    assert np.allclose(first[0], [0, 2, 0, 1, 0]) and np.allclose(first[2], first[0])
+    # The stored vectors are the model's, the normalization is done after the lookup
+    normalized = encoder.encode('RET RET bone', normalize_embeddings=True)
+    assert normalized.shape == (5,) and np.allclose(normalized, np.array([0, 2, 0, 1, 0]) / np.sqrt(5), atol=1e-3)
+    assert st_model.encoded == ['RET RET bone', 'Duchenne']
+    assert encoder.stats == {'hit': 1, 'miss': 3}
+    assert encoder.get_sentence_embedding_dimension() == 5
+    # A new run reads the stored vectors
+    st_model = _CountingEncoder()
+    encoder = load_cached_encoder(st_model, 'fake/model', store_dir)
+    second = encoder.encode(['Duchenne', 'crest', 'RET RET bone'])
+    assert st_model.encoded == ['crest']
+    assert np.array_equal(second[0], first[1]) and np.array_equal(second[2], first[0])
+    # The rows appended without hash by an interrupted run are dropped
+    store = EmbeddingStore(store_dir, 'fake/model', 5)
+    with open(store.vector_path, 'ab') as f:
+        f.write(np.ones(5, dtype=np.float16).tobytes())
+    store = EmbeddingStore(store_dir, 'fake/model', 5)
+    assert len(store) == 3 and os.path.getsize(store.vector_path) == 3 * 5 * 2
+    vectors, missing = store.get_many(['crest', 'unknown'])
+    assert missing == ['unknown'] and np.allclose(vectors[0], [0, 0, 0, 0, 1]) and not vectors[1].any()
+
+def test_snippet_rerank():
+    import config
+    import model
+    from snippet_rerank import SnippetReranker
+    class _FakeCrossEncoder:
+        # Score by the number of 'ret' and 'hirschsprung' words, counts the scored pairs
+        def __init__(self):
+            self.batches = []
+        def predict(self, pairs, batch_size=32):
+            self.batches.append(len(pairs))
+            return [sentence.lower().count('hirschsprung') + 2 * sentence.lower().count('ret') for _, sentence in pairs]
+    class _FakeClock:
+        # Every call takes one second
+        def __init__(self):
+            self.now = 0.0
+        def __call__(self):
+            self.now += 1.0
+            return self.now
+    candidates = [(0.9, 'Hirschsprung', '1'), (0.8, 'RET', '1'), (0.7, 'RET and RET', '2'), (0.6, 'other', '2'), (0.5, 'RET RET RET', '3')]
+    cross_encoder = _FakeCrossEncoder()
+    reranker = SnippetReranker(cross_encoder, batch_size=2, latency_budget=0)
+    assert [cand[1] for cand in reranker.rerank('q', candidates)] == ['RET RET RET', 'RET and RET', 'RET', 'Hirschsprung', 'other']
+    assert cross_encoder.batches == [2, 2, 1]
+    # Over budget, the candidates left keep the bi-encoder order after the reranked batch
+    cross_encoder = _FakeCrossEncoder()
+    reranker = SnippetReranker(cross_encoder, batch_size=2, latency_budget=1.5, clock=_FakeClock())
+    assert [cand[1] for cand in reranker.rerank('q', candidates)] == ['RET', 'Hirschsprung', 'RET and RET', 'other', 'RET RET RET']
+    assert cross_encoder.batches == [2] and reranker.stats == {'scored': 2, 'skipped': 3}
+    # At most max_per_article snippets per article
+    reranker = SnippetReranker(_FakeCrossEncoder(), batch_size=8, latency_budget=0)
+    selected = reranker.select('q', candidates + [(0.4, 'RET Hirschsprung', '3')], max_snippets=4, max_per_article=1)
+    assert [(cand[1], cand[2]) for cand in selected] == [('RET RET RET', '3'), ('RET and RET', '2'), ('RET', '1')]
+    # extract_snippets returns the reranked sentences of all articles
+    articles = [
+        {'pmid': '1', 'title': 'Bone health', 'abstract_raw': 'Crest cells. RET and Hirschsprung',
+            'abstract_list': ['Crest cells. RET and Hirschsprung']},
+        {'pmid': '2', 'title': 'Only a title', 'abstract_raw': '', 'abstract_list': []},
+        {'pmid': '3', 'title': 'RET in Hirschsprung', 'abstract_raw': 'RET RET', 'abstract_list': ['RET RET']}]
+    orig_mode = config.SNIP_EXTRACT_MODE
+    config.SNIP_EXTRACT_MODE = 'TRANSFORMER'
+    try:
+        reranker = SnippetReranker(_FakeCrossEncoder(), batch_size=8, latency_budget=0)
+        snippets = model.extract_snippets(articles, 'RET in Hirschsprung?', FakeEncoder(), reranker=reranker)
+    finally:
+        config.SNIP_EXTRACT_MODE = orig_mode
+    assert [(snip['document'][-1], snip['text'], snip['beginSection']) for snip in snippets] == [
+        ('3', 'RET RET', 'abstract'), ('1', 'RET and Hirschsprung', 'abstract'), ('3', 'RET in Hirschsprung', 'title'),
+        ('1', 'Crest cells', 'abstract'), ('2', 'Only a title', 'title')]
+
+def test_model_manager():
+    import threading
+    import time
+    import model_manager
+    loads = []
+    def _load():
+        loads.append(threading.current_thread().name)
+        time.sleep(0.2)
+        return object()
+    key = ('test_model', object()) # a new model for every run of the test
+    threads = model_manager.warm_up(lambda: model_manager.get_model(key, _load))
+    # The callers during the load wait for it and get the same model
+    results = []
+    callers = [threading.Thread(target=lambda: results.append(model_manager.get_model(key, _load))) for _ in range(4)]
+    for thread in callers:
+        thread.start()
+    for thread in callers + threads:
+        thread.join()
+    assert len(loads) == 1 and len(results) == 4 and all(res is results[0] for res in results)
+    assert model_manager.is_loaded(key) and model_manager.get_model(key, _load) is results[0]
+
+def test_onnx_embedder():
+    import numpy as np
+    from onnx_embedder import OnnxEmbedder, mean_pooling, check_parity, benchmark, load_fixture_sentences
+    vocab = ['[PAD]', 'ret', 'bone', 'crest']
+    class _FakeTokenizer:
+        def __call__(self, texts, padding=True, truncation=True, max_length=None, return_tensors='np'):
+            ids = [[vocab.index(word) for word in text.split()][:max_length] for text in texts]
+            length = max(len(row) for row in ids)
+            return {'input_ids': np.array([row + [0] * (length - len(row)) for row in ids]),
+                    'attention_mask': np.array([[1] * len(row) + [0] * (length - len(row)) for row in ids])}
+    class _FakeSession:
+        # The token embeddings are the one-hot vectors of the token ids, records the batch shapes
+        def __init__(self):
+            self.shapes = []
+        def run(self, output_names, inputs):
+            self.shapes.append(inputs['input_ids'].shape)
+            return [np.eye(len(vocab), dtype=np.float32)[inputs['input_ids']]]
+    session = _FakeSession()
+    embedder = OnnxEmbedder(session, _FakeTokenizer(), {'dim': 4, 'max_seq_length': 3, 'input_names': ['input_ids', 'attention_mask'], 'normalize': False})
+    embeddings = embedder.encode(['crest', 'ret ret bone bone', 'bone ret'], batch_size=2)
+    # The padding tokens are not pooled, the long sentence is truncated, the input order is kept
+    assert np.allclose(embeddings, [[0, 0, 0, 1], [0, 2 / 3, 1 / 3, 0], [0, 0.5, 0.5, 0]])
+    assert session.shapes == [(2, 3), (1, 1)]
+    assert np.allclose(embedder.encode('ret bone', normalize_embeddings=True), [0, np.sqrt(0.5), np.sqrt(0.5), 0])
+    assert np.allclose(mean_pooling(np.ones((1, 3, 2)), np.array([[1, 1, 0]])), [[1, 1]])
+    sentences = load_fixture_sentences()
+    assert len(sentences) == 20
+    parity = check_parity(FakeEncoder(), FakeEncoder(), ['RET in Hirschsprung', 'bone crest', 'Duchenne'])
+    assert parity['passed'] and abs(parity['min_cosine'] - 1) < 1e-6 and parity['topk_overlap'] == 1.0
+    # The embeddings of the other sentences: every nearest neighbour changes, the overlap fails the check
+    class _RotatedEncoder(FakeEncoder):
+        def encode(self, sentences, batch_size=32, normalize_embeddings=False):
+            return super().encode(sentences[1:] + sentences[:1], batch_size, normalize_embeddings)
+    parity = check_parity(FakeEncoder(), _RotatedEncoder(), ['ret', 'ret crest', 'bone', 'bone crest'], min_cosine=-1, top_k=1)
+    assert parity['topk_overlap'] == 0.0 and not parity['passed']
+    class _NoisyEncoder(FakeEncoder):
+        def encode(self, sentences, batch_size=32, normalize_embeddings=False):
+            return super().encode(sentences, batch_size, normalize_embeddings) + 0.5
+    assert not check_parity(FakeEncoder(), _NoisyEncoder(), ['RET bone'])['passed']
+    rates = benchmark({'fake': FakeEncoder()}, sentences, batch_size=8, repeat=2)
+    assert list(rates) == ['fake'] and rates['fake'] > 0
+
+def test_onnx_export_parity():
+    import importlib.util
+    import os
+    import re
+    import tempfile
+    import config
+    import onnx_embedder
+    missing = [name for name in ('torch', 'transformers', 'sentence_transformers', 'onnxruntime', 'onnx')
+               if importlib.util.find_spec(name) is None]
+    if missing:
+        print(f'Skip test_onnx_export_parity, not installed: {missing}')
+        return
+    import torch
+    from transformers import BertConfig, BertModel, BertTokenizer
+    from sentence_transformers import SentenceTransformer, models
+    sentences = onnx_embedder.load_fixture_sentences()
+    # A small random BERT with the words of the fixture as vocabulary, exported as the real model would be
+    tmp_dir = tempfile.mkdtemp()
+    bert_dir = os.path.join(tmp_dir, 'bert')
+    os.makedirs(bert_dir)
+    words = sorted({word for sentence in sentences for word in re.findall(r'\w+|[^\w\s]', sentence.lower())})
+    with open(os.path.join(bert_dir, 'vocab.txt'), 'w') as f:
+        f.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + words) + '\n')
+    BertTokenizer(os.path.join(bert_dir, 'vocab.txt')).save_pretrained(bert_dir)
+    torch.manual_seed(0)
+    BertModel(BertConfig(vocab_size=len(words) + 5, hidden_size=32, num_hidden_layers=2, num_attention_heads=2,
+        intermediate_size=64, max_position_embeddings=128)).save_pretrained(bert_dir)
+    st_dir = os.path.join(tmp_dir, 'st')
+    SentenceTransformer(modules=[models.Transformer(bert_dir, max_seq_length=64), models.Pooling(32, 'mean'), models.Normalize()]).save(st_dir)
+    onnx_dir = os.path.join(tmp_dir, 'onnx')
+    onnx_embedder.export_onnx(st_dir, onnx_dir)
+    reference = SentenceTransformer(st_dir)
+    for quantized in (False, True):
+        parity = onnx_embedder.check_parity(reference, onnx_embedder.load_onnx_embedder(onnx_dir, quantized, num_threads=1), sentences)
+        print(f'Tiny model parity, quantized={quantized}: {parity}')
+        assert parity['passed']
+    # The exported real model, when it was exported on this machine
+    if not os.path.exists(os.path.join(config.ONNX_MODEL_DIR, 'meta.json')):
+        print(f'Skip the {config.DENSE_MODEL_NAME} parity check, export it with onnx_embedder.py --export')
+        return
+    reference = SentenceTransformer(config.DENSE_MODEL_NAME)
+    for quantized in (False, True):
+        embedder = onnx_embedder.load_onnx_embedder(config.ONNX_MODEL_DIR, quantized, config.ONNX_NUM_THREADS)
+        parity = onnx_embedder.check_parity(reference, embedder, sentences)
+        print(f'{config.DENSE_MODEL_NAME} parity, quantized={quantized}: {parity}')
+        assert parity['passed']
+
+def test_resume_stage_b():
+    import json
+    import os
+    import tempfile
+    import config
+    import model
+    asked = []
+    def _qa_ask_llm(cur_model, ques, context, log_file=None):
+        asked.append(ques.id)
+        return {'ideal': f'ideal {ques.id}', 'exact': 'yes'}, [f'raw {ques.id}']
+    questions = [{'id': f'q{ind}', 'body': f'Question {ind}?', 'type': 'yesno', 'documents': [], 'snippets': []} for ind in range(4)]
+    orig_cwd, orig_ask, orig_context = os.getcwd(), model.qa_ask_llm, config.ADD_QA_CONTEXT
+    os.chdir(tempfile.mkdtemp())
+    model.qa_ask_llm, config.ADD_QA_CONTEXT = _qa_ask_llm, False
+    try:
+        for folder in ('input', 'output', 'logs'):
+            os.mkdir(folder)
+        with open('input/resume.json', 'w') as f:
+            json.dump({'questions': questions}, f)
+        # q0 and q2 were answered before the crash, the last line was cut while written
+        res_path = 'logs/res_inc_1700000000.jsonl'
+        for ques_id in ('q0', 'q2'):
+            model.append_log(res_path, {'id': ques_id, 'body': '', 'type': 'yesno', 'ideal_answer': f'old {ques_id}', 'exact_answer': 'no'})
+        with open(res_path, 'a') as f:
+            f.write('{"id": "q1", "ideal')
+        assert list(model.load_checkpoint(res_path)) == ['q0', 'q2']
+        model.run('resume', 'B', False, resume=res_path)
+        with open('output/submission_stageB_resume_1700000000.json', 'r') as f:
+            submission = json.load(f)['questions']
+        # The answers of the resumed run are checkpointed too
+        assert list(model.load_checkpoint(res_path)) == ['q0', 'q2', 'q1', 'q3']
+    finally:
+        os.chdir(orig_cwd)
+        model.qa_ask_llm, config.ADD_QA_CONTEXT = orig_ask, orig_context
+    assert sorted(asked) == ['q1', 'q3']
+    assert [ques['id'] for ques in submission] == ['q0', 'q1', 'q2', 'q3']
+    assert [ques['ideal_answer'] for ques in submission] == ['old q0', 'ideal q1', 'old q2', 'ideal q3']
+
 test_calculate_qa_accuracy_yesno()
 test_calculate_qa_accuracy_factoid()
 test_calculate_qa_accuracy_list()
 test_ir_accuracy()
-test_postproc_predict()
\ No newline at end of file
+test_postproc_predict()
+test_token_bucket()
+test_llm_cache()
+test_llm_replay()
+test_llm_replay_bypasses_cache()
+test_llm_recorder_rotation()
+test_query_by_pmids_chunks()
+test_parse_pubmed_articles()
+test_article_store()
+test_iter_articles_by_pmids()
+test_baseline_index()
+test_dense_index()
+test_hybrid_search()
+test_extract_snippets_batched()
+test_embedding_store()
+test_snippet_rerank()
+test_model_manager()
+test_onnx_embedder()
+test_onnx_export_parity()
+test_resume_stage_b()